@@ -0,0 +1,239 @@
+"""
+Host-wide admission control for pandoc processes.
+
+Every gunicorn worker, job thread and batch process on the host takes one of
+``max_active`` slots before it starts pandoc, and waits for a free slot in a
+queue of at most ``max_queued`` entries. Slots and queue entries are
+``flock()`` locks on files in a shared directory, so they are counted across
+processes and released by the kernel if a process dies while holding one.
+
+A request is rejected instead of waiting when the queue is full, when it has
+waited longer than ``queue_timeout`` seconds, or when less than
+``min_free_bytes`` of memory is available to the container.
+
+``acquire()`` waits by sleeping; ``acquire_async()`` waits on the event loop
+for servers that run many conversions per process.
+"""
+
+import asyncio
+import fcntl
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+MEMINFO_PATH = '/proc/meminfo'
+# cgroup v2 and v1 locations of the container's memory limit and usage
+CGROUP_V2 = ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current', '/sys/fs/cgroup/memory.stat', 'inactive_file')
+CGROUP_V1 = ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes',
+             '/sys/fs/cgroup/memory/memory.stat', 'total_inactive_file')
+
+# Polling interval bounds while waiting for a slot
+MIN_POLL_INTERVAL = 0.01
+MAX_POLL_INTERVAL = 0.1
+
+
+class AdmissionRejected(Exception):
+    """A pandoc slot could not be granted; the client should retry later."""
+
+    def __init__(self, reason, message, status_code, retry_after):
+        super().__init__(message)
+        self.reason = reason
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def _read_int(path):
+    try:
+        with open(path, 'r') as f:
+            value = f.read().strip()
+    except OSError:
+        return None
+    return int(value) if value.isdigit() else None
+
+
+def _read_stat(path, key):
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                name, _, value = line.partition(' ')
+                if name == key:
+                    return int(value)
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def available_memory():
+    """
+    Bytes of memory available to this container, or None if unknown.
+
+    The smaller of the host's MemAvailable and the headroom below the cgroup
+    memory limit, counting reclaimable page cache as free like the kernel does.
+    """
+    candidates = []
+    try:
+        with open(MEMINFO_PATH, 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    candidates.append(int(line.split()[1]) * 1024)
+                    break
+    except (OSError, ValueError):
+        pass
+
+    for limit_path, usage_path, stat_path, inactive_key in (CGROUP_V2, CGROUP_V1):
+        limit = _read_int(limit_path)
+        usage = _read_int(usage_path)
+        # An unlimited cgroup reports 'max' (v2) or a huge number (v1)
+        if limit is None or usage is None or limit >= 1 << 60:
+            continue
+        usage -= _read_stat(stat_path, inactive_key)
+        candidates.append(max(0, limit - usage))
+        break
+
+    return min(candidates) if candidates else None
+
+
+class _Lock:
+    """An exclusive flock on one slot or queue file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def try_acquire(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)      # closing the descriptor drops the lock
+            self._fd = None
+
+    def is_held(self):
+        """Whether any process holds this lock (probing takes and drops it when free)."""
+        if self.try_acquire():
+            self.release()
+            return False
+        return True
+
+
+class AdmissionController:
+    """Bounded, host-wide semaphore with a bounded wait queue."""
+
+    def __init__(self, directory, max_active, max_queued, queue_timeout, min_free_bytes, retry_after):
+        self.directory = directory
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.min_free_bytes = min_free_bytes
+        self.retry_after = retry_after
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _slots(self):
+        return [_Lock(os.path.join(self.directory, f'slot-{i}.lock')) for i in range(self.max_active)]
+
+    def _queue(self):
+        return [_Lock(os.path.join(self.directory, f'queue-{i}.lock')) for i in range(self.max_queued)]
+
+    def _try_any(self, locks):
+        for lock in locks:
+            if lock.try_acquire():
+                return lock
+        return None
+
+    def _check_memory(self):
+        if self.min_free_bytes <= 0:
+            return
+        available = available_memory()
+        if available is not None and available < self.min_free_bytes:
+            raise AdmissionRejected(
+                'memory',
+                f"Server is low on memory ({available // (1024 * 1024)} MB free), try again later",
+                503, self.retry_after)
+
+    def acquire(self):
+        """
+        Take a pandoc slot, waiting in the queue if all slots are busy.
+
+        Returns the held slot; call its release() when pandoc has finished.
+        Raises AdmissionRejected when the request should be turned away.
+        """
+        attempts = self._attempts()
+        try:
+            while True:
+                time.sleep(next(attempts))
+        except StopIteration as done:
+            return done.value
+        finally:
+            attempts.close()
+
+    async def acquire_async(self):
+        """Like acquire(), but waits without blocking the event loop; cancelling gives up the queue position."""
+        attempts = self._attempts()
+        try:
+            while True:
+                await asyncio.sleep(next(attempts))
+        except StopIteration as done:
+            return done.value
+        finally:
+            attempts.close()
+
+    def _attempts(self):
+        """
+        The steps of acquiring a slot, shared by acquire() and acquire_async().
+
+        Yields the seconds to wait before the next try and returns the slot.
+        Closing the generator while it waits releases the queue position.
+        """
+        self._check_memory()
+
+        # Start at a per-process slot so workers do not all probe slot 0 first
+        slots = self._slots()
+        start = os.getpid() % len(slots)
+        slots = slots[start:] + slots[:start]
+        slot = self._try_any(slots)
+        if slot is not None:
+            return slot
+
+        position = self._try_any(self._queue())
+        if position is None:
+            raise AdmissionRejected(
+                'queue_full', "Too many conversions in progress, try again later", 429, self.retry_after)
+
+        try:
+            deadline = time.monotonic() + self.queue_timeout
+            interval = MIN_POLL_INTERVAL
+            while True:
+                yield interval
+                interval = min(interval * 2, MAX_POLL_INTERVAL)
+                slot = self._try_any(slots)
+                if slot is not None:
+                    # Memory may have run low while this request was waiting
+                    try:
+                        self._check_memory()
+                    except AdmissionRejected:
+                        slot.release()
+                        raise
+                    return slot
+                if time.monotonic() >= deadline:
+                    raise AdmissionRejected(
+                        'timeout',
+                        f"No conversion slot became free within {self.queue_timeout} seconds, try again later",
+                        503, self.retry_after)
+        finally:
+            position.release()
+
+    def state(self):
+        """Host-wide number of 'active' slots and 'queued' requests."""
+        return {
+            'active': sum(lock.is_held() for lock in self._slots()),
+            'queued': sum(lock.is_held() for lock in self._queue()),
+        }
@@ -1,47 +1,520 @@
+import codecs
+import contextvars
+import hashlib
+import io
+import json
+import multiprocessing
 import os
+import re
+import shutil
 import tempfile
 import subprocess
 import logging
-import sys
-from flask import Flask, request, send_file, jsonify, send_from_directory
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from concurrent.futures.process import BrokenProcessPool
+from flask import (Flask, g, has_request_context, request, send_file, jsonify, send_from_directory, stream_with_context,
+                   url_for)
 from functools import wraps
+from werkzeug.exceptions import HTTPException
+from admission import AdmissionController, AdmissionRejected
+from book_store import BookStore, valid_id
+from chunked_epub import has_images, make_chunks, merge_fragments
+from conversion_profiles import DEFAULT_PROFILE, EPUB_WRITERS, load_profiles
+from epub_compress import COMPRESSION_MODES, recompress_epub
+from epub_inspect import VERIFY_MODES, inspect_epub
+from epub_writer import Chapter, extract_headings, write_epub
+from image_assets import AssetStore, InvalidImage, decode_base64_image, link_images, optimization_available
+from idempotency_store import IdempotencyConflict, IdempotencyStore
+from job_store import JobStore
+from live_preview import render_preview
+from markdown_normalizer import MarkdownNormalizer, normalize_markdown
+from metrics import SIZE_BUCKETS, Metrics
+from native_engine import NativeUnsupported, render_blocks as render_native_blocks, render_chapters
+from pandoc_limits import PandocLimitExceeded, PandocLimits
+from pandoc_pool import PandocServerPool, PandocPoolError, PandocPoolTimeout
+from request_body import BodyDecodeError, BodyTooLarge, UnsupportedEncoding, install_body_stream, supported_encodings
+from result_cache import ResultCache, cache_key, cache_key_hasher
+from result_store import RESULT_STORE_BACKENDS, create_result_store
+from structured_logging import (
+    LOG_FORMATS, bind_log_context, clip, configure_logging, log_context, new_request_id, start_request
+)
+
+# Logging: LOG_FORMAT 'text' or 'json' (one object per line); LOG_DEBUG_SAMPLE_RATE is
+# the fraction of requests whose debug detail is logged at LOG_LEVEL=DEBUG, and
+# LOG_MAX_PAYLOAD caps the characters of pandoc output and other payloads logged
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', 1.0))
+LOG_MAX_PAYLOAD = int(os.environ.get('LOG_MAX_PAYLOAD', 2048))
 
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
+configure_logging(
+    LOG_LEVEL if isinstance(logging.getLevelName(LOG_LEVEL), int) else 'INFO',
+    LOG_FORMAT if LOG_FORMAT in LOG_FORMATS else 'text',
+    max_payload=LOG_MAX_PAYLOAD
 )
 logger = logging.getLogger(__name__)
+if not isinstance(logging.getLevelName(LOG_LEVEL), int):
+    logger.warning("Unknown LOG_LEVEL '%s', using 'INFO'", LOG_LEVEL)
+if LOG_FORMAT not in LOG_FORMATS:
+    logger.warning("Unknown LOG_FORMAT '%s', using 'text'", LOG_FORMAT)
+
+# Client-supplied request ids that are reused for log correlation
+REQUEST_ID_RE = re.compile(r'^[A-Za-z0-9._:-]{1,128}$')
 
 app = Flask(__name__)
 
 # Get auth token from environment variable
 AUTH_TOKEN = os.environ.get('AUTH_TOKEN', '')
 
+# Maximum size of a /convert request body after decompression, enforced while
+# the body is read (0 disables the limit)
+MAX_INPUT_MB = int(os.environ.get('MAX_INPUT_MB', 50))
+MAX_INPUT_BYTES = MAX_INPUT_MB * 1024 * 1024
+
+# Result cache configuration (the disk tier is shared by all workers on the host)
+CACHE_ENABLED = os.environ.get('CACHE_ENABLED', 'True').lower() == 'true'
+CACHE_DIR = os.environ.get('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'epub-cache'))
+CACHE_MEMORY_MB = int(os.environ.get('CACHE_MEMORY_MB', 32))
+CACHE_DISK_MB = int(os.environ.get('CACHE_DISK_MB', 512))
+CACHE_TTL = int(os.environ.get('CACHE_TTL', 86400))
+
+result_cache = ResultCache(
+    CACHE_DIR,
+    max_memory_bytes=CACHE_MEMORY_MB * 1024 * 1024,
+    max_disk_bytes=CACHE_DISK_MB * 1024 * 1024,
+    ttl=CACHE_TTL
+) if CACHE_ENABLED else None
+
+# /convert/formats parses markdown once into pandoc's JSON AST and keeps it in a
+# cache of its own, by content hash, for further formats of the same document
+AST_CACHE_DIR = os.environ.get('AST_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'epub-ast-cache'))
+AST_CACHE_MEMORY_MB = int(os.environ.get('AST_CACHE_MEMORY_MB', 16))
+AST_CACHE_DISK_MB = int(os.environ.get('AST_CACHE_DISK_MB', 256))
+
+ast_cache = ResultCache(
+    AST_CACHE_DIR,
+    max_memory_bytes=AST_CACHE_MEMORY_MB * 1024 * 1024,
+    max_disk_bytes=AST_CACHE_DISK_MB * 1024 * 1024,
+    ttl=CACHE_TTL,
+    suffix='.json'
+) if CACHE_ENABLED else None
+
+# Live preview (/preview) keeps the rendered blocks of the documents being edited in
+# memory, PREVIEW_CACHE_MB per worker, so that an edit re-renders only the changed blocks
+PREVIEW_CACHE_MB = int(os.environ.get('PREVIEW_CACHE_MB', 16))
+
+preview_cache = ResultCache(
+    None,
+    max_memory_bytes=PREVIEW_CACHE_MB * 1024 * 1024,
+    max_disk_bytes=0,
+    ttl=CACHE_TTL
+) if PREVIEW_CACHE_MB > 0 else None
+
+# Previews do not take the admission slots of conversions: each worker runs pandoc for at
+# most PREVIEW_MAX_ACTIVE previews at once and answers further ones with 429 (0: no limit)
+PREVIEW_MAX_ACTIVE = int(os.environ.get('PREVIEW_MAX_ACTIVE', 2))
+
+preview_slots = threading.BoundedSemaphore(PREVIEW_MAX_ACTIVE) if PREVIEW_MAX_ACTIVE > 0 else None
+
+# Output formats of /convert/formats: pandoc writer -> (file extension, media type)
+OUTPUT_FORMATS = {
+    'epub3': ('epub', 'application/epub+zip'),
+    'epub2': ('epub', 'application/epub+zip'),
+    'html5': ('html', 'text/html'),
+    'docx': ('docx', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'),
+    'odt': ('odt', 'application/vnd.oasis.opendocument.text'),
+}
+
+# Delivery of generated EPUBs: 'stream' sends the file from the worker,
+# 'x-accel-redirect' (nginx) and 'x-sendfile' (Apache, lighttpd) hand it to the
+# front proxy, which must be able to read SENDFILE_DIR
+EPUB_DELIVERY = os.environ.get('EPUB_DELIVERY', 'stream').lower()
+SENDFILE_DIR = os.environ.get('SENDFILE_DIR', os.path.join(tempfile.gettempdir(), 'epub-sendfile'))
+SENDFILE_TTL = int(os.environ.get('SENDFILE_TTL', 300))
+X_ACCEL_PREFIX = os.environ.get('X_ACCEL_PREFIX', '/protected-epub/')
+if EPUB_DELIVERY not in ('stream', 'x-accel-redirect', 'x-sendfile'):
+    logger.warning("Unknown EPUB_DELIVERY '%s', using 'stream'", EPUB_DELIVERY)
+    EPUB_DELIVERY = 'stream'
+if EPUB_DELIVERY != 'stream':
+    os.makedirs(SENDFILE_DIR, exist_ok=True)
+
+# Asynchronous jobs: state lives in JOBS_DIR so every worker can answer for any job
+JOBS_DIR = os.environ.get('JOBS_DIR', os.path.join(tempfile.gettempdir(), 'epub-jobs'))
+JOBS_WORKERS = int(os.environ.get('JOBS_WORKERS', 2))
+JOBS_TTL = int(os.environ.get('JOBS_TTL', 3600))
+JOBS_STALE_AFTER = int(os.environ.get('JOBS_STALE_AFTER', 900))
+
+job_store = JobStore(JOBS_DIR, ttl=JOBS_TTL, stale_after=JOBS_STALE_AFTER)
+job_executor = ThreadPoolExecutor(max_workers=JOBS_WORKERS, thread_name_prefix='epub-job')
+
+# Multi-chapter books; BOOKS_DIR should be on a persistent volume
+BOOKS_DIR = os.environ.get('BOOKS_DIR', os.path.join(tempfile.gettempdir(), 'epub-books'))
+
+book_store = BookStore(BOOKS_DIR)
+
+# Batch conversions run on a per-worker pool of BATCH_WORKERS processes
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', 2))
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 500))
+
+batch_pool = None
+batch_pool_lock = threading.Lock()
+
+# Verification of generated EPUBs: 'off', 'fast' (structure and metadata) or
+# 'full' (also manifest references and entry CRCs)
+EPUB_VERIFY_MODE = os.environ.get('EPUB_VERIFY_MODE', 'fast').lower()
+if EPUB_VERIFY_MODE not in VERIFY_MODES:
+    logger.warning("Unknown EPUB_VERIFY_MODE '%s', using 'fast'", EPUB_VERIFY_MODE)
+    EPUB_VERIFY_MODE = 'fast'
+
+# Recompression of generated EPUBs: 'off', 'fast' (quick deflate, media stored),
+# 'balanced' or 'smallest' (maximum deflate, minified markup, duplicate resources removed)
+EPUB_COMPRESSION = os.environ.get('EPUB_COMPRESSION', 'off').lower()
+if EPUB_COMPRESSION not in COMPRESSION_MODES:
+    logger.warning("Unknown EPUB_COMPRESSION '%s', using 'off'", EPUB_COMPRESSION)
+    EPUB_COMPRESSION = 'off'
+
+# Limits of pandoc processes: each is killed after PANDOC_TIMEOUT seconds
+# (PANDOC_JOB_TIMEOUT for asynchronous jobs) and after PANDOC_CPU_SECONDS of CPU time
+# (0 for the same as its timeout), and may use PANDOC_MAX_MEMORY_MB of heap; 0 disables a limit.
+# The heap limit has to stay below the container's memory limit (512 MB) to fire first.
+# Conversions on the pandoc server pool get the same timeouts and heap limit
+PANDOC_TIMEOUT = float(os.environ.get('PANDOC_TIMEOUT', 25))
+PANDOC_JOB_TIMEOUT = float(os.environ.get('PANDOC_JOB_TIMEOUT', 600))
+PANDOC_CPU_SECONDS = int(os.environ.get('PANDOC_CPU_SECONDS', 0))
+PANDOC_MAX_MEMORY_MB = int(os.environ.get('PANDOC_MAX_MEMORY_MB', 384))
+
+pandoc_limits = PandocLimits(cpu_seconds=PANDOC_CPU_SECONDS, memory_mb=PANDOC_MAX_MEMORY_MB)
+# The timeout in effect for the pandoc processes of the current request or job
+pandoc_timeout_var = contextvars.ContextVar('pandoc_timeout', default=PANDOC_TIMEOUT)
+
+# A request has to be answered within the worker timeout (gunicorn's --timeout, keep them
+# equal) or the worker is killed: pandoc gets at most what is left of WORKER_TIMEOUT after
+# the request waited for its slot, less RESPONSE_RESERVE seconds to send the answer (0: no cap)
+WORKER_TIMEOUT = float(os.environ.get('WORKER_TIMEOUT', 30))
+RESPONSE_RESERVE = 2
+# time.monotonic() by which the pandoc processes of the current request have to end; None in jobs
+request_deadline_var = contextvars.ContextVar('request_deadline', default=None)
+
+# Pandoc engine: 'subprocess' runs one pandoc process per conversion, 'server' keeps
+# a pool of warm pandoc server processes per worker and falls back to 'subprocess'.
+# Batch processes (see get_batch_pool) import the app too but always use 'subprocess',
+# so that the host runs PANDOC_POOL_SIZE servers per worker and no more
+BATCH_PROCESS_ENV = 'EPUB_BATCH_PROCESS'
+PANDOC_ENGINE = os.environ.get('PANDOC_ENGINE', 'subprocess').lower()
+PANDOC_SERVER_CMD = os.environ.get('PANDOC_SERVER_CMD', 'pandoc server')
+PANDOC_POOL_SIZE = int(os.environ.get('PANDOC_POOL_SIZE', 2))
+PANDOC_POOL_MAX_JOBS = int(os.environ.get('PANDOC_POOL_MAX_JOBS', 500))
+PANDOC_POOL_HEALTH_INTERVAL = int(os.environ.get('PANDOC_POOL_HEALTH_INTERVAL', 30))
+
+pandoc_pool = PandocServerPool(
+    PANDOC_POOL_SIZE,
+    max_jobs=PANDOC_POOL_MAX_JOBS,
+    health_interval=PANDOC_POOL_HEALTH_INTERVAL,
+    command=PANDOC_SERVER_CMD,
+    request_timeout=max(PANDOC_TIMEOUT, PANDOC_JOB_TIMEOUT) if PANDOC_TIMEOUT and PANDOC_JOB_TIMEOUT else 0,
+    limits=pandoc_limits
+) if PANDOC_ENGINE == 'server' and not os.environ.get(BATCH_PROCESS_ENV) else None
+
+if pandoc_pool is not None:
+    # gunicorn workers import the app after forking, so every worker starts its own servers
+    pandoc_pool.start()
+
+# Pandoc I/O: 'files' writes the markdown and metadata to a work directory and reads
+# the EPUB back; 'pipe' converts JSON requests of up to PANDOC_PIPE_MAX_KB over
+# pandoc's stdin/stdout in memory and uses the work directory for larger inputs
+PANDOC_IO = os.environ.get('PANDOC_IO', 'files').lower()
+if PANDOC_IO not in ('files', 'pipe'):
+    logger.warning("Unknown PANDOC_IO '%s', using 'files'", PANDOC_IO)
+    PANDOC_IO = 'files'
+PANDOC_PIPE_MAX_KB = int(os.environ.get('PANDOC_PIPE_MAX_KB', 1024))
+
+# Images sent with /convert requests are stored once per content hash in ASSETS_DIR and
+# removed ASSETS_TTL seconds after their last use. IMAGE_OPTIMIZE 'on' downscales them
+# to fit IMAGE_MAX_WIDTH x IMAGE_MAX_HEIGHT and recompresses them (requires Pillow)
+ASSETS_DIR = os.environ.get('ASSETS_DIR', os.path.join(tempfile.gettempdir(), 'epub-assets'))
+ASSETS_TTL = int(os.environ.get('ASSETS_TTL', 86400))
+IMAGE_OPTIMIZE = os.environ.get('IMAGE_OPTIMIZE', 'off').lower()
+IMAGE_MAX_WIDTH = int(os.environ.get('IMAGE_MAX_WIDTH', 1264))
+IMAGE_MAX_HEIGHT = int(os.environ.get('IMAGE_MAX_HEIGHT', 1680))
+IMAGE_QUALITY = int(os.environ.get('IMAGE_QUALITY', 80))
+if IMAGE_OPTIMIZE not in ('off', 'on'):
+    logger.warning("Unknown IMAGE_OPTIMIZE '%s', using 'off'", IMAGE_OPTIMIZE)
+    IMAGE_OPTIMIZE = 'off'
+if IMAGE_OPTIMIZE == 'on' and not optimization_available():
+    logger.warning("IMAGE_OPTIMIZE is 'on' but Pillow is not installed; images are embedded unchanged")
+
+asset_store = AssetStore(
+    ASSETS_DIR,
+    ASSETS_TTL,
+    optimize=(IMAGE_MAX_WIDTH, IMAGE_MAX_HEIGHT, IMAGE_QUALITY) if IMAGE_OPTIMIZE == 'on' else None
+)
+
+# Native engine: 'auto' converts simple markdown (headings, paragraphs, lists,
+# emphasis, links) in-process and hands everything else to pandoc; 'off' always uses pandoc
+NATIVE_ENGINE = os.environ.get('NATIVE_ENGINE', 'off').lower()
+if NATIVE_ENGINE not in ('off', 'auto'):
+    logger.warning("Unknown NATIVE_ENGINE '%s', using 'off'", NATIVE_ENGINE)
+    NATIVE_ENGINE = 'off'
+
+# Admission control: at most PANDOC_MAX_ACTIVE pandoc conversions run at once on the
+# host (0 disables the limit), with up to PANDOC_MAX_QUEUE more waiting for a slot
+PANDOC_MAX_ACTIVE = int(os.environ.get('PANDOC_MAX_ACTIVE', 2))
+PANDOC_MAX_QUEUE = int(os.environ.get('PANDOC_MAX_QUEUE', 8))
+PANDOC_QUEUE_TIMEOUT = float(os.environ.get('PANDOC_QUEUE_TIMEOUT', 20))
+MIN_FREE_MEMORY_MB = int(os.environ.get('MIN_FREE_MEMORY_MB', 64))
+RETRY_AFTER = int(os.environ.get('RETRY_AFTER', 5))
+ADMISSION_DIR = os.environ.get('ADMISSION_DIR', os.path.join(tempfile.gettempdir(), 'epub-admission'))
+
+admission = AdmissionController(
+    ADMISSION_DIR,
+    max_active=PANDOC_MAX_ACTIVE,
+    max_queued=PANDOC_MAX_QUEUE,
+    queue_timeout=PANDOC_QUEUE_TIMEOUT,
+    min_free_bytes=MIN_FREE_MEMORY_MB * 1024 * 1024,
+    retry_after=RETRY_AFTER
+) if PANDOC_MAX_ACTIVE > 0 else None
+
+# Responses of /convert requests with an Idempotency-Key header are kept for
+# IDEMPOTENCY_TTL seconds and replayed when the key is sent again
+IDEMPOTENCY_DIR = os.environ.get('IDEMPOTENCY_DIR', os.path.join(tempfile.gettempdir(), 'epub-idempotency'))
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 3600))
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_DIR, IDEMPOTENCY_TTL, retry_after=RETRY_AFTER)
+
+# Result store: /convert?delivery=url keeps the EPUB for RESULT_STORE_TTL seconds and
+# answers with a URL to download it from, with resumable Range requests. RESULT_STORE
+# selects the backend; 'local' keeps results in RESULT_STORE_DIR, shared by all workers
+RESULT_STORE = os.environ.get('RESULT_STORE', 'local').lower()
+if RESULT_STORE not in RESULT_STORE_BACKENDS:
+    logger.warning("Unknown RESULT_STORE '%s', using 'local'", RESULT_STORE)
+    RESULT_STORE = 'local'
+RESULT_STORE_DIR = os.environ.get('RESULT_STORE_DIR', os.path.join(tempfile.gettempdir(), 'epub-results'))
+RESULT_STORE_TTL = int(os.environ.get('RESULT_STORE_TTL', 86400))
+
+result_store = create_result_store(RESULT_STORE, RESULT_STORE_DIR, RESULT_STORE_TTL)
+
+# How /convert returns the EPUB, chosen per request with the delivery query parameter
+DELIVERY_MODES = ('body', 'url')
+
+# Parallel conversion: 'auto' splits markdown of PARALLEL_MIN_KB or more at its level-1
+# headings and converts the parts on up to PARALLEL_WORKERS pandoc processes at once;
+# 'off' converts every document in one piece. Each part takes a pandoc slot, so more
+# workers than PANDOC_MAX_ACTIVE only queue
+PARALLEL_CONVERSION = os.environ.get('PARALLEL_CONVERSION', 'auto').lower()
+if PARALLEL_CONVERSION not in ('off', 'auto'):
+    logger.warning("Unknown PARALLEL_CONVERSION '%s', using 'auto'", PARALLEL_CONVERSION)
+    PARALLEL_CONVERSION = 'auto'
+PARALLEL_MIN_KB = int(os.environ.get('PARALLEL_MIN_KB', 512))
+PARALLEL_WORKERS = int(os.environ.get('PARALLEL_WORKERS', min(4, os.cpu_count() or 1, PANDOC_MAX_ACTIVE or 4)))
+
+chunk_executor = ThreadPoolExecutor(max_workers=max(PARALLEL_WORKERS, 1), thread_name_prefix='epub-chunk')
+
+# Pipeline metrics: every worker writes its counters to METRICS_DIR, and /metrics
+# reports the sum over all workers on the host
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'epub-metrics'))
+
+metrics = Metrics(METRICS_DIR)
+metrics.counter('epub_http_requests_total', 'HTTP requests by endpoint, method and status code')
+metrics.histogram('epub_http_request_duration_seconds', 'Time to produce a response, by endpoint')
+metrics.histogram('epub_stage_duration_seconds', 'Time spent in each conversion pipeline stage')
+metrics.histogram('epub_input_bytes', 'Size of decoded /convert request bodies', buckets=SIZE_BUCKETS)
+metrics.histogram('epub_output_bytes', 'Size of generated EPUB files', buckets=SIZE_BUCKETS)
+metrics.counter('epub_conversions_total', 'Conversions by the engine that produced the EPUB')
+metrics.counter('epub_pandoc_exits_total', 'Finished pandoc processes by exit code')
+metrics.counter('epub_pandoc_limits_exceeded_total', 'Pandoc processes stopped for exceeding a limit (timeout, cpu, memory)')
+metrics.counter('epub_cache_lookups_total', 'Result cache lookups by result')
+metrics.counter('epub_ast_cache_lookups_total', 'Parsed document cache lookups by result')
+metrics.counter('epub_preview_blocks_total', 'Blocks of /preview documents by result (cached, rendered)')
+metrics.counter('epub_admission_rejections_total', 'Conversions turned away by admission control, by reason')
+metrics.counter('epub_replayed_responses_total', 'Conversions answered without converting, by kind (not_modified, idempotent)')
+if admission is not None:
+    metrics.gauge('epub_pandoc_active', 'Pandoc conversions running on the host', lambda: admission.state()['active'])
+    metrics.gauge('epub_pandoc_queued', 'Conversions waiting for a pandoc slot on the host', lambda: admission.state()['queued'])
+
+
+def record_stage(stage, seconds):
+    """Record the duration of a pipeline stage in the stage histogram and the Server-Timing header."""
+    metrics.observe('epub_stage_duration_seconds', seconds, stage=stage)
+    if has_request_context():
+        g.setdefault('stage_timings', []).append((stage, seconds))
+
+
+@contextmanager
+def timed_stage(stage):
+    """Record the duration of the with-block as a pipeline stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def admission_error(e):
+    """Count an AdmissionRejected and turn it into the ConversionError reported to the client."""
+    metrics.inc('epub_admission_rejections_total', reason=e.reason)
+    logger.warning("Conversion rejected by admission control (%s): %s", e.reason, e)
+    return ConversionError(str(e), e.status_code, retry_after=e.retry_after)
+
+
+def limit_error(e):
+    """Count a PandocLimitExceeded and turn it into the ConversionError reported to the client."""
+    metrics.inc('epub_pandoc_limits_exceeded_total', limit=e.limit)
+    logger.error("Pandoc stopped (%s limit): %s", e.limit, e)
+    return ConversionError(str(e), e.status_code)
+
+
+def pandoc_timeout():
+    """
+    The timeout of a pandoc run that starts now: the current one, cut to what is left of the request's deadline.
+    
+    Raises ConversionError (503) when the request spent its time waiting for a slot.
+    """
+    timeout = pandoc_timeout_var.get()
+    deadline = request_deadline_var.get()
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.monotonic()
+    if remaining < 1:
+        metrics.inc('epub_admission_rejections_total', reason='deadline')
+        logger.warning("No time left to run pandoc within the worker timeout of %s seconds", WORKER_TIMEOUT)
+        raise ConversionError("Server is busy, no time left to convert within the request timeout", 503,
+                              retry_after=RETRY_AFTER)
+    return round(min(timeout, remaining) if timeout else remaining, 1)
+
+
+def run_limited(cmd, **kwargs):
+    """Run a pandoc command line under pandoc_limits (see PandocLimits.run). Raises ConversionError on timeout."""
+    try:
+        return pandoc_limits.run(cmd, timeout=pandoc_timeout(), **kwargs)
+    except PandocLimitExceeded as e:
+        raise limit_error(e)
+
+
+def pool_convert(args, text, metadata):
+    """Convert on the pandoc server pool under the current limits. Raises ConversionError when one is exceeded."""
+    timeout = pandoc_timeout()
+    try:
+        return pandoc_pool.convert(args, text, metadata, timeout=timeout)
+    except PandocPoolTimeout:
+        raise limit_error(pandoc_limits.timeout_exceeded(timeout))
+    except PandocLimitExceeded as e:
+        raise limit_error(e)
+
+
+def check_pandoc_limits(returncode, stderr):
+    """Raise ConversionError if a finished pandoc process was stopped by its CPU or memory limit."""
+    try:
+        pandoc_limits.check(returncode, stderr)
+    except PandocLimitExceeded as e:
+        raise limit_error(e)
+
+
+@contextmanager
+def pandoc_slot():
+    """
+    Hold one of the host's pandoc slots for the with-block.
+    
+    Raises ConversionError with status 429 (queue full) or 503 (queue timeout,
+    low memory) and a Retry-After hint when the conversion is turned away.
+    """
+    if admission is None:
+        yield
+        return
+    
+    start = time.perf_counter()
+    try:
+        slot = admission.acquire()
+    except AdmissionRejected as e:
+        raise admission_error(e)
+    record_stage('queue', time.perf_counter() - start)
+    try:
+        yield
+    finally:
+        slot.release()
+
+
+@contextmanager
+def preview_slot():
+    """
+    Hold one of this worker's preview slots for the with-block.
+    
+    Previews do not wait for a slot: raises ConversionError with status 429
+    and a Retry-After hint when all of them are taken.
+    """
+    if preview_slots is None:
+        yield
+        return
+    
+    if not preview_slots.acquire(blocking=False):
+        metrics.inc('epub_admission_rejections_total', reason='preview')
+        raise ConversionError("Too many previews are being rendered, try again shortly", 429, retry_after=1)
+    try:
+        yield
+    finally:
+        preview_slots.release()
+
+
+@app.before_request
+def start_request_timer():
+    """Start timing the request and bind its id (X-Request-ID or a new one) to its log records."""
+    g.request_started = time.perf_counter()
+    request_deadline_var.set(time.monotonic() + WORKER_TIMEOUT - RESPONSE_RESERVE if WORKER_TIMEOUT else None)
+    request_id = request.headers.get('X-Request-ID', '')
+    g.request_id = request_id if REQUEST_ID_RE.match(request_id) else new_request_id()
+    start_request(g.request_id, LOG_DEBUG_SAMPLE_RATE)
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Count the request, add the Server-Timing header and publish this worker's metrics."""
+    elapsed = time.perf_counter() - g.request_started
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.inc('epub_http_requests_total', endpoint=endpoint, method=request.method, status=str(response.status_code))
+    metrics.observe('epub_http_request_duration_seconds', elapsed, endpoint=endpoint)
+    
+    timings = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in g.get('stage_timings', [])]
+    timings.append(f"total;dur={elapsed * 1000:.1f}")
+    response.headers['Server-Timing'] = ', '.join(timings)
+    response.headers['X-Request-ID'] = g.request_id
+    
+    metrics.flush()
+    return response
+
+def authentication_error():
+    """Return the 401 response when the request lacks a valid token, None when it may proceed."""
+    # If no auth token is configured or it's empty, skip authentication
+    if not AUTH_TOKEN or AUTH_TOKEN.strip() == '':
+        return None
+    
+    # Check for token in headers
+    token = None
+    auth_header = request.headers.get('Authorization')
+    if auth_header and auth_header.startswith('Bearer '):
+        token = auth_header.split(' ')[1]
+    
+    # Also check for token in X-Auth-Token header (alternative)
+    if not token:
+        token = request.headers.get('X-Auth-Token')
+    
+    # Check if token matches
+    if not token or token != AUTH_TOKEN:
+        logger.warning("Authentication failed: Invalid or missing token")
+        return jsonify({"error": "Authentication required"}), 401
+    return None
+
+
 def auth_required(f):
     """Decorator to check if authentication is required and validate token if needed."""
     @wraps(f)
     def decorated(*args, **kwargs):
-        # If no auth token is configured or it's empty, skip authentication
-        if not AUTH_TOKEN or AUTH_TOKEN.strip() == '':
-            return f(*args, **kwargs)
-        
-        # Check for token in headers
-        token = None
-        auth_header = request.headers.get('Authorization')
-        if auth_header and auth_header.startswith('Bearer '):
-            token = auth_header.split(' ')[1]
-        
-        # Also check for token in X-Auth-Token header (alternative)
-        if not token:
-            token = request.headers.get('X-Auth-Token')
-        
-        # Check if token matches
-        if not token or token != AUTH_TOKEN:
-            logger.warning(f"Authentication failed: Invalid or missing token")
-            return jsonify({"error": "Authentication required"}), 401
-            
+        error = authentication_error()
+        if error is not None:
+            return error
         return f(*args, **kwargs)
     return decorated
 
@@ -67,7 +540,7 @@ def index():
     try:
         return send_file('index.html')
     except Exception as e:
-        logger.error(f"Error serving index.html: {str(e)}")
+        logger.error("Error serving index.html: %s", e)
         return jsonify({"error": "Could not load index page"}), 500
 
 @app.route('/openapi.yaml', methods=['GET'])
@@ -86,29 +559,66 @@ def openapi_spec():
             logger.error("OpenAPI specification file not found")
             return jsonify({"error": "OpenAPI specification file not found"}), 404
     except Exception as e:
-        logger.error(f"Error serving OpenAPI specification: {str(e)}")
+        logger.error("Error serving OpenAPI specification: %s", e)
         return jsonify({"error": f"Error serving OpenAPI specification: {str(e)}"}), 500
 
-@app.route('/convert', methods=['POST'])
-@auth_required
-def convert():
-    logger.info("Convert endpoint called")
-    
-    # Get JSON data from request
-    data = request.get_json()
-    logger.debug(f"Request data: {data}")
+# Placeholder document converted when a request has no markdown content
+EMPTY_INPUT_MARKDOWN = "# No Input Given\n\nNo markdown content was provided for conversion."
+
+# Markdown reader extensions used for every conversion
+PANDOC_READER_FORMAT = 'markdown+smart+autolink_bare_uris+inline_notes+pipe_tables+line_blocks+escaped_line_breaks+hard_line_breaks+raw_html+native_divs+native_spans'
+
+# Conversion profiles (reader extensions, TOC, stylesheet, template, default
+# metadata) are compiled from PROFILES_FILE at startup; the EPUB_* variables
+# are the metadata defaults of every profile
+PROFILES_FILE = os.environ.get('PROFILES_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles.yaml'))
+
+profiles = load_profiles(PROFILES_FILE, PANDOC_READER_FORMAT, {
+    'date': os.environ.get('EPUB_DATE', ''),
+    'language': os.environ.get('EPUB_LANGUAGE', 'en-US'),
+    'rights': os.environ.get('EPUB_RIGHTS', ''),
+    'publisher': os.environ.get('EPUB_PUBLISHER', '')
+})
+
+
+class ConversionError(Exception):
+    """Raised when a step of the conversion pipeline fails."""
+
+    def __init__(self, message, status_code=500, retry_after=None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        # Seconds after which an overloaded server suggests retrying
+        self.retry_after = retry_after
+
+
+def error_response(e):
+    """JSON error response for a ConversionError, with Retry-After when it has one."""
+    response = jsonify({"error": e.message})
+    response.status_code = e.status_code
+    if e.retry_after is not None:
+        response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+def parse_conversion_request(data):
+    """
+    Validate a conversion request body and apply defaults.
     
+    Returns (markdown_content, title, author, profile). Raises ConversionError
+    if the required markdown field is missing or the profile is unknown.
+    """
     # Validate required markdown field
     if not data or 'markdown' not in data:
         logger.error("Missing required field: markdown")
-        return jsonify({"error": "Missing required field: markdown"}), 400
+        raise ConversionError("Missing required field: markdown", 400)
     
     markdown_content = data['markdown']
     
     # Check if markdown_content is empty, None, or invalid
     if markdown_content is None or not isinstance(markdown_content, str) or not markdown_content.strip():
         logger.warning("Empty or invalid markdown content provided, using default message")
-        markdown_content = "# No Input Given\n\nNo markdown content was provided for conversion."
+        markdown_content = EMPTY_INPUT_MARKDOWN
     
     # Get title and author with validation
     title = data.get('title', 'Untitled')
@@ -121,230 +631,1668 @@ def convert():
         logger.warning("Invalid or missing author, using default")
         author = 'Unknown Author'
     
-    logger.info(f"Processing conversion request - Title: '{title}', Author: '{author}'")
-    logger.debug(f"Markdown content length: {len(markdown_content)} characters")
+    return markdown_content, title, author, request_profile(data.get('profile'))
+
+
+def request_profile(name):
+    """The conversion profile a request selected by name, the default one for None."""
+    if name is None:
+        return profiles[DEFAULT_PROFILE]
+    profile = profiles.get(name) if isinstance(name, str) else None
+    if profile is None:
+        logger.warning("Unknown conversion profile: %r", name)
+        raise ConversionError(f"Unknown profile: {name} (available: {', '.join(profiles)})", 400)
+    return profile
+
+
+def build_metadata(title, author, profile=None):
+    """Resolve the EPUB metadata for a conversion from the request and its profile."""
+    return (profile or profiles[DEFAULT_PROFILE]).build_metadata(title, author)
+
+
+def build_pandoc_options(title, author, profile=None):
+    """Return the pandoc options that follow the input and output paths."""
+    return (profile or profiles[DEFAULT_PROFILE]).pandoc_options(title, author)
+
+
+def write_metadata_file(metadata_path, metadata, profile=None):
+    """Write the metadata block pandoc reads via --metadata-file."""
+    try:
+        # The profile has its defaults compiled to YAML; only title and author are dumped here
+        document = (profile or profiles[DEFAULT_PROFILE]).metadata_document(metadata)
+        with open(metadata_path, 'w', encoding='utf-8') as f:
+            f.write(document)
+        logger.debug("Created metadata file at %s", metadata_path)
+    except Exception as yaml_error:
+        logger.error("Error creating YAML metadata: %s", yaml_error)
+        # Fallback to simple metadata handling with manual escaping
+        logger.warning("Falling back to basic metadata handling")
+        with open(metadata_path, 'w', encoding='utf-8') as f:
+            f.write('---\n')
+            for key, value in metadata.items():
+                # Escape any quotes in the values
+                safe_value = str(value).replace('"', '\\"')
+                f.write(f'{key}: "{safe_value}"\n')
+            f.write('---\n')
+        logger.debug("Created basic metadata file at %s", metadata_path)
+
+
+def write_output(output, data):
+    """Write EPUB bytes to the output path or in-memory buffer of a conversion."""
+    if isinstance(output, str):
+        with open(output, 'wb') as f:
+            f.write(data)
+    else:
+        output.write(data)
+
+
+def output_size(output):
+    """Size in bytes of a conversion's output file or buffer, or None if no file was created."""
+    if isinstance(output, str):
+        return os.path.getsize(output) if os.path.exists(output) else None
+    return output.getbuffer().nbytes
+
+
+def run_native(normalized_content, metadata, output, profile=None):
+    """
+    Convert simple markdown in-process with the native engine and write the EPUB to output.
+    
+    Returns False when the engine is disabled or the document uses markdown or
+    profile settings it does not support, so the caller can fall back to pandoc.
+    """
+    profile = profile or profiles[DEFAULT_PROFILE]
+    if NATIVE_ENGINE != 'auto' or not profile.native:
+        return False
+    
+    with timed_stage('native'):
+        try:
+            chapters = render_chapters(normalized_content, metadata.get('title', 'Untitled'))
+        except NativeUnsupported as e:
+            logger.info("Native engine cannot convert this document, using pandoc: %s", e)
+            return False
+        if not chapters:
+            return False
+        
+        write_epub(output, metadata, chapters, toc_depth=profile.toc_depth)
+    logger.info("Converted with native engine (%s chapters)", len(chapters))
+    return True
+
+
+def run_pandoc_server(normalized_content, metadata, pandoc_options, output):
+    """
+    Convert on a warm pandoc server from the pool and write the result to output.
+    
+    Returns False when the pool is disabled or fails, so the caller can fall back
+    to the one-shot subprocess path.
+    """
+    if pandoc_pool is None or not pandoc_pool.available:
+        return False
     
     try:
-        # Create temporary directory for processing
-        with tempfile.TemporaryDirectory() as temp_dir:
-            logger.debug(f"Created temporary directory: {temp_dir}")
-            
-            # Create input markdown file
-            # Ensure proper line breaks by normalizing newlines and adding extra newlines for headers
-            normalized_content = markdown_content.replace('\r\n', '\n').replace('\r', '\n')
-            
-            # Ensure double newlines are preserved and properly interpreted
-            # Replace literal "\n\n" with actual double newlines
-            normalized_content = normalized_content.replace('\\n\\n', '\n\n')
-            
-            # Add extra newlines before headers to ensure proper separation
-            import re
-            normalized_content = re.sub(r'(\n)#', r'\n\n#', normalized_content)
-            normalized_content = re.sub(r'(\n)(\*|\-|\+)(\s)', r'\n\n\2\3', normalized_content)
-            
-            # Ensure paragraphs are properly separated
-            normalized_content = re.sub(r'\n\n+', '\n\n', normalized_content)
-            
-            input_path = os.path.join(temp_dir, 'input.md')
+        with pandoc_slot(), timed_stage('pandoc'):
+            epub = pool_convert(['--standalone'] + pandoc_options, normalized_content, metadata)
+    except PandocPoolError as e:
+        logger.warning("pandoc server engine unavailable, falling back to subprocess: %s", e)
+        return False
+    
+    write_output(output, epub)
+    logger.info("Converted with pandoc server engine (%s bytes)", len(epub))
+    return True
+
+
+def subprocess_command(input_path, metadata_path, output_path, pandoc_options):
+    """The pandoc command line converting input_path to output_path with a metadata file."""
+    # Build pandoc command with metadata file and explicit EPUB format
+    return [
+        'pandoc',
+        '--standalone',
+        '--metadata-file=' + metadata_path,
+        input_path,
+        '-o', output_path,
+    ] + pandoc_options
+
+
+def pipe_command(metadata, pandoc_options):
+    """
+    The pandoc command line converting stdin to an EPUB on stdout.
+    
+    The metadata is passed on the command line like the pandoc server engine does.
+    """
+    # --metadata values in the options (title, author) override the resolved metadata
+    overridden = {value.split('=', 1)[0] for option, value in zip(pandoc_options, pandoc_options[1:]) if option == '--metadata'}
+    cmd = ['pandoc', '--standalone']
+    for key, value in metadata.items():
+        if key not in overridden:
+            cmd += ['--metadata', f'{key}={value}']
+    return cmd + pandoc_options + ['-o', '-']
+
+
+def check_pandoc_exit(returncode, stderr, stdout=None):
+    """Count and log a finished pandoc process. Raises ConversionError if it failed."""
+    metrics.inc('epub_pandoc_exits_total', code=str(returncode))
+    check_pandoc_limits(returncode, stderr)
+    
+    # Log pandoc output
+    if stdout is not None:
+        logger.debug("Pandoc stdout: %s", clip(stdout))
+    logger.debug("Pandoc stderr: %s", clip(stderr))
+    logger.debug("Pandoc return code: %s", returncode)
+    
+    # Check if conversion was successful
+    if returncode != 0:
+        logger.error("Pandoc conversion failed with return code %s", returncode)
+        logger.error("Pandoc error: %s", clip(stderr))
+        raise ConversionError(f"Conversion failed: {stderr}")
+
+
+def run_pandoc_subprocess(input_path, metadata, pandoc_options, output_path, temp_dir, profile=None):
+    """Convert with a one-shot pandoc process. Raises ConversionError on failure."""
+    # Create metadata file for better control using PyYAML for proper escaping
+    metadata_path = os.path.join(temp_dir, 'metadata.yaml')
+    with timed_stage('metadata'):
+        write_metadata_file(metadata_path, metadata, profile)
+    
+    cmd = subprocess_command(input_path, metadata_path, output_path, pandoc_options)
+    logger.info("Executing pandoc command: %s", ' '.join(cmd))
+    
+    # Execute pandoc command
+    with pandoc_slot(), timed_stage('pandoc'):
+        result = run_limited(cmd, text=True)
+    check_pandoc_exit(result.returncode, result.stderr, result.stdout)
+
+
+def run_pandoc_pipe(normalized_content, metadata, pandoc_options, output):
+    """
+    Convert with a one-shot pandoc process over stdin and stdout, without files.
+    
+    The EPUB is written to output. Raises ConversionError on failure.
+    """
+    cmd = pipe_command(metadata, pandoc_options)
+    logger.info("Executing pandoc command: %s", ' '.join(cmd))
+    
+    with pandoc_slot(), timed_stage('pandoc'):
+        result = run_limited(cmd, input=normalized_content.encode('utf-8'))
+    check_pandoc_exit(result.returncode, result.stderr.decode('utf-8', errors='replace'))
+    write_output(output, result.stdout)
+
+
+def render_fragment(normalized_content, reader_format=PANDOC_READER_FORMAT, options=(), slot=pandoc_slot):
+    """
+    Convert normalized markdown to an XHTML body fragment with pandoc.
+    
+    options are added to the pandoc arguments and slot (pandoc_slot or
+    preview_slot) is held while pandoc runs. Uses the pandoc server pool when
+    available and a one-shot process otherwise. Raises ConversionError on failure.
+    """
+    args = ['-f', reader_format, '-t', 'html5', '--wrap=none'] + list(options)
+    if pandoc_pool is not None and pandoc_pool.available:
+        try:
+            with slot():
+                return pool_convert(args, normalized_content, {}).decode('utf-8')
+        except PandocPoolError as e:
+            logger.warning("pandoc server engine unavailable, falling back to subprocess: %s", e)
+    
+    with slot(), timed_stage('pandoc'):
+        result = run_limited(['pandoc'] + args, input=normalized_content, text=True)
+    metrics.inc('epub_pandoc_exits_total', code=str(result.returncode))
+    check_pandoc_limits(result.returncode, result.stderr)
+    if result.returncode != 0:
+        logger.error("Pandoc fragment conversion failed with return code %s: %s", result.returncode, clip(result.stderr))
+        raise ConversionError(f"Conversion failed: {result.stderr}")
+    return result.stdout
+
+
+def parallel_candidate(size, profile, images=None):
+    """Whether a document of size bytes may be converted in parallel parts (see run_parallel)."""
+    return PARALLEL_CONVERSION == 'auto' and not images and profile.chunked and size >= PARALLEL_MIN_KB * 1024
+
+
+def run_parallel(normalized_content, metadata, output, profile):
+    """
+    Convert a large document in parts on several pandoc processes and write the EPUB to output.
+    
+    The markdown is split at level-1 headings into up to PARALLEL_WORKERS parts
+    of similar size, which are converted to XHTML at the same time and merged
+    into one book with continuous footnote numbers, working cross-references
+    and a table of contents over all parts. Returns False when the document is
+    too small, has images or fewer than two level-1 headings, so the caller can
+    convert it in one piece. Raises ConversionError when a part fails.
+    """
+    size = len(normalized_content.encode('utf-8'))
+    if not parallel_candidate(size, profile) or has_images(normalized_content):
+        return False
+    with timed_stage('split'):
+        # make_chunks measures in characters, the threshold above is in bytes
+        chunks = make_chunks(normalized_content, -(-len(normalized_content) // PARALLEL_WORKERS))
+    if len(chunks) < 2:
+        return False
+    
+    # Notes go to the end of each section, i.e. of the chapter that references them
+    options = ['--preserve-tabs', '--reference-location=section']
+    futures = [chunk_executor.submit(contextvars.copy_context().run, render_fragment, chunk, profile.reader_format, options)
+               for chunk in chunks]
+    try:
+        fragments = [future.result() for future in futures]
+    finally:
+        for future in futures:
+            future.cancel()
+    
+    with timed_stage('merge'):
+        chapters = merge_fragments(fragments, metadata.get('title', 'Untitled'))
+        write_epub(output, metadata, chapters, toc_depth=profile.toc_depth, stylesheet=profile.stylesheet)
+    logger.info("Converted in %s parallel parts (%s chapters)", len(chunks), len(chapters))
+    return True
+
+
+def verify_epub(output_path, title, author):
+    """Check the generated EPUB according to EPUB_VERIFY_MODE. Raises ConversionError if invalid."""
+    if EPUB_VERIFY_MODE == 'off':
+        return
+    
+    logger.info("Verifying EPUB file (%s mode)", EPUB_VERIFY_MODE)
+    try:
+        with timed_stage('verify'):
+            report = inspect_epub(output_path, EPUB_VERIFY_MODE, expected_title=title, expected_author=author)
+    except zipfile.BadZipFile as e:
+        logger.error("EPUB file is not a valid ZIP archive: %s", e)
+        raise ConversionError(f"Generated EPUB is corrupted: {str(e)}")
+    for stage, seconds in report.timings.items():
+        record_stage(stage, seconds)
+    
+    for warning in report.warnings:
+        logger.warning(warning)
+    if not report.ok:
+        logger.error("EPUB verification failed: %s", '; '.join(report.errors))
+        raise ConversionError(f"Generated EPUB is invalid: {'; '.join(report.errors)}")
+    
+    file_list = report.files
+    logger.info("EPUB contains %s files: %s%s", len(file_list), ', '.join(file_list[:5]), '...' if len(file_list) > 5 else '')
+
+
+def compress_epub(output_path, temp_dir, title, author):
+    """
+    Recompress the verified EPUB at output_path according to EPUB_COMPRESSION.
+    
+    The container is rewritten to a new file that then replaces output_path.
+    Except in 'fast' mode, the original is kept when the rewrite is not
+    smaller. Returns the recompression stats, or None when disabled.
+    """
+    if EPUB_COMPRESSION == 'off':
+        return None
+    
+    compressed_path = os.path.join(temp_dir, 'output.recompressed.epub')
+    try:
+        with timed_stage('compress'):
+            stats = recompress_epub(output_path, compressed_path, EPUB_COMPRESSION)
+    except (zipfile.BadZipFile, KeyError, UnicodeDecodeError) as e:
+        logger.warning("EPUB recompression failed, keeping pandoc output: %s", e)
+        return None
+    
+    if EPUB_COMPRESSION != 'fast' and stats['compressed_size'] >= stats['original_size']:
+        logger.info("Recompressed EPUB is not smaller (%s bytes), keeping original", stats['compressed_size'])
+        os.remove(compressed_path)
+        stats['compressed_size'] = stats['original_size']
+        return stats
+    
+    if EPUB_COMPRESSION == 'smallest':
+        # Minification and deduplication rewrite documents; check the result again
+        try:
+            verify_epub(compressed_path, title, author)
+        except ConversionError as e:
+            logger.warning("Recompressed EPUB failed verification, keeping original: %s", e.message)
+            os.remove(compressed_path)
+            return None
+    os.replace(compressed_path, output_path)
+    logger.info("Recompressed EPUB (%s): %s -> %s bytes", EPUB_COMPRESSION, stats['original_size'], stats['compressed_size'])
+    return stats
+
+
+def convert_to_epub(normalized_content, metadata, pandoc_options, temp_dir, progress=None, images=None, profile=None):
+    """
+    Convert the normalized markdown inside temp_dir and verify the result.
+    
+    normalized_content may be None when temp_dir/input.md already holds the
+    normalized markdown (streamed uploads); it is then only read into memory
+    for the engines that need it. With temp_dir None (see converts_in_memory)
+    the conversion runs without files and the EPUB is kept in a BytesIO.
+    
+    The engines are tried in this order, each only where it applies:
+    
+    1. the native engine (NATIVE_ENGINE=auto, simple markdown);
+    2. parallel conversion in parts (documents of PARALLEL_MIN_KB or more);
+    3. the pandoc server pool (PANDOC_ENGINE=server);
+    4. a one-shot pandoc process, over pipes or through temp_dir.
+    
+    Conversions with images (from store_images) and profiles the faster
+    engines do not support always use the one-shot process, which reads the
+    images from temp_dir.
+    
+    progress, if given, is called with a stage name and a percentage as the
+    conversion advances. Returns the path of the generated EPUB file (or the
+    BytesIO) and a dict with the name of the 'engine' that produced it and
+    the 'compression' stats (None when recompression is off). Raises
+    ConversionError on failure.
+    """
+    if progress is None:
+        progress = lambda stage, percent: None
+    
+    if temp_dir is None:
+        output = io.BytesIO()
+        input_path = input_written = None
+    else:
+        output = os.path.join(temp_dir, 'output.epub')
+        logger.debug("Output path set to %s", output)
+        input_path = os.path.join(temp_dir, 'input.md')
+        input_written = normalized_content is None
+        pandoc_options = link_conversion_images(images, temp_dir, pandoc_options)
+    profile = profile or profiles[DEFAULT_PROFILE]
+    native = not images and profile.native and NATIVE_ENGINE == 'auto'
+    server = not images and profile.pandoc_server and pandoc_pool is not None and pandoc_pool.available
+    if input_written:
+        parallel = parallel_candidate(os.path.getsize(input_path), profile, images)
+    else:
+        parallel = (normalized_content is not None
+                    and parallel_candidate(len(normalized_content.encode('utf-8')), profile, images))
+    if input_written and (native or server or parallel):
+        with open(input_path, 'r', encoding='utf-8') as f:
+            normalized_content = f.read()
+    
+    progress('converting', 20)
+    if normalized_content is not None and native and run_native(normalized_content, metadata, output, profile):
+        engine = 'native'
+    elif normalized_content is not None and parallel and run_parallel(normalized_content, metadata, output, profile):
+        engine = 'pandoc-parallel'
+    elif normalized_content is not None and server and run_pandoc_server(normalized_content, metadata, pandoc_options, output):
+        engine = 'pandoc-server'
+    elif temp_dir is None:
+        run_pandoc_pipe(normalized_content, metadata, pandoc_options, output)
+        engine = 'pandoc'
+    else:
+        if not input_written:
             with open(input_path, 'w', encoding='utf-8') as f:
                 f.write(normalized_content)
+        
+        # Verify input file was created correctly
+        if not os.path.exists(input_path):
+            logger.error("Failed to create input file at %s", input_path)
+            raise ConversionError("Failed to create input file")
             
-            # Verify input file was created correctly
-            if not os.path.exists(input_path):
-                logger.error(f"Failed to create input file at {input_path}")
-                return jsonify({"error": "Failed to create input file"}), 500
-                
-            input_size = os.path.getsize(input_path)
-            logger.debug(f"Input file created at {input_path} with size {input_size} bytes")
-            
-            # Set output path for EPUB file
-            output_path = os.path.join(temp_dir, 'output.epub')
-            logger.debug(f"Output path set to {output_path}")
-            
-            # Create metadata file for better control using PyYAML for proper escaping
-            import yaml
-            metadata_path = os.path.join(temp_dir, 'metadata.yaml')
-            
-            # Prepare metadata as a dictionary
-            metadata = {
-                'title': title,
-                'author': author,
-                'date': os.environ.get('EPUB_DATE', ''),
-                'language': os.environ.get('EPUB_LANGUAGE', 'en-US'),
-                'rights': os.environ.get('EPUB_RIGHTS', ''),
-                'publisher': os.environ.get('EPUB_PUBLISHER', '')
-            }
-            
-            # Filter out empty values
-            metadata = {k: v for k, v in metadata.items() if v}
-            
+        input_size = os.path.getsize(input_path)
+        logger.debug("Input file created at %s with size %s bytes", input_path, input_size)
+        
+        run_pandoc_subprocess(input_path, metadata, pandoc_options, output, temp_dir, profile)
+        engine = 'pandoc'
+    
+    return finish_conversion(output, engine, metadata, temp_dir, progress)
+
+
+def finish_conversion(output, engine, metadata, temp_dir, progress):
+    """Check, verify and recompress the output of an engine; the second half of convert_to_epub."""
+    title = metadata.get('title', '')
+    author = metadata.get('author', '')
+    
+    # Verify output file exists and has content
+    size = output_size(output)
+    if size is None:
+        logger.error("Output file not found at %s", output)
+        raise ConversionError("Output file not created by pandoc")
+    logger.info("Output created with size %s bytes", size)
+    
+    if size == 0:
+        logger.error("Output file has zero bytes")
+        raise ConversionError("Generated EPUB file is empty")
+        
+    # Verify metadata and container structure in-process
+    progress('verifying', 80)
+    verify_epub(output, title, author)
+    
+    progress('compressing', 90)
+    compression = compress_epub(output, temp_dir, title, author) if temp_dir is not None else None
+    
+    metrics.inc('epub_conversions_total', engine=engine)
+    metrics.observe('epub_output_bytes', compression['compressed_size'] if compression else size)
+    return output, {'engine': engine, 'compression': compression}
+
+
+def converts_in_memory(normalized_content, images=None):
+    """
+    Whether convert_to_epub can run without a work directory for this markdown.
+    
+    True with PANDOC_IO=pipe for inputs of up to PANDOC_PIPE_MAX_KB, unless
+    recompression is on (it rewrites the container through files) or the
+    conversion has images (pandoc reads them from files).
+    """
+    return (PANDOC_IO == 'pipe' and EPUB_COMPRESSION == 'off' and not images
+            and len(normalized_content.encode('utf-8')) <= PANDOC_PIPE_MAX_KB * 1024)
+
+
+def request_images(data):
+    """The images of a JSON conversion request: its 'images' object of names to base64 data."""
+    images = data.get('images')
+    if images is None:
+        return {}
+    if not isinstance(images, dict):
+        raise ConversionError("'images' must be an object mapping image names to base64 data", 400)
+    try:
+        return {name: decode_base64_image(name, value) for name, value in images.items()}
+    except InvalidImage as e:
+        raise ConversionError(str(e), 400)
+
+
+def uploaded_images():
+    """The images of a multipart conversion request: its 'images' file parts, named by filename."""
+    return {upload.filename or '': upload.read() for upload in request.files.getlist('images')}
+
+
+def store_images(images):
+    """
+    Put the images of a conversion request into the asset store.
+    
+    images maps the names used in the markdown to their bytes. Returns a dict
+    of those names to the stored files, or None when there are no images.
+    Raises ConversionError for images that cannot be embedded.
+    """
+    if not images:
+        return None
+    stored = {}
+    with timed_stage('images'):
+        for name, data in images.items():
             try:
-                # Write metadata using PyYAML for proper YAML formatting
-                with open(metadata_path, 'w', encoding='utf-8') as f:
-                    f.write('---\n')
-                    yaml.dump(metadata, f, default_flow_style=False, allow_unicode=True, sort_keys=False)
-                    f.write('---\n')
-                logger.debug(f"Created metadata file at {metadata_path}")
-            except Exception as yaml_error:
-                logger.error(f"Error creating YAML metadata: {str(yaml_error)}")
-                # Fallback to simple metadata handling with manual escaping
-                logger.warning("Falling back to basic metadata handling")
-                with open(metadata_path, 'w', encoding='utf-8') as f:
-                    # Escape any quotes in the values
-                    safe_title = title.replace('"', '\\"') if title else ""
-                    safe_author = author.replace('"', '\\"') if author else ""
-                    
-                    f.write('---\n')
-                    f.write(f'title: "{safe_title}"\n')
-                    f.write(f'author: "{safe_author}"\n')
-                    if os.environ.get('EPUB_DATE', ''):
-                        f.write(f'date: "{os.environ.get("EPUB_DATE", "")}"\n')
-                    f.write(f'language: "{os.environ.get("EPUB_LANGUAGE", "en-US")}"\n')
-                    if os.environ.get('EPUB_RIGHTS', ''):
-                        f.write(f'rights: "{os.environ.get("EPUB_RIGHTS", "")}"\n')
-                    if os.environ.get('EPUB_PUBLISHER', ''):
-                        f.write(f'publisher: "{os.environ.get("EPUB_PUBLISHER", "")}"\n')
-                    f.write('---\n')
-                logger.debug(f"Created basic metadata file at {metadata_path}")
-            
-            # Build pandoc command with metadata file and explicit EPUB format
-            cmd = [
-                'pandoc',
-                '--standalone',
-                '--metadata-file=' + metadata_path,
-                input_path,
-                '-o', output_path,
-                # Explicitly specify EPUB format
-                '-t', 'epub3',
-                # Add markdown reader option with extensions for proper interpretation
-                '-f', 'markdown+smart+autolink_bare_uris+inline_notes+pipe_tables+line_blocks+escaped_line_breaks+hard_line_breaks+raw_html+native_divs+native_spans',
-                # Add options for better rendering
-                '--toc',  # Add table of contents
-                '--toc-depth=3',  # Include headings up to level 3 in TOC
-                '--wrap=none',  # Don't wrap lines
-                '--preserve-tabs',  # Preserve tabs
-                '--shift-heading-level-by=0',  # Don't shift heading levels
-                # Still include direct metadata for backwards compatibility
-                '--metadata', f'title={title}',
-                '--metadata', f'author={author}'
-            ]
-            logger.info(f"Executing pandoc command: {' '.join(cmd)}")
-            
-            # Execute pandoc command
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            
-            # Log pandoc output
-            logger.debug(f"Pandoc stdout: {result.stdout}")
-            logger.debug(f"Pandoc stderr: {result.stderr}")
-            logger.debug(f"Pandoc return code: {result.returncode}")
+                stored[name] = asset_store.put(name, data)
+            except InvalidImage as e:
+                logger.warning("Rejected image: %s", e)
+                raise ConversionError(str(e), 400)
+    logger.debug("Stored %s images: %s", len(stored), ', '.join(stored))
+    return stored
+
+
+def link_conversion_images(images, temp_dir, pandoc_options):
+    """Link stored images into temp_dir and return the pandoc options that let pandoc find them."""
+    if not images:
+        return pandoc_options
+    resource_dir = os.path.join(temp_dir, 'resources')
+    link_images(images, resource_dir)
+    return pandoc_options + ['--resource-path=' + resource_dir]
+
+
+def conversion_cache_hasher(metadata, pandoc_options, images=None, profile=None):
+    """
+    Result cache key hasher.
+    
+    Native, parallel and recompressed output differ from pandoc's, so those settings
+    are part of it, and so are the stored files (content hashes) of images and
+    the contents of the profile's stylesheet and template.
+    """
+    if NATIVE_ENGINE != 'off':
+        pandoc_options = pandoc_options + [f'native-engine={NATIVE_ENGINE}']
+    if EPUB_COMPRESSION != 'off':
+        pandoc_options = pandoc_options + [f'epub-compression={EPUB_COMPRESSION}']
+    if PARALLEL_CONVERSION != 'off':
+        pandoc_options = pandoc_options + [f'parallel-min-kb={PARALLEL_MIN_KB}']
+    if images:
+        pandoc_options = pandoc_options + [f'image={name}={os.path.basename(path)}' for name, path in sorted(images.items())]
+    if profile is not None and profile.files_digest is not None:
+        pandoc_options = pandoc_options + [f'profile-files={profile.files_digest}']
+    return cache_key_hasher(metadata, pandoc_options)
+
+
+def conversion_cache_key(normalized_content, metadata, pandoc_options, images=None, profile=None):
+    """Result cache key of a conversion of in-memory markdown."""
+    hasher = conversion_cache_hasher(metadata, pandoc_options, images, profile)
+    hasher.update(normalized_content.encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def remove_temp_dir(temp_dir):
+    """Delete a conversion's temporary directory, ignoring errors."""
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    logger.debug("Removed temporary directory: %s", temp_dir)
+
+
+def sweep_handoff_dir(now):
+    """Delete EPUBs handed to the front proxy that are older than SENDFILE_TTL."""
+    try:
+        with os.scandir(SENDFILE_DIR) as it:
+            for entry in it:
+                try:
+                    if now - entry.stat().st_mtime > SENDFILE_TTL:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+    except OSError as e:
+        logger.warning("Could not sweep handoff directory %s: %s", SENDFILE_DIR, e)
+
+
+def handoff_response(output_path):
+    """
+    Move the EPUB into SENDFILE_DIR and let the front proxy send it.
+    
+    The proxy reads the file after this response is complete, so handed-off
+    files are removed by age instead of when the response closes.
+    """
+    now = time.time()
+    sweep_handoff_dir(now)
+    
+    name = f"{uuid.uuid4().hex}.epub"
+    handoff_path = os.path.join(SENDFILE_DIR, name)
+    shutil.move(output_path, handoff_path)
+    
+    response = app.response_class(status=200, mimetype='application/epub+zip')
+    response.headers['Content-Disposition'] = 'attachment; filename=book.epub'
+    if EPUB_DELIVERY == 'x-accel-redirect':
+        response.headers['X-Accel-Redirect'] = X_ACCEL_PREFIX.rstrip('/') + '/' + name
+    else:
+        response.headers['X-Sendfile'] = handoff_path
+    return response
+
+
+class TempDirFile(io.FileIO):
+    """
+    Read-only file that removes its conversion's temporary directory when closed.
+    
+    The WSGI server closes the response file after the last byte is sent, which
+    also works for send_file responses where Response.call_on_close does not run.
+    """
+    
+    def __init__(self, path, temp_dir):
+        super().__init__(path, 'rb')
+        self.temp_dir = temp_dir
+        self.opened = time.perf_counter()
+    
+    def close(self):
+        try:
+            super().close()
+        finally:
+            if self.temp_dir is not None:
+                remove_temp_dir(self.temp_dir)
+                self.temp_dir = None
+                # Sending ends after the request's metrics were published
+                metrics.observe('epub_stage_duration_seconds', time.perf_counter() - self.opened, stage='send')
+                metrics.flush()
+
+
+def epub_response(source, cache_status=None, temp_dir=None, etag=None, delivery='body'):
+    """
+    Build the attachment response for an EPUB file path or binary file object.
+    
+    The file is streamed (via wsgi.file_wrapper where the server provides it)
+    rather than read into memory. temp_dir is removed once the response has
+    been sent. With an etag, clients may keep the EPUB and revalidate it with
+    If-None-Match; without one they are told not to store it. With delivery
+    'url' the EPUB goes to the result store instead (see download_url_response).
+    """
+    if delivery == 'url':
+        response = download_url_response(source, temp_dir)
+        etag = None
+    elif isinstance(source, str) and EPUB_DELIVERY != 'stream':
+        response = handoff_response(source)
+        if temp_dir is not None:
+            remove_temp_dir(temp_dir)
+    else:
+        if isinstance(source, str):
+            source = TempDirFile(source, temp_dir)
+        if isinstance(source, io.BytesIO):
+            size = source.getbuffer().nbytes
+        else:
+            size = os.fstat(source.fileno()).st_size
+        response = send_file(
+            source,
+            mimetype='application/epub+zip',
+            as_attachment=True,
+            download_name='book.epub',
+            etag=False
+        )
+        response.content_length = size
+    
+    if etag is not None:
+        set_conversion_etag(response, etag)
+    else:
+        # Add headers to prevent caching issues
+        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '0'
+    if cache_status is not None:
+        response.headers['X-Cache'] = cache_status
+    
+    return response
+
+
+def request_delivery():
+    """How a /convert request wants its EPUB (see DELIVERY_MODES). Raises ConversionError for unknown modes."""
+    delivery = request.args.get('delivery', 'body')
+    if delivery not in DELIVERY_MODES:
+        raise ConversionError(f"Unknown delivery: {delivery} (available: {', '.join(DELIVERY_MODES)})", 400)
+    return delivery
+
+
+def download_url_response(source, temp_dir=None):
+    """
+    Put an EPUB path or binary file object into the result store and answer with its download URL.
+    
+    File objects are closed and temp_dir is removed once the EPUB is stored.
+    """
+    try:
+        with timed_stage('store'):
+            result = result_store.put(source, 'book.epub', 'application/epub+zip')
+    finally:
+        if not isinstance(source, str):
+            source.close()
+        if temp_dir is not None:
+            remove_temp_dir(temp_dir)
+    
+    url = result_store.download_url(result) or url_for('download_result', result_id=result.result_id, _external=True)
+    logger.info("Stored EPUB for download as result %s (%s bytes)", result.result_id, result.size)
+    response = jsonify({
+        "result_id": result.result_id,
+        "url": url,
+        "size": result.size,
+        "expires_at": result.expires_at
+    })
+    response.status_code = 201
+    response.headers['Location'] = url
+    return response
+
+
+def set_conversion_etag(response, key):
+    """Mark a /convert response with the ETag of its conversion key; it may be stored but must be revalidated."""
+    response.set_etag(key)
+    response.headers['Cache-Control'] = 'private, no-cache'
+
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    """Endpoint reporting the result cache counters of the answering worker."""
+    logger.info("Cache stats endpoint called")
+    if result_cache is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify({"enabled": True, **result_cache.stats()}), 200
+
+@app.route('/profiles', methods=['GET'])
+def list_profiles():
+    """Endpoint listing the conversion profiles requests can select."""
+    return jsonify({"default": DEFAULT_PROFILE, "profiles": [profile.describe() for profile in profiles.values()]}), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Endpoint exposing the pipeline metrics of all workers in Prometheus text format."""
+    return app.response_class(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+MARKDOWN_MIMETYPES = ('text/markdown', 'text/x-markdown', 'text/plain')
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def open_markdown_upload():
+    """
+    Return (title, author, profile, stream, charset) for a raw markdown or multipart /convert request.
+    
+    Raw markdown bodies take the title, author and profile from the query
+    string, multipart uploads from the form fields sent next to the 'file'
+    part. Raises ConversionError if the upload is missing or the profile unknown.
+    """
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get('file') or request.files.get('markdown')
+        if upload is None:
+            logger.error("Missing required file field: file")
+            raise ConversionError("Missing required file field: file", 400)
+        fields = request.form
+        stream, charset = upload.stream, upload.mimetype_params.get('charset', 'utf-8')
+    else:
+        fields = request.args
+        stream, charset = request.stream, request.mimetype_params.get('charset', 'utf-8')
+    
+    title = fields.get('title') or 'Untitled'
+    author = fields.get('author') or 'Unknown Author'
+    return title, author, request_profile(fields.get('profile')), stream, charset
+
+
+def ingest_markdown_stream(stream, charset, input_path, metadata, pandoc_options, images=None, profile=None):
+    """
+    Decode, normalize and write a markdown body to input_path chunk by chunk.
+    
+    Returns the conversion key of the document (see conversion_cache_key),
+    computed from the same chunks. Empty input is replaced by the
+    placeholder document used for JSON requests. Raises ConversionError for
+    unknown charsets and undecodable input.
+    """
+    try:
+        decoder = codecs.getincrementaldecoder(charset)()
+    except LookupError:
+        raise ConversionError(f"Unsupported charset: {charset}", 415)
+    
+    normalizer = MarkdownNormalizer()
+    hasher = conversion_cache_hasher(metadata, pandoc_options, images, profile)
+    has_content = False
+    size = 0
+    with open(input_path, 'w', encoding='utf-8') as f:
+        def write(text):
+            nonlocal has_content
+            if text:
+                f.write(text)
+                hasher.update(text.encode('utf-8'))
+                has_content = has_content or not text.isspace()
+        
+        # Reading the body is part of this stage; normalization runs as it arrives
+        with timed_stage('normalize'):
+            try:
+                while True:
+                    chunk = stream.read(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    write(normalizer.feed(decoder.decode(chunk)))
+                write(normalizer.feed(decoder.decode(b'', final=True)))
+            except UnicodeDecodeError:
+                raise ConversionError(f"Request body is not valid {charset}", 400)
+            write(normalizer.close())
+    logger.debug("Streamed %s bytes of markdown to %s", size, input_path)
+    metrics.observe('epub_input_bytes', size)
+    
+    if not has_content:
+        logger.warning("Empty markdown content provided, using default message")
+        normalized_content = normalize_markdown(EMPTY_INPUT_MARKDOWN)
+        with open(input_path, 'w', encoding='utf-8') as f:
+            f.write(normalized_content)
+        return conversion_cache_key(normalized_content, metadata, pandoc_options, images, profile)
+    
+    return hasher.hexdigest()
+
+
+@app.route('/convert', methods=['POST'])
+@auth_required
+def convert():
+    logger.info("Convert endpoint called")
+    
+    # Temporary directory for processing, created unless the conversion runs in
+    # memory; it is removed after the response has been sent so the EPUB can be
+    # streamed from disk
+    temp_dir = None
+    
+    try:
+        try:
+            # Decompress and size-limit the body while it is read
+            install_body_stream(request.environ, MAX_INPUT_BYTES)
+            request_delivery()
             
-            # Check if conversion was successful
-            if result.returncode != 0:
-                logger.error(f"Pandoc conversion failed with return code {result.returncode}")
-                logger.error(f"Pandoc error: {result.stderr}")
-                return jsonify({"error": f"Conversion failed: {result.stderr}"}), 500
-                
-            # Verify output file exists and has content
-            if not os.path.exists(output_path):
-                logger.error(f"Output file not found at {output_path}")
-                return jsonify({"error": "Output file not created by pandoc"}), 500
-                
-            output_size = os.path.getsize(output_path)
-            logger.info(f"Output file created at {output_path} with size {output_size} bytes")
+            if request.mimetype in MARKDOWN_MIMETYPES or request.mimetype == 'multipart/form-data':
+                # Raw and uploaded markdown is normalized straight into the work file
+                title, author, profile, stream, charset = open_markdown_upload()
+                metadata = build_metadata(title, author, profile)
+                pandoc_options = build_pandoc_options(title, author, profile)
+                images = store_images(uploaded_images()) if request.mimetype == 'multipart/form-data' else None
+                normalized_content = None
+                temp_dir = tempfile.mkdtemp()
+                key = ingest_markdown_stream(stream, charset, os.path.join(temp_dir, 'input.md'), metadata, pandoc_options,
+                                             images, profile)
+            else:
+                title, author, profile, metadata, pandoc_options, normalized_content, images, key = read_json_conversion()
+                if not converts_in_memory(normalized_content, images):
+                    temp_dir = tempfile.mkdtemp()
+            if temp_dir is not None:
+                logger.debug("Created temporary directory: %s", temp_dir)
             
-            if output_size == 0:
-                logger.error("Output file has zero bytes")
-                return jsonify({"error": "Generated EPUB file is empty"}), 500
-                
-            # Verify metadata was included (basic check)
-            logger.info("Verifying metadata in EPUB file")
-            verify_cmd = [
-                'pandoc',
-                '--standalone',
-                output_path,
-                '-t', 'plain',
-                '--no-highlight'
-            ]
-            try:
-                verify_result = subprocess.run(verify_cmd, capture_output=True, text=True)
-                if verify_result.returncode == 0:
-                    content = verify_result.stdout.lower()
-                    if title.lower() in content:
-                        logger.info("Title verified in EPUB content")
-                    else:
-                        logger.warning(f"Title '{title}' not found in EPUB content")
-                    
-                    if author.lower() in content:
-                        logger.info("Author verified in EPUB content")
-                    else:
-                        logger.warning(f"Author '{author}' not found in EPUB content")
-                else:
-                    logger.warning("Could not verify metadata in EPUB file")
-            except Exception as e:
-                logger.warning(f"Error verifying metadata: {str(e)}")
+            logger.info("Processing conversion request - Title: '%s', Author: '%s', Profile: %s", title, author, profile.name)
             
-            # Verify the EPUB file is a valid ZIP archive
-            logger.info("Verifying EPUB file integrity")
-            try:
-                import zipfile
-                with zipfile.ZipFile(output_path, 'r') as zip_ref:
-                    # Try to get the list of files to verify the ZIP structure
-                    file_list = zip_ref.namelist()
-                    logger.info(f"EPUB contains {len(file_list)} files: {', '.join(file_list[:5])}{'...' if len(file_list) > 5 else ''}")
-            except zipfile.BadZipFile as e:
-                logger.error(f"EPUB file is not a valid ZIP archive: {str(e)}")
-                return jsonify({"error": f"Generated EPUB is corrupted: {str(e)}"}), 500
-            except Exception as e:
-                logger.error(f"Error verifying EPUB ZIP structure: {str(e)}")
-                # Continue anyway, as this is just a verification step
+            # Answer revalidations, retries and repeated conversions without running pandoc
+            response, idempotency_key = stored_conversion_response(key)
+            if response is not None:
+                if temp_dir is not None:
+                    remove_temp_dir(temp_dir)
+                return response
             
-            # Copy the file to a more permanent location to avoid temp file issues
-            permanent_output_path = os.path.join(os.path.dirname(output_path), 'final_output.epub')
             try:
-                import shutil
-                shutil.copy2(output_path, permanent_output_path)
-                logger.info(f"Copied EPUB to {permanent_output_path}")
-                
-                # Double check the copied file
-                if os.path.getsize(permanent_output_path) != os.path.getsize(output_path):
-                    logger.error("File size mismatch after copying")
-                    return jsonify({"error": "File corruption during copying"}), 500
-            except Exception as e:
-                logger.error(f"Error copying EPUB file: {str(e)}")
-                # Continue with the original file if copying fails
-                permanent_output_path = output_path
-            
-            # Return the EPUB file
-            logger.info("Sending EPUB file to client")
+                output, details = convert_to_epub(normalized_content, metadata, pandoc_options, temp_dir, images=images,
+                                                  profile=profile)
+                return conversion_response(output, details, key, temp_dir, idempotency_key)
+            except Exception:
+                release_idempotency_key(idempotency_key)
+                raise
+        except Exception:
+            if temp_dir is not None:
+                remove_temp_dir(temp_dir)
+            raise
+    
+    except HTTPException:
+        # Malformed JSON and unsupported media types keep Flask's responses
+        raise
+    except Exception as e:
+        return conversion_error_response(e)
+
+
+def read_json_conversion():
+    """
+    Read and normalize the JSON body of a /convert request.
+    
+    Returns (title, author, profile, metadata, pandoc_options,
+    normalized_content, images, key), where images are the stored images (see
+    store_images) and key is the conversion key (see conversion_cache_key).
+    """
+    # Get JSON data from request
+    data = request.get_json()
+    metrics.observe('epub_input_bytes', len(request.get_data()))
+    markdown_content, title, author, profile = parse_conversion_request(data)
+    logger.debug("Markdown content length: %s characters", len(markdown_content))
+    metadata = build_metadata(title, author, profile)
+    pandoc_options = build_pandoc_options(title, author, profile)
+    images = store_images(request_images(data))
+    with timed_stage('normalize'):
+        normalized_content = normalize_markdown(markdown_content)
+    key = conversion_cache_key(normalized_content, metadata, pandoc_options, images, profile)
+    return title, author, profile, metadata, pandoc_options, normalized_content, images, key
+
+
+def open_cached_conversion(key):
+    """Open the cached EPUB for a /convert conversion key, or return None on a miss or without a cache."""
+    if result_cache is None:
+        return None
+    cached = result_cache.open(key)
+    metrics.inc('epub_cache_lookups_total', result='miss' if cached is None else 'hit')
+    if cached is not None:
+        logger.info("Serving EPUB from result cache (%s)", key[:12])
+    return cached
+
+
+def stored_conversion_response(key):
+    """
+    Answer a /convert request from what the server already has, if possible.
+    
+    Returns (response, idempotency_key). response is a 304 when If-None-Match
+    names the conversion key (the ETag), the stored response of an earlier
+    request with the same Idempotency-Key, or a result cache hit, and None
+    when the EPUB must be converted. idempotency_key is then the key this
+    request has claimed, which conversion_response() or
+    release_idempotency_key() must settle, or None.
+    Raises ConversionError for Idempotency-Keys that cannot be used.
+    """
+    if request.if_none_match.contains_weak(key):
+        logger.info("EPUB not modified (%s)", key[:12])
+        metrics.inc('epub_replayed_responses_total', kind='not_modified')
+        response = app.response_class(status=304)
+        set_conversion_etag(response, key)
+        return response, None
+    
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key is not None:
+        stored = None
+        try:
+            record = idempotency_store.begin(idempotency_key, key)
+            if record is not None:
+                try:
+                    stored = open(idempotency_store.result_path(idempotency_key), 'rb')
+                except FileNotFoundError:
+                    # Pruned since begin() read the record: convert again under a new claim
+                    logger.warning("Stored response for Idempotency-Key has expired, converting again (%s)", key[:12])
+                    idempotency_store.reclaim(idempotency_key, key)
+        except IdempotencyConflict as e:
+            logger.warning("Rejected Idempotency-Key: %s", e)
+            raise ConversionError(str(e), e.status_code, retry_after=e.retry_after)
+        if stored is not None:
+            logger.info("Replaying stored response for Idempotency-Key (%s)", key[:12])
+            metrics.inc('epub_replayed_responses_total', kind='idempotent')
+            response = epub_response(stored, etag=key, delivery=request_delivery())
+            response.headers.update(record['headers'])
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response, None
+    
+    try:
+        cached = open_cached_conversion(key)
+        if cached is not None and idempotency_key is not None:
+            idempotency_store.complete(idempotency_key, key, cached, {})
+    except Exception:
+        release_idempotency_key(idempotency_key)
+        raise
+    if cached is not None:
+        return epub_response(cached, 'HIT', etag=key, delivery=request_delivery()), None
+    return None, idempotency_key
+
+
+def release_idempotency_key(idempotency_key):
+    """Give up the Idempotency-Key claimed by a conversion that failed, so the client can retry it."""
+    if idempotency_key is not None:
+        idempotency_store.release(idempotency_key)
+
+
+def conversion_response(output, details, key, temp_dir, idempotency_key=None):
+    """Cache a fresh /convert result, keep it for its Idempotency-Key and build its response."""
+    headers = {'X-Conversion-Engine': details['engine']}
+    compression = details['compression']
+    if compression is not None:
+        headers['X-EPUB-Compression'] = EPUB_COMPRESSION
+        headers['X-EPUB-Size-Before'] = str(compression['original_size'])
+        headers['X-EPUB-Size-After'] = str(compression['compressed_size'])
+    
+    if result_cache is not None:
+        with timed_stage('copy'):
+            if temp_dir is None:
+                result_cache.put(key, output.getvalue())
+            else:
+                result_cache.put_file(key, output)
+    # Verification leaves an in-memory EPUB at some offset
+    if temp_dir is None:
+        output.seek(0)
+    if idempotency_key is not None:
+        idempotency_store.complete(idempotency_key, key, output, headers)
+    
+    # Return the EPUB file
+    logger.info("Sending EPUB file to client")
+    response = epub_response(output, 'MISS', temp_dir, etag=key, delivery=request_delivery())
+    response.headers.update(headers)
+    return response
+
+
+def conversion_error_response(e):
+    """The error response for an exception raised while handling a /convert request."""
+    if isinstance(e, ConversionError):
+        return error_response(e)
+    if isinstance(e, BodyTooLarge):
+        logger.warning("Rejected conversion request: %s", e)
+        return jsonify({"error": str(e)}), 413
+    if isinstance(e, UnsupportedEncoding):
+        logger.warning("Rejected conversion request: %s", e)
+        return jsonify({"error": str(e), "supported_encodings": list(supported_encodings())}), 415
+    if isinstance(e, BodyDecodeError):
+        logger.warning("Rejected conversion request: %s", e)
+        return jsonify({"error": str(e)}), 400
+    logger.exception("Exception during conversion process: %s", e)
+    return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+
+def request_formats(data):
+    """The output formats a /convert/formats request asked for, without duplicates. Raises ConversionError."""
+    formats = data.get('formats') if isinstance(data, dict) else None
+    if not isinstance(formats, list) or not formats or not all(isinstance(writer, str) for writer in formats):
+        raise ConversionError(f"formats must be a list of output formats ({', '.join(OUTPUT_FORMATS)})", 400)
+    for writer in formats:
+        if writer not in OUTPUT_FORMATS:
+            raise ConversionError(f"Unknown output format: {writer} (available: {', '.join(OUTPUT_FORMATS)})", 400)
+    return list(dict.fromkeys(formats))
+
+
+def parse_document(normalized_content, profile, ast_path):
+    """
+    Write the pandoc JSON AST of normalized markdown to ast_path.
+    
+    The AST comes from the AST cache when the same markdown was parsed with
+    the same reader before, and is parsed with pandoc and cached otherwise.
+    Returns 'HIT' or 'MISS', or None without a cache. Raises ConversionError.
+    """
+    key = cache_key(normalized_content, {}, profile.parse_options)
+    if ast_cache is not None:
+        cached = ast_cache.open(key)
+        metrics.inc('epub_ast_cache_lookups_total', result='miss' if cached is None else 'hit')
+        if cached is not None:
+            with cached, open(ast_path, 'wb') as f:
+                shutil.copyfileobj(cached, f)
+            logger.info("Using parsed document from AST cache (%s)", key[:12])
+            return 'HIT'
+    
+    cmd = ['pandoc'] + profile.parse_options + ['-o', ast_path]
+    logger.info("Executing pandoc command: %s", ' '.join(cmd))
+    with pandoc_slot(), timed_stage('parse'):
+        result = run_limited(cmd, input=normalized_content, text=True)
+    check_pandoc_exit(result.returncode, result.stderr, result.stdout)
+    if ast_cache is None:
+        return None
+    ast_cache.put_file(key, ast_path)
+    return 'MISS'
+
+
+def render_document(ast_path, metadata_path, writer, title, author, profile, resource_options):
+    """
+    Render a parsed document (see parse_document) with a pandoc writer.
+    
+    The output is written next to the AST, and EPUBs are verified. Returns its
+    path. Raises ConversionError on failure.
+    """
+    output_path = os.path.join(os.path.dirname(ast_path), f"output-{writer}.{OUTPUT_FORMATS[writer][0]}")
+    cmd = subprocess_command(ast_path, metadata_path, output_path,
+                             profile.writer_options(writer, title, author) + resource_options)
+    logger.info("Executing pandoc command: %s", ' '.join(cmd))
+    with pandoc_slot(), timed_stage('render'):
+        result = run_limited(cmd, text=True)
+    check_pandoc_exit(result.returncode, result.stderr, result.stdout)
+    if writer in EPUB_WRITERS:
+        verify_epub(output_path, title, author)
+    return output_path
+
+
+def produce_epub(markdown_content, title, author, temp_dir, progress=None, profile=None):
+    """
+    Run the full pipeline for one document, using the result cache when possible.
+    
+    Returns the path of the EPUB inside temp_dir. Raises ConversionError on failure.
+    """
+    with timed_stage('normalize'):
+        normalized_content = normalize_markdown(markdown_content)
+    metadata = build_metadata(title, author, profile)
+    pandoc_options = build_pandoc_options(title, author, profile)
+    
+    key = None
+    if result_cache is not None:
+        key = conversion_cache_key(normalized_content, metadata, pandoc_options, profile=profile)
+        cached = result_cache.open(key)
+        metrics.inc('epub_cache_lookups_total', result='miss' if cached is None else 'hit')
+        if cached is not None:
+            logger.info("Using EPUB from result cache (%s)", key[:12])
+            output_path = os.path.join(temp_dir, 'output.epub')
+            with timed_stage('copy'), cached, open(output_path, 'wb') as f:
+                shutil.copyfileobj(cached, f)
+            return output_path
+    
+    output_path, _ = convert_to_epub(normalized_content, metadata, pandoc_options, temp_dir, progress, profile=profile)
+    if key is not None:
+        with timed_stage('copy'):
+            result_cache.put_file(key, output_path)
+    return output_path
+
+
+def run_job(job_id, markdown_content, title, author, profile=None):
+    """Run the conversion pipeline for an asynchronous job and record the outcome."""
+    def progress(stage, percent):
+        job_store.update(job_id, status='running', stage=stage, progress=percent)
+    
+    logger.info("Starting job %s - Title: '%s', Author: '%s'", job_id, title, author)
+    # Jobs are for conversions that take longer than a request may
+    pandoc_timeout_var.set(PANDOC_JOB_TIMEOUT)
+    request_deadline_var.set(None)
+    try:
+        progress('normalizing', 5)
+        temp_dir = tempfile.mkdtemp()
+        try:
+            output_path = produce_epub(markdown_content, title, author, temp_dir, progress, profile)
+            progress('storing', 95)
+            job_store.store_result(job_id, output_path)
+        finally:
+            remove_temp_dir(temp_dir)
+        
+        size = os.path.getsize(job_store.result_path(job_id))
+        job_store.update(job_id, status='done', stage='done', progress=100, size=size)
+        logger.info("Job %s finished (%s bytes)", job_id, size)
+    except ConversionError as e:
+        logger.error("Job %s failed: %s", job_id, e.message)
+        job_store.update(job_id, status='failed', error=e.message)
+    except Exception as e:
+        logger.exception("Exception during job %s: %s", job_id, e)
+        job_store.update(job_id, status='failed', error=f"An error occurred: {str(e)}")
+    finally:
+        metrics.flush()
+
+
+def job_links(job_id):
+    return {
+        "status_url": f"/jobs/{job_id}",
+        "result_url": f"/jobs/{job_id}/result"
+    }
+
+
+@app.route('/jobs', methods=['POST'])
+@auth_required
+def create_job():
+    """Queue a conversion and return its job id without waiting for pandoc."""
+    logger.info("Create job endpoint called")
+    
+    data = request.get_json()
+    try:
+        markdown_content, title, author, profile = parse_conversion_request(data)
+    except ConversionError as e:
+        return error_response(e)
+    
+    job_id = job_store.create(title=title, author=author, profile=profile.name)
+    # Job threads keep logging under the id of the request that created the job
+    job_executor.submit(contextvars.copy_context().run, run_job, job_id, markdown_content, title, author, profile)
+    logger.info("Queued job %s (%s characters)", job_id, len(markdown_content))
+    
+    response = jsonify({"job_id": job_id, "status": "queued", **job_links(job_id)})
+    response.status_code = 202
+    response.headers['Location'] = f"/jobs/{job_id}"
+    return response
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+@auth_required
+def job_status(job_id):
+    """Report the status and progress of a job."""
+    state = job_store.get(job_id)
+    if state is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify({**state, **job_links(job_id)}), 200
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+@auth_required
+def job_result(job_id):
+    """Send the EPUB of a finished job."""
+    state = job_store.get(job_id)
+    if state is None:
+        return jsonify({"error": "Job not found"}), 404
+    if state['status'] == 'failed':
+        return jsonify({"error": state['error'], "status": state['status']}), 409
+    if state['status'] != 'done':
+        return jsonify({"error": "Job is not finished", "status": state['status']}), 409
+    
+    try:
+        result_file = open(job_store.result_path(job_id), 'rb')
+    except FileNotFoundError:
+        return jsonify({"error": "Job not found"}), 404
+    return epub_response(result_file)
+
+def convert_batch_item(item, context=None):
+    """
+    Convert one batch item; runs in a batch pool process.
+    
+    context is the log_context() of the batch request. Returns a dict with the
+    EPUB 'path' and its 'temp_dir' (to be removed by the caller) on success,
+    or an 'error' message on failure.
+    """
+    if context is not None:
+        bind_log_context(context)
+    try:
+        if not isinstance(item, dict):
+            raise ConversionError("Batch item must be an object", 400)
+        markdown_content, title, author, profile = parse_conversion_request(item)
+    except ConversionError as e:
+        return {"error": e.message}
+    
+    temp_dir = tempfile.mkdtemp()
+    try:
+        output_path = produce_epub(markdown_content, title, author, temp_dir, profile=profile)
+        return {"path": output_path, "temp_dir": temp_dir}
+    except ConversionError as e:
+        remove_temp_dir(temp_dir)
+        return {"error": e.message}
+    except Exception as e:
+        logger.exception("Exception during batch item conversion: %s", e)
+        remove_temp_dir(temp_dir)
+        return {"error": f"An error occurred: {str(e)}"}
+    finally:
+        metrics.flush()
+
+
+def get_batch_pool():
+    """Return this worker's batch process pool, creating it on first use."""
+    global batch_pool
+    with batch_pool_lock:
+        if batch_pool is None:
+            # Spawned children do not inherit the worker's threads or open sockets, but the
+            # environment, which tells them that they are batch processes
+            os.environ[BATCH_PROCESS_ENV] = '1'
+            batch_pool = ProcessPoolExecutor(
+                max_workers=BATCH_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return batch_pool
+
+
+def reset_batch_pool(pool):
+    """Discard a pool whose processes died so the next batch starts a new one."""
+    global batch_pool
+    with batch_pool_lock:
+        if batch_pool is pool:
+            batch_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def read_batch_items():
+    """Yield the items of a batch request from a JSON array or an NDJSON body."""
+    content_type = (request.mimetype or '').lower()
+    if content_type in ('application/x-ndjson', 'application/jsonl', 'application/x-jsonlines'):
+        # Read line by line so conversions start while the body is still arriving
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
             try:
-                # Read the file into memory to avoid temp file issues
-                with open(permanent_output_path, 'rb') as f:
-                    file_data = f.read()
-                
-                from io import BytesIO
-                mem_file = BytesIO(file_data)
-                
-                # Send from memory instead of from disk
-                response = send_file(
-                    mem_file,
-                    mimetype='application/epub+zip',
-                    as_attachment=True,
-                    download_name='book.epub'
-                )
+                yield json.loads(line)
+            except ValueError as e:
+                yield ConversionError(f"Invalid JSON line: {str(e)}", 400)
+        return
+    
+    data = request.get_json()
+    if isinstance(data, dict):
+        data = data.get('items')
+    if not isinstance(data, list):
+        raise ConversionError("Batch body must be a JSON array of conversion requests or NDJSON", 400)
+    yield from data
+
+
+def batch_entry_name(index, title):
+    """File name of a batch item's EPUB inside the result zip."""
+    slug = re.sub(r'[^A-Za-z0-9]+', '-', title).strip('-').lower()[:60] or 'book'
+    return f"{index:04d}-{slug}.epub"
+
+
+class ZipStream(io.RawIOBase):
+    """Write-only sink that collects zipfile output so it can be yielded in chunks."""
+    
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+    
+    def writable(self):
+        return True
+    
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+    
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def discard_batch_result(future):
+    """Remove the temporary directory of a batch result nobody will send."""
+    if future.cancelled() or future.exception() is not None:
+        return
+    result = future.result()
+    if 'temp_dir' in result:
+        remove_temp_dir(result['temp_dir'])
+
+
+def abandon_batch_items(futures):
+    """Cancel batch items that will not be sent; running ones clean up when they finish."""
+    for future in futures:
+        if not future.cancel():
+            future.add_done_callback(discard_batch_result)
+
+
+def stream_batch_zip(pool, futures, entries):
+    """Yield a zip of the EPUBs as batch items finish, followed by manifest.json."""
+    sink = ZipStream()
+    pending = set(futures)
+    try:
+        with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as zf:
+            for future in as_completed(futures):
+                pending.discard(future)
+                index = futures[future]
+                entry = entries[index]
+                try:
+                    result = future.result()
+                except BrokenProcessPool as e:
+                    logger.error("Batch process pool is broken, restarting it: %s", e)
+                    reset_batch_pool(pool)
+                    result = {"error": "Batch worker process died"}
+                except Exception as e:
+                    logger.error("Batch item %s failed in pool process: %s", index, e)
+                    result = {"error": f"An error occurred: {str(e)}"}
                 
-                # Add headers to prevent caching issues
-                response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-                response.headers['Pragma'] = 'no-cache'
-                response.headers['Expires'] = '0'
+                if 'error' in result:
+                    entry.update(status='failed', error=result['error'])
+                    continue
                 
-                return response
-            except Exception as e:
-                logger.error(f"Error sending file: {str(e)}")
-                return jsonify({"error": f"Error sending file: {str(e)}"}), 500
+                try:
+                    name = batch_entry_name(index, entry['title'])
+                    # EPUBs are already compressed, so store them as they are
+                    zf.write(result['path'], name)
+                    entry.update(status='done', file=name, size=os.path.getsize(result['path']))
+                finally:
+                    remove_temp_dir(result['temp_dir'])
+                yield sink.drain()
+            
+            manifest = sorted(entries.values(), key=lambda e: e['index'])
+            zf.writestr('manifest.json', json.dumps({"items": manifest}, indent=2), compress_type=zipfile.ZIP_DEFLATED)
+    finally:
+        # The client went away before every item was sent
+        abandon_batch_items(pending)
+    
+    failed = sum(1 for e in manifest if e['status'] == 'failed')
+    logger.info("Batch finished: %s converted, %s failed", len(manifest) - failed, failed)
+    yield sink.drain()
+
+
+@app.route('/convert/formats', methods=['POST'])
+@auth_required
+def convert_formats():
+    """
+    Convert one document to several output formats, reading the markdown only once.
+    
+    One format is sent as is; several are sent as a zip of book-<format>.<ext> files.
+    """
+    logger.info("Formats convert endpoint called")
+    temp_dir = None
+    try:
+        install_body_stream(request.environ, MAX_INPUT_BYTES)
+        formats = request_formats(request.get_json())
+        title, author, profile, metadata, _, normalized_content, images, _ = read_json_conversion()
+        logger.info("Processing conversion request - Title: '%s', Author: '%s', Profile: %s, Formats: %s",
+                    title, author, profile.name, ', '.join(formats))
+        
+        temp_dir = tempfile.mkdtemp()
+        ast_path = os.path.join(temp_dir, 'input.json')
+        ast_status = parse_document(normalized_content, profile, ast_path)
+        metadata_path = os.path.join(temp_dir, 'metadata.yaml')
+        with timed_stage('metadata'):
+            write_metadata_file(metadata_path, metadata, profile)
+        resource_options = link_conversion_images(images, temp_dir, [])
+        
+        # The formats are rendered at the same time, each on its own pandoc slot
+        futures = [
+            chunk_executor.submit(contextvars.copy_context().run, render_document, ast_path, metadata_path, writer,
+                                  title, author, profile, resource_options)
+            for writer in formats
+        ]
+        try:
+            paths = [future.result() for future in futures]
+        finally:
+            for future in futures:
+                future.cancel()
+        
+        if len(formats) == 1:
+            extension, mimetype = OUTPUT_FORMATS[formats[0]]
+            source, download_name = paths[0], f"book.{extension}"
+        else:
+            mimetype, source, download_name = 'application/zip', os.path.join(temp_dir, 'formats.zip'), 'book.zip'
+            with zipfile.ZipFile(source, 'w') as zf:
+                for writer, path in zip(formats, paths):
+                    # Most formats are zip containers already
+                    compression = zipfile.ZIP_DEFLATED if writer == 'html5' else zipfile.ZIP_STORED
+                    zf.write(path, f"book-{writer}.{OUTPUT_FORMATS[writer][0]}", compress_type=compression)
+        
+        response = send_file(TempDirFile(source, temp_dir), mimetype=mimetype, as_attachment=True,
+                             download_name=download_name, etag=False)
+        response.content_length = os.path.getsize(source)
+        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+        if ast_status is not None:
+            response.headers['X-AST-Cache'] = ast_status
+        return response
+    except HTTPException:
+        if temp_dir is not None:
+            remove_temp_dir(temp_dir)
+        raise
+    except Exception as e:
+        if temp_dir is not None:
+            remove_temp_dir(temp_dir)
+        return conversion_error_response(e)
+
+def render_preview_source(source, profile):
+    """
+    Render markdown for render_preview: with the native engine when it is
+    enabled and supports the markdown, otherwise with pandoc under a preview slot.
+    """
+    if NATIVE_ENGINE == 'auto' and profile.native:
+        try:
+            return '\n'.join(block[3] for block in render_native_blocks(source))
+        except NativeUnsupported:
+            pass
+    return render_fragment(source, profile.reader_format, slot=preview_slot)
+
+@app.route('/preview', methods=['POST'])
+@auth_required
+def preview():
+    """
+    Render markdown to an HTML fragment for the live preview of the web UI.
     
+    The markdown is read with the reader extensions of the requested profile,
+    block by block, and blocks rendered for an earlier request come from the
+    preview cache (see live_preview).
+    """
+    try:
+        install_body_stream(request.environ, MAX_INPUT_BYTES)
+        data = request.get_json()
+        if not isinstance(data, dict) or not isinstance(data.get('markdown'), str):
+            raise ConversionError("Missing required field: markdown", 400)
+        profile = request_profile(data.get('profile'))
+        with timed_stage('normalize'):
+            normalized_content = normalize_markdown(data['markdown'])
+        with timed_stage('preview'):
+            html, blocks, rendered = render_preview(
+                normalized_content, profile.reader_format,
+                lambda source: render_preview_source(source, profile), preview_cache)
+        metrics.inc('epub_preview_blocks_total', blocks - rendered, result='cached')
+        metrics.inc('epub_preview_blocks_total', rendered, result='rendered')
+        logger.info("Rendered preview: %s of %s blocks", rendered, blocks)
+        
+        response = jsonify({'html': html, 'blocks': blocks, 'rendered': rendered})
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.exception(f"Exception during conversion process: {str(e)}")
-        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+        return conversion_error_response(e)
+
+@app.route('/results/<result_id>', methods=['GET'])
+def download_result(result_id):
+    """
+    Send a result stored by /convert?delivery=url.
+    
+    Not authenticated: the random result id in the URL is the credential, as
+    with object storage download links. Range and If-Range requests resume an
+    interrupted download.
+    """
+    result = result_store.get(result_id)
+    if result is None:
+        return jsonify({"error": "Result not found or expired"}), 404
+    
+    response = send_file(
+        result.path,
+        mimetype=result.content_type,
+        as_attachment=True,
+        download_name=result.filename,
+        conditional=True,
+        etag=result.etag,
+        last_modified=result.created_at
+    )
+    response.headers['Cache-Control'] = f"private, max-age={max(int(result.expires_at - time.time()), 0)}, immutable"
+    return response
+
+@app.route('/convert/batch', methods=['POST'])
+@auth_required
+def convert_batch():
+    """Convert many documents concurrently and stream back a zip of EPUBs plus a manifest."""
+    logger.info("Batch convert endpoint called")
+    
+    pool = get_batch_pool()
+    futures = {}
+    entries = {}
+    try:
+        for index, item in enumerate(read_batch_items()):
+            if index >= BATCH_MAX_ITEMS:
+                raise ConversionError(f"Batch exceeds the maximum of {BATCH_MAX_ITEMS} items", 413)
+            
+            title = item.get('title') if isinstance(item, dict) else None
+            entries[index] = {
+                "index": index,
+                "title": title if isinstance(title, str) and title else 'Untitled',
+                "status": "pending",
+                "error": None
+            }
+            if isinstance(item, ConversionError):
+                entries[index].update(status='failed', error=item.message)
+                continue
+            futures[pool.submit(convert_batch_item, item, log_context())] = index
+    except ConversionError as e:
+        abandon_batch_items(futures)
+        return error_response(e)
+    except BrokenProcessPool as e:
+        abandon_batch_items(futures)
+        logger.error("Batch process pool is broken, restarting it: %s", e)
+        reset_batch_pool(pool)
+        return jsonify({"error": "Batch workers unavailable, please retry"}), 503
+    
+    if not entries:
+        return jsonify({"error": "Batch contains no items"}), 400
+    
+    logger.info("Queued batch of %s items on %s processes", len(entries), BATCH_WORKERS)
+    response = app.response_class(
+        stream_with_context(stream_batch_zip(pool, futures, entries)),
+        mimetype='application/zip'
+    )
+    response.headers['Content-Disposition'] = 'attachment; filename=batch.zip'
+    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    return response
+
+def book_not_found(book_id):
+    return jsonify({"error": f"Book not found: {book_id}"}), 404
+
+
+def assemble_book(book):
+    """Build the book's EPUB from its stored chapters unless it is already current."""
+    book_id = book['book_id']
+    if book_store.epub_is_current(book):
+        return
+    
+    chapters = [
+        Chapter(f"ch{index + 1:03d}.xhtml", chapter['title'], book_store.read_chapter(book_id, chapter['chapter_id']),
+                headings=[tuple(h) for h in chapter['headings']])
+        for index, chapter in enumerate(book['chapters'])
+    ]
+    metadata = build_metadata(book['title'], book['author'])
+    modified = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(book['updated_at']))
+    
+    epub_path = book_store.epub_path(book_id)
+    tmp_path = f"{epub_path}.{os.getpid()}.tmp"
+    try:
+        write_epub(tmp_path, metadata, chapters, toc_depth=3, identifier=book['identifier'], modified=modified)
+        verify_epub(tmp_path, book['title'], book['author'])
+        os.replace(tmp_path, epub_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    logger.info("Assembled book %s from %s chapters", book_id, len(chapters))
+
+
+@app.route('/books/<book_id>', methods=['PUT'])
+@auth_required
+def put_book(book_id):
+    """Create a book or update its title and author."""
+    if not valid_id(book_id):
+        return jsonify({"error": "Invalid book id"}), 400
+    data = request.get_json(silent=True) or {}
+    
+    with book_store.lock(book_id):
+        book = book_store.load(book_id)
+        created = book is None
+        if created:
+            book = book_store.new_book(book_id, 'Untitled', 'Unknown Author')
+        for field in ('title', 'author'):
+            if isinstance(data.get(field), str) and data[field]:
+                book[field] = data[field]
+        book_store.save(book)
+    
+    logger.info("%s book %s", 'Created' if created else 'Updated', book_id)
+    return jsonify(book), 201 if created else 200
+
+@app.route('/books/<book_id>', methods=['GET'])
+@auth_required
+def get_book(book_id):
+    """Return a book's metadata and chapter list."""
+    book = book_store.load(book_id) if valid_id(book_id) else None
+    if book is None:
+        return book_not_found(book_id)
+    return jsonify(book), 200
+
+@app.route('/books/<book_id>', methods=['DELETE'])
+@auth_required
+def delete_book(book_id):
+    """Delete a book with all of its chapters."""
+    if not valid_id(book_id) or book_store.load(book_id) is None:
+        return book_not_found(book_id)
+    book_store.delete(book_id)
+    logger.info("Deleted book %s", book_id)
+    return '', 204
+
+@app.route('/books/<book_id>/chapters/<chapter_id>', methods=['PUT'])
+@auth_required
+def put_chapter(book_id, chapter_id):
+    """
+    Add or replace a chapter. Only this chapter is converted; unchanged
+    content is detected by hash and not converted again.
+    """
+    if not valid_id(book_id) or book_store.load(book_id) is None:
+        return book_not_found(book_id)
+    if not valid_id(chapter_id):
+        return jsonify({"error": "Invalid chapter id"}), 400
+    
+    data = request.get_json()
+    if not data or not isinstance(data.get('markdown'), str):
+        logger.error("Missing required field: markdown")
+        return jsonify({"error": "Missing required field: markdown"}), 400
+    
+    normalized_content = normalize_markdown(data['markdown'])
+    content_hash = hashlib.sha256(f"{PANDOC_READER_FORMAT}\n{normalized_content}".encode('utf-8')).hexdigest()
+    
+    with book_store.lock(book_id):
+        book = book_store.load(book_id)
+        if book is None:
+            return book_not_found(book_id)
+        chapters = book['chapters']
+        existing = next((c for c in chapters if c['chapter_id'] == chapter_id), None)
+        
+        converted = existing is None or existing['hash'] != content_hash
+        if converted:
+            try:
+                body = render_fragment(normalized_content)
+            except ConversionError as e:
+                return error_response(e)
+            book_store.write_chapter(book_id, chapter_id, body)
+            headings = extract_headings(body)
+        else:
+            headings = [tuple(h) for h in existing['headings']]
+        
+        title = data.get('title')
+        if not isinstance(title, str) or not title:
+            title = existing['title'] if existing else next((h[2] for h in headings if h[2]), chapter_id)
+        
+        chapter = {
+            "chapter_id": chapter_id,
+            "title": title,
+            "hash": content_hash,
+            "headings": headings,
+            "updated_at": time.time() if converted else existing['updated_at']
+        }
+        # Keep the chapter's place unless an explicit position is given; new chapters go last
+        if existing is not None:
+            index = chapters.index(existing)
+            chapters.pop(index)
+        else:
+            index = len(chapters)
+        position = data.get('position')
+        if isinstance(position, int) and not isinstance(position, bool):
+            index = max(0, min(position, len(chapters)))
+        chapters.insert(index, chapter)
+        book_store.save(book)
+    
+    logger.info("%s chapter %s of book %s", 'Converted' if converted else 'Kept', chapter_id, book_id)
+    return jsonify({**chapter, "converted": converted}), 200
+
+@app.route('/books/<book_id>/chapters/<chapter_id>', methods=['DELETE'])
+@auth_required
+def delete_chapter(book_id, chapter_id):
+    """Remove a chapter from a book."""
+    if not valid_id(book_id) or book_store.load(book_id) is None:
+        return book_not_found(book_id)
+    
+    with book_store.lock(book_id):
+        book = book_store.load(book_id)
+        if book is None:
+            return book_not_found(book_id)
+        remaining = [c for c in book['chapters'] if c['chapter_id'] != chapter_id]
+        if len(remaining) == len(book['chapters']):
+            return jsonify({"error": f"Chapter not found: {chapter_id}"}), 404
+        book['chapters'] = remaining
+        book_store.delete_chapter(book_id, chapter_id)
+        book_store.save(book)
+    return '', 204
+
+@app.route('/books/<book_id>/epub', methods=['GET'])
+@auth_required
+def get_book_epub(book_id):
+    """Return the book as an EPUB, re-assembling it from stored chapters if it changed."""
+    book = book_store.load(book_id) if valid_id(book_id) else None
+    if book is None:
+        return book_not_found(book_id)
+    if not book['chapters']:
+        return jsonify({"error": "Book has no chapters"}), 409
+    
+    try:
+        with book_store.lock(book_id):
+            book = book_store.load(book_id)
+            if book is None:
+                return book_not_found(book_id)
+            assemble_book(book)
+            # Open before releasing the lock; a later rebuild replaces the file, not its contents
+            epub_file = open(book_store.epub_path(book_id), 'rb')
+    except ConversionError as e:
+        return error_response(e)
+    return epub_response(epub_file)
 
 if __name__ == '__main__':
     # Get configuration from environment variables
@@ -352,13 +2300,13 @@ if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     debug = os.environ.get('DEBUG', 'False').lower() == 'true'
     
-    logger.info(f"Starting application on {host}:{port} (debug={debug})")
+    logger.info("Starting application on %s:%s (debug=%s)", host, port, debug)
     
     # Check if pandoc is installed and working
     try:
         version_result = subprocess.run(['pandoc', '--version'], capture_output=True, text=True)
-        logger.info(f"Pandoc version: {version_result.stdout.splitlines()[0]}")
+        logger.info("Pandoc version: %s", version_result.stdout.splitlines()[0])
     except Exception as e:
-        logger.error(f"Error checking pandoc installation: {str(e)}")
+        logger.error("Error checking pandoc installation: %s", e)
     
     app.run(host=host, port=port, debug=debug)
@@ -0,0 +1,365 @@
+"""
+Asyncio (ASGI) server mode for the conversion API.
+
+Serves the same Flask app, but a worker process is no longer tied up while a
+conversion waits for pandoc:
+
+- JSON ``POST /convert`` requests are handled on the event loop. pandoc is
+  started with ``asyncio.create_subprocess_exec`` and the admission control
+  slot is waited for without blocking, so one process can have any number of
+  conversions waiting on pandoc. When the client disconnects, its conversion
+  is cancelled and the pandoc process killed.
+- The blocking steps of those conversions (normalization, the native engine,
+  the pandoc server pool, verification, the result cache) run in threads.
+- Every other request runs the Flask app in one of ``ASGI_THREADS`` threads,
+  as a threaded WSGI server would, so ``/status`` stays responsive while
+  conversions are in flight.
+
+Run with ``uvicorn asgi:app`` or ``gunicorn -k uvicorn.workers.UvicornWorker asgi:app``.
+"""
+
+import asyncio
+import io
+import logging
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from flask import request
+from werkzeug.exceptions import ClientDisconnected, HTTPException
+
+from admission import AdmissionRejected
+from app import (
+    MARKDOWN_MIMETYPES, MAX_INPUT_BYTES, admission, admission_error, authentication_error, check_pandoc_exit,
+    conversion_error_response, conversion_response, converts_in_memory, finish_conversion, limit_error,
+    link_conversion_images, pandoc_limits, pandoc_timeout, pipe_command, read_json_conversion, record_stage,
+    release_idempotency_key, remove_temp_dir, request_delivery, run_native, run_pandoc_server, run_parallel,
+    stored_conversion_response, subprocess_command, timed_stage, write_metadata_file
+)
+from app import app as flask_app
+from pandoc_limits import kill_process_group
+from request_body import BodyTooLarge, install_body_stream
+
+logger = logging.getLogger(__name__)
+
+# Threads per process that run the Flask app for requests not handled on the event loop
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 16))
+
+# Status recorded for conversions abandoned by the client (as nginx logs them)
+CLIENT_CLOSED_REQUEST = 499
+
+wsgi_executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='wsgi')
+
+
+class ReceiveStream(io.RawIOBase):
+    """Request body for the Flask app in a thread, read from the ASGI receive channel as it arrives."""
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = b''
+        self._more_body = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer and self._more_body:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message['type'] == 'http.disconnect':
+                raise ClientDisconnected()
+            self._buffer = message.get('body', b'')
+            self._more_body = message.get('more_body', False)
+        count = min(len(b), len(self._buffer))
+        b[:count] = self._buffer[:count]
+        self._buffer = self._buffer[count:]
+        return count
+
+
+def wsgi_environ(scope, body):
+    """The WSGI environ of an ASGI HTTP request, reading the request body from body."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        # Chunked bodies have no Content-Length; let readers consume the stream to its end
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        value = value.decode('latin-1')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def run_wsgi(wsgi_app, environ, send):
+    """Run a WSGI application in a thread and send its response from there."""
+    loop = asyncio.get_running_loop()
+
+    def send_from_thread(message):
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    def run():
+        response_start = {}
+
+        def start_response(status, headers, exc_info=None):
+            response_start['status'] = int(status.split(' ', 1)[0])
+            response_start['headers'] = [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+            return lambda data: send_body(data)
+
+        def send_body(data, more_body=True):
+            if 'sent' not in response_start:
+                send_from_thread({'type': 'http.response.start', 'status': response_start['status'],
+                                  'headers': response_start['headers']})
+                response_start['sent'] = True
+            if data or not more_body:
+                send_from_thread({'type': 'http.response.body', 'body': data, 'more_body': more_body})
+
+        iterable = wsgi_app(environ, start_response)
+        try:
+            for chunk in iterable:
+                send_body(chunk)
+            send_body(b'', more_body=False)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    await loop.run_in_executor(wsgi_executor, run)
+
+
+async def read_body(receive, max_bytes):
+    """Read a whole request body. Raises BodyTooLarge beyond max_bytes (0 for no limit)."""
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ClientDisconnected()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if max_bytes > 0 and size > max_bytes:
+            raise BodyTooLarge(max_bytes)
+        chunks.append(chunk)
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def until_disconnect(coroutine, receive):
+    """Await coroutine; if the client disconnects first, cancel it and raise ClientDisconnected."""
+    task = asyncio.ensure_future(coroutine)
+    watcher = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        watcher.cancel()
+        raise
+    watcher.cancel()
+    if task.done():
+        return task.result()
+
+    task.cancel()
+    await asyncio.wait({task})
+    raise ClientDisconnected()
+
+
+@asynccontextmanager
+async def pandoc_slot_async():
+    """Hold one of the host's pandoc slots, like pandoc_slot(), waiting on the event loop."""
+    if admission is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        slot = await admission.acquire_async()
+    except AdmissionRejected as e:
+        raise admission_error(e)
+    record_stage('queue', time.perf_counter() - start)
+    try:
+        yield
+    finally:
+        slot.release()
+
+
+async def run_pandoc_async(normalized_content, metadata, pandoc_options, output, temp_dir, profile):
+    """
+    Convert with a one-shot pandoc process without blocking the event loop.
+
+    Uses stdin/stdout when output is in memory and work files otherwise. The
+    process runs under the limits of the threaded server and is killed when the
+    conversion is cancelled. Raises ConversionError on failure.
+    """
+    if temp_dir is None:
+        cmd = pipe_command(metadata, pandoc_options)
+        stdin = normalized_content.encode('utf-8')
+    else:
+        input_path = os.path.join(temp_dir, 'input.md')
+        metadata_path = os.path.join(temp_dir, 'metadata.yaml')
+
+        def write_work_files():
+            with open(input_path, 'w', encoding='utf-8') as f:
+                f.write(normalized_content)
+            with timed_stage('metadata'):
+                write_metadata_file(metadata_path, metadata, profile)
+
+        await asyncio.to_thread(write_work_files)
+        cmd = subprocess_command(input_path, metadata_path, output, pandoc_options)
+        stdin = None
+    logger.info("Executing pandoc command: %s", ' '.join(cmd))
+
+    async with pandoc_slot_async():
+        timeout = pandoc_timeout()
+        with timed_stage('pandoc'):
+            process = await asyncio.create_subprocess_exec(
+                *pandoc_limits.command(cmd),
+                stdin=asyncio.subprocess.PIPE if stdin is not None else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True
+            )
+            pandoc_limits.started(process.pid, timeout)
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(stdin), timeout or None)
+            except asyncio.TimeoutError:
+                kill_process_group(process.pid)
+                await process.wait()
+                logger.warning("Killed pandoc process %s after %s seconds", process.pid, timeout)
+                raise limit_error(pandoc_limits.timeout_exceeded(timeout))
+            except asyncio.CancelledError:
+                kill_process_group(process.pid)
+                await process.wait()
+                logger.info("Killed pandoc process %s of a cancelled conversion", process.pid)
+                raise
+
+    stderr = stderr.decode('utf-8', errors='replace')
+    if temp_dir is None:
+        check_pandoc_exit(process.returncode, stderr)
+        output.write(stdout)
+    else:
+        check_pandoc_exit(process.returncode, stderr, stdout.decode('utf-8', errors='replace'))
+
+
+async def convert_to_epub_async(normalized_content, metadata, pandoc_options, temp_dir, images, profile):
+    """convert_to_epub() with a one-shot pandoc process driven by the event loop."""
+    if temp_dir is None:
+        output = io.BytesIO()
+    else:
+        output = os.path.join(temp_dir, 'output.epub')
+        pandoc_options = await asyncio.to_thread(link_conversion_images, images, temp_dir, pandoc_options)
+    if not images and await asyncio.to_thread(run_native, normalized_content, metadata, output, profile):
+        engine = 'native'
+    elif not images and await asyncio.to_thread(run_parallel, normalized_content, metadata, output, profile):
+        engine = 'pandoc-parallel'
+    elif (not images and profile.pandoc_server
+          and await asyncio.to_thread(run_pandoc_server, normalized_content, metadata, pandoc_options, output)):
+        engine = 'pandoc-server'
+    else:
+        await run_pandoc_async(normalized_content, metadata, pandoc_options, output, temp_dir, profile)
+        engine = 'pandoc'
+    return await asyncio.to_thread(finish_conversion, output, engine, metadata, temp_dir, lambda stage, percent: None)
+
+
+async def convert_json():
+    """The JSON branch of the /convert view, run on the event loop."""
+    install_body_stream(request.environ, MAX_INPUT_BYTES)
+    request_delivery()
+    title, author, profile, metadata, pandoc_options, normalized_content, images, key = await asyncio.to_thread(
+        read_json_conversion)
+    logger.info("Processing conversion request - Title: '%s', Author: '%s', Profile: %s", title, author, profile.name)
+
+    # Answer revalidations, retries and repeated conversions without running pandoc
+    response, idempotency_key = await asyncio.to_thread(stored_conversion_response, key)
+    if response is not None:
+        return response
+
+    temp_dir = None if converts_in_memory(normalized_content, images) else tempfile.mkdtemp()
+    try:
+        output, details = await convert_to_epub_async(normalized_content, metadata, pandoc_options, temp_dir, images, profile)
+        return await asyncio.to_thread(conversion_response, output, details, key, temp_dir, idempotency_key)
+    except BaseException:
+        # Also on cancellation, when the client has disconnected
+        release_idempotency_key(idempotency_key)
+        if temp_dir is not None:
+            remove_temp_dir(temp_dir)
+        raise
+
+
+async def convert(scope, receive, send):
+    """Handle a JSON /convert request in the Flask app's request context."""
+    environ = wsgi_environ(scope, io.BytesIO())
+    with flask_app.request_context(environ):
+        response = flask_app.preprocess_request() or authentication_error()
+        if response is None:
+            try:
+                environ['wsgi.input'] = io.BytesIO(await read_body(receive, MAX_INPUT_BYTES))
+                response = await until_disconnect(convert_json(), receive)
+            except ClientDisconnected:
+                logger.info("Client disconnected, conversion cancelled")
+                # Counted in the request metrics, but there is no one to send it to
+                flask_app.process_response(flask_app.response_class(status=CLIENT_CLOSED_REQUEST))
+                return
+            except HTTPException as e:
+                # Malformed JSON and unsupported media types keep Flask's responses
+                response = flask_app.handle_user_exception(e)
+            except Exception as e:
+                response = conversion_error_response(e)
+        response = flask_app.process_response(flask_app.make_response(response))
+    await run_wsgi(response, environ, send)
+
+
+def converts_on_loop(scope):
+    """Whether a request is a JSON conversion handled on the event loop (see the /convert view)."""
+    if scope['method'] != 'POST' or scope['path'] != '/convert':
+        return False
+    content_type = next((value for name, value in scope['headers'] if name.lower() == b'content-type'), b'')
+    mimetype = content_type.decode('latin-1').split(';', 1)[0].strip().lower()
+    return mimetype not in MARKDOWN_MIMETYPES and mimetype != 'multipart/form-data'
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            wsgi_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI entry point."""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif scope['type'] == 'http':
+        if converts_on_loop(scope):
+            await convert(scope, receive, send)
+        else:
+            body = io.BufferedReader(ReceiveStream(receive, asyncio.get_running_loop()))
+            await run_wsgi(flask_app, wsgi_environ(scope, body), send)
@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+"""
+Load-testing harness for the conversion service.
+
+Starts the app under gunicorn for every combination of worker count and
+worker class, replays a corpus of conversion requests at fixed concurrency
+levels and reports throughput, p50/p95/p99 latency, error rate and the
+resident memory of the gunicorn workers. Results are written as JSON (and
+optionally CSV) and can be compared against an earlier run to catch
+regressions.
+
+The corpus is either a JSONL file (objects with ``markdown``, ``title`` and
+``author`` fields, or ``title``/``body`` pairs such as ``requests.jsonl``), a
+directory of ``.md`` files, or generated documents of the given sizes.
+
+The worker class ``asgi`` runs the asyncio server (``asgi:app``) under
+uvicorn's gunicorn worker.
+
+Usage:
+    python bench_load.py --corpus requests.jsonl --workers 1,2,4 --concurrency 1,8,32
+    python bench_load.py --sizes 4k,256k,2m --worker-class sync,gthread,asgi --output run.json
+    python bench_load.py --sizes 64k --output new.json --baseline run.json --threshold 10
+    python bench_load.py --url http://localhost:8088 --sizes 64k --concurrency 4
+"""
+
+import argparse
+import csv
+import http.client
+import json
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PARAGRAPH = (
+    "It was a bright cold day in April, and the clocks were striking thirteen. "
+    "Winston Smith, his chin nuzzled into his breast in an effort to escape the vile wind, "
+    "slipped quickly through the glass doors of Victory Mansions.\n\n"
+)
+SECTION = (
+    "## Section\n\n" + PARAGRAPH * 3 +
+    "- first point with *emphasis*\n- second point with a [link](https://example.com)\n\n" +
+    PARAGRAPH
+)
+
+# Settings that would make repeated requests measure something else than the pipeline
+DEFAULT_SERVER_ENV = {
+    'CACHE_ENABLED': 'False',
+}
+
+# Worker class shorthand for the asyncio server mode
+ASGI_WORKER_CLASS = 'uvicorn.workers.UvicornWorker'
+
+
+def parse_size(text):
+    """Parse '64k', '2m' or '1000' into a number of bytes."""
+    text = text.strip().lower()
+    units = {'k': 1024, 'm': 1024 * 1024}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def parse_list(text, convert=str):
+    return [convert(item) for item in text.split(',') if item.strip()]
+
+
+def generate_document(size):
+    """Markdown of roughly size bytes, split into chapters of about 32 KB."""
+    chapters = []
+    total = 0
+    number = 1
+    while total < size:
+        chapter = f"# Chapter {number}\n\n" + PARAGRAPH
+        while len(chapter) < 32 * 1024 and total + len(chapter) < size:
+            chapter += SECTION
+        chapters.append(chapter)
+        total += len(chapter)
+        number += 1
+    return ''.join(chapters)
+
+
+def load_corpus(args):
+    """Return a list of (name, JSON request body) pairs."""
+    corpus = []
+    if args.corpus and os.path.isdir(args.corpus):
+        for name in sorted(os.listdir(args.corpus)):
+            if name.endswith('.md'):
+                with open(os.path.join(args.corpus, name), 'r', encoding='utf-8') as f:
+                    corpus.append((name, {'markdown': f.read(), 'title': name[:-3], 'author': 'Benchmark'}))
+    elif args.corpus:
+        with open(args.corpus, 'r', encoding='utf-8') as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                if 'markdown' in item:
+                    body = {key: item[key] for key in ('markdown', 'title', 'author') if key in item}
+                else:
+                    title = item.get('title', f'Document {number}')
+                    body = {'markdown': f"# {title}\n\n{item.get('body', '')}\n", 'title': title, 'author': 'Benchmark'}
+                corpus.append((item.get('request_id', f'line-{number}'), body))
+    for size in parse_list(args.sizes or '', parse_size):
+        corpus.append((f'generated-{size}', {'markdown': generate_document(size), 'title': f'Generated {size}', 'author': 'Benchmark'}))
+    return corpus
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Server:
+    """A gunicorn instance of the app started for one benchmark configuration."""
+
+    def __init__(self, workers, worker_class, threads, env, timeout):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        cmd = [
+            sys.executable, '-m', 'gunicorn', 'asgi:app' if worker_class == 'asgi' else 'app:app',
+            '--bind', f"127.0.0.1:{self.port}",
+            '--workers', str(workers),
+            '--worker-class', ASGI_WORKER_CLASS if worker_class == 'asgi' else worker_class,
+            '--threads', str(threads),
+            '--timeout', str(timeout),
+            '--log-level', 'warning',
+        ]
+        server_env = dict(os.environ, **DEFAULT_SERVER_ENV, **env)
+        self.process = subprocess.Popen(cmd, cwd=APP_DIR, env=server_env,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def wait_ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"gunicorn exited with code {self.process.returncode}")
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=2)
+                conn.request('GET', '/status')
+                if conn.getresponse().status == 200:
+                    return
+            except OSError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError("gunicorn did not become ready")
+
+    def worker_pids(self):
+        return child_pids(self.process.pid)
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+
+def child_pids(parent):
+    """PIDs of the direct children of a process (Linux /proc only)."""
+    pids = []
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return pids
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as f:
+                # The command name may contain spaces; fields after it are fixed
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == parent:
+            pids.append(int(entry))
+    return pids
+
+
+def rss_bytes(pid):
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+class RssSampler(threading.Thread):
+    """Samples the summed RSS of the server's workers while a run is in progress."""
+
+    def __init__(self, pids_func, interval=0.25):
+        super().__init__(daemon=True)
+        self.pids_func = pids_func
+        self.interval = interval
+        self.samples = []
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            pids = self.pids_func()
+            if pids:
+                self.samples.append(sum(rss_bytes(pid) for pid in pids))
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class Client:
+    """One keep-alive connection per benchmark thread."""
+
+    def __init__(self, url, token, timeout):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.headers = {'Content-Type': 'application/json'}
+        if token:
+            self.headers['Authorization'] = f'Bearer {token}'
+        self._local = threading.local()
+
+    def post(self, path, body):
+        """Send one request; returns (status or None, latency in seconds)."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        start = time.perf_counter()
+        try:
+            conn.request('POST', self.prefix + path, body=body, headers=self.headers)
+            response = conn.getresponse()
+            response.read()
+            status = response.status
+            if response.getheader('Connection', '').lower() == 'close':
+                conn.close()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            self._local.conn = None
+            status = None
+        return status, time.perf_counter() - start
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(fraction * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def run_level(client, bodies, concurrency, total_requests, warmup):
+    """Replay bodies round-robin with concurrency threads; returns latency and status lists."""
+    def send(index):
+        return client.post('/convert', bodies[index % len(bodies)])
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, range(warmup)))
+        start = time.perf_counter()
+        results = list(pool.map(send, range(total_requests)))
+        elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+def summarize(config, results, elapsed, rss_samples):
+    latencies = sorted(latency for _, latency in results)
+    statuses = {}
+    for status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    errors = sum(count for status, count in statuses.items() if status == 'None' or not status.startswith('2'))
+
+    def ms(value):
+        return round(value * 1000, 2) if value is not None else None
+
+    return {
+        **config,
+        'requests': len(results),
+        'errors': errors,
+        'error_rate': round(errors / len(results), 4) if results else 0,
+        'statuses': statuses,
+        'duration_s': round(elapsed, 3),
+        'throughput_rps': round(len(results) / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            'mean': ms(sum(latencies) / len(latencies)) if latencies else None,
+            'p50': ms(percentile(latencies, 0.50)),
+            'p95': ms(percentile(latencies, 0.95)),
+            'p99': ms(percentile(latencies, 0.99)),
+            'max': ms(latencies[-1]) if latencies else None,
+        },
+        'worker_rss_mb': {
+            'peak': round(max(rss_samples) / 1024 / 1024, 1) if rss_samples else None,
+            'mean': round(sum(rss_samples) / len(rss_samples) / 1024 / 1024, 1) if rss_samples else None,
+        },
+    }
+
+
+def print_row(run):
+    latency = run['latency_ms']
+    rss = run['worker_rss_mb']['peak']
+    print(
+        f"{run['workers'] or '-':>7} {run['worker_class']:<8} {run['concurrency']:>5} {run['requests']:>6} "
+        f"{run['throughput_rps']:>9.2f} {latency['p50']:>9.1f} {latency['p95']:>9.1f} {latency['p99']:>9.1f} "
+        f"{run['error_rate'] * 100:>6.1f}% {rss if rss is not None else '-':>8}"
+    )
+
+
+def run_key(run):
+    return (run['workers'], run['worker_class'], run['concurrency'])
+
+
+def compare(runs, baseline_path, threshold):
+    """Print changes against a baseline result file; returns the number of regressions."""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = {run_key(run): run for run in json.load(f)['runs']}
+
+    print(f"\nComparison with {baseline_path} (regression threshold {threshold}%)")
+    regressions = 0
+    for run in runs:
+        old = baseline.get(run_key(run))
+        if old is None:
+            continue
+        changes = []
+        for label, new_value, old_value, higher_is_better in (
+            ('throughput', run['throughput_rps'], old['throughput_rps'], True),
+            ('p95', run['latency_ms']['p95'], old['latency_ms']['p95'], False),
+            ('p99', run['latency_ms']['p99'], old['latency_ms']['p99'], False),
+        ):
+            if not new_value or not old_value:
+                continue
+            change = (new_value - old_value) / old_value * 100
+            worse = -change if higher_is_better else change
+            flag = ' REGRESSION' if worse > threshold else ''
+            regressions += bool(flag)
+            changes.append(f"{label} {change:+.1f}%{flag}")
+        if run['error_rate'] > old['error_rate']:
+            regressions += 1
+            changes.append(f"error rate {old['error_rate']:.2%} -> {run['error_rate']:.2%} REGRESSION")
+        print(f"  workers={run['workers']} class={run['worker_class']} concurrency={run['concurrency']}: {', '.join(changes)}")
+    return regressions
+
+
+def write_csv(path, runs):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['workers', 'worker_class', 'threads', 'concurrency', 'requests', 'errors', 'error_rate',
+                         'throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'rss_peak_mb', 'rss_mean_mb'])
+        for run in runs:
+            latency = run['latency_ms']
+            writer.writerow([run['workers'], run['worker_class'], run['threads'], run['concurrency'], run['requests'],
+                             run['errors'], run['error_rate'], run['throughput_rps'], latency['p50'], latency['p95'],
+                             latency['p99'], latency['max'], run['worker_rss_mb']['peak'], run['worker_rss_mb']['mean']])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the Markdown to EPUB conversion service')
+    parser.add_argument('--corpus', help='JSONL file or directory of .md files to replay')
+    parser.add_argument('--sizes', help='Comma-separated sizes of generated documents, e.g. 4k,256k,2m')
+    parser.add_argument('--url', help='Benchmark an already running server instead of starting gunicorn')
+    parser.add_argument('--token', help='Authentication token for the server')
+    parser.add_argument('--workers', default='2', help='Comma-separated gunicorn worker counts (default: 2)')
+    parser.add_argument('--worker-class', default='sync', help='Comma-separated gunicorn worker classes (default: sync)')
+    parser.add_argument('--threads', type=int, default=4, help='Threads per worker for the gthread class (default: 4)')
+    parser.add_argument('--concurrency', default='1,4,16', help='Comma-separated client concurrency levels (default: 1,4,16)')
+    parser.add_argument('--requests', type=int, default=100, help='Measured requests per concurrency level (default: 100)')
+    parser.add_argument('--warmup', type=int, default=5, help='Unmeasured requests before each level (default: 5)')
+    parser.add_argument('--timeout', type=int, default=120, help='Request and gunicorn worker timeout in seconds (default: 120)')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='Environment variable for the started server; repeatable (the result cache is off unless CACHE_ENABLED=True)')
+    parser.add_argument('--output', default='bench_load_results.json', help='JSON result file (default: bench_load_results.json)')
+    parser.add_argument('--csv', help='Also write the results as CSV')
+    parser.add_argument('--baseline', help='Earlier JSON result file to compare against')
+    parser.add_argument('--threshold', type=float, default=10, help='Percent change counted as a regression (default: 10)')
+    args = parser.parse_args()
+
+    corpus = load_corpus(args)
+    if not corpus:
+        parser.error('no documents: pass --corpus and/or --sizes')
+    bodies = [json.dumps(body).encode('utf-8') for _, body in corpus]
+    print(f"Corpus: {len(corpus)} documents, {sum(len(b) for b in bodies) / 1024:.0f} KB of request bodies")
+
+    env = dict(item.split('=', 1) for item in args.env)
+    concurrency_levels = parse_list(args.concurrency, int)
+    if args.url:
+        configs = [(None, 'external')]
+    else:
+        configs = [(workers, worker_class) for workers in parse_list(args.workers, int)
+                   for worker_class in parse_list(args.worker_class)]
+
+    print(f"\n{'workers':>7} {'class':<8} {'conc':>5} {'reqs':>6} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} "
+          f"{'p99 ms':>9} {'errors':>7} {'RSS MB':>8}")
+    runs = []
+    for workers, worker_class in configs:
+        server = None
+        if args.url:
+            url, pids_func = args.url, lambda: []
+        else:
+            server = Server(workers, worker_class, args.threads, env, args.timeout)
+            try:
+                server.wait_ready()
+            except RuntimeError as e:
+                print(f"Skipping workers={workers} class={worker_class}: {str(e)}")
+                server.stop()
+                continue
+            url, pids_func = server.url, server.worker_pids
+
+        try:
+            client = Client(url, args.token, args.timeout)
+            for concurrency in concurrency_levels:
+                sampler = RssSampler(pids_func)
+                sampler.start()
+                results, elapsed = run_level(client, bodies, concurrency, args.requests, args.warmup)
+                sampler.stop()
+                config = {
+                    'workers': workers,
+                    'worker_class': worker_class,
+                    'threads': args.threads if worker_class == 'gthread' else 1,
+                    'concurrency': concurrency,
+                }
+                run = summarize(config, results, elapsed, sampler.samples)
+                runs.append(run)
+                print_row(run)
+        finally:
+            if server is not None:
+                server.stop()
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'host': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'corpus': [name for name, _ in corpus],
+        'server_env': {**DEFAULT_SERVER_ENV, **env},
+        'requests_per_level': args.requests,
+        'runs': runs,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+    if args.csv:
+        write_csv(args.csv, runs)
+        print(f"CSV written to {args.csv}")
+
+    regressions = compare(runs, args.baseline, args.threshold) if args.baseline else 0
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
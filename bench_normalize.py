@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for markdown normalization on multi-megabyte inputs.
+
+Compares the original multi-pass normalization with the single-pass
+normalizer, both on whole documents and fed in chunks as a request body
+would arrive, and checks that all three produce the same output.
+
+Usage:
+    python bench_normalize.py --size-mb 8 --repeat 5
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from markdown_normalizer import MarkdownNormalizer, normalize_markdown
+from test_markdown_normalizer import reference_normalize
+
+PARAGRAPH = (
+    "It was a \"bright\" cold day in April -- and the clocks were striking thirteen.\n"
+    "Winston Smith, his chin nuzzled into his breast, slipped quickly through the doors...\n\n"
+)
+SECTION = (
+    "# Chapter\n\n" + PARAGRAPH * 4 +
+    "## Notes\n" + PARAGRAPH +
+    "- first point\n- second point\n  - nested point\n* other list\n\n" +
+    PARAGRAPH * 2
+)
+
+
+def make_documents(size_bytes):
+    """Return (name, text) pairs of roughly size_bytes each."""
+    def repeat(unit):
+        return unit * max(1, size_bytes // len(unit))
+
+    return [
+        ('prose', repeat(PARAGRAPH)),
+        ('mixed', repeat(SECTION)),
+        ('crlf', repeat(SECTION.replace('\n', '\r\n'))),
+        ('escaped', repeat(SECTION.replace('\n\n', '\\n\\n'))),
+        ('list-heavy', repeat("- a short list item\n")),
+    ]
+
+
+def normalize_chunked(text, chunk_size):
+    normalizer = MarkdownNormalizer()
+    parts = [normalizer.feed(text[i:i + chunk_size]) for i in range(0, len(text), chunk_size)]
+    parts.append(normalizer.close())
+    return ''.join(parts)
+
+
+def best_time(func, text, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark markdown normalization')
+    parser.add_argument('--size-mb', type=float, default=4, help='Approximate size of each document in MB')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per measurement; the best is reported')
+    parser.add_argument('--chunk-kb', type=int, default=64, help='Chunk size for incremental normalization')
+    args = parser.parse_args()
+
+    size_bytes = int(args.size_mb * 1024 * 1024)
+    chunk_size = args.chunk_kb * 1024
+    print(f"{'document':<12} {'size':>8} {'multi-pass':>12} {'single-pass':>12} {'chunked':>12} {'speedup':>8}")
+
+    mismatches = 0
+    for name, text in make_documents(size_bytes):
+        reference_time, expected = best_time(reference_normalize, text, args.repeat)
+        single_time, single = best_time(normalize_markdown, text, args.repeat)
+        chunked_time, chunked = best_time(lambda t: normalize_chunked(t, chunk_size), text, args.repeat)
+        ok = single == expected and chunked == expected
+        mismatches += not ok
+        print(
+            f"{name:<12} {len(text) / 1024 / 1024:>6.1f}MB "
+            f"{reference_time * 1000:>10.1f}ms {single_time * 1000:>10.1f}ms {chunked_time * 1000:>10.1f}ms "
+            f"{reference_time / single_time:>7.2f}x{'' if ok else '  OUTPUT MISMATCH'}"
+        )
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
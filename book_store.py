@@ -0,0 +1,114 @@
+"""
+File-backed storage for multi-chapter books.
+
+Each book lives in its own directory under the store root:
+
+- ``book.json``: metadata and the ordered chapter list
+- ``chapters/<chapter_id>.xhtml``: the converted XHTML body of each chapter
+- ``book.epub``: the last assembled EPUB, rebuilt when the book changes
+
+Writers take an exclusive ``flock`` on the book's lock file, so chapter
+updates arriving at different gunicorn workers do not overwrite each other.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+ID_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def valid_id(value):
+    """Whether ``value`` can be used as a book or chapter id."""
+    return isinstance(value, str) and bool(ID_RE.match(value))
+
+
+class BookStore:
+    """Reads and writes books, their chapters and assembled EPUBs."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _book_dir(self, book_id):
+        return os.path.join(self.directory, book_id)
+
+    def chapter_path(self, book_id, chapter_id):
+        return os.path.join(self._book_dir(book_id), 'chapters', f"{chapter_id}.xhtml")
+
+    def epub_path(self, book_id):
+        return os.path.join(self._book_dir(book_id), 'book.epub')
+
+    @contextmanager
+    def lock(self, book_id):
+        """Hold an exclusive lock on a book for the duration of the block."""
+        os.makedirs(os.path.join(self._book_dir(book_id), 'chapters'), exist_ok=True)
+        with open(os.path.join(self._book_dir(book_id), '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write_atomic(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def load(self, book_id):
+        """Return the book record, or None if the book does not exist."""
+        try:
+            with open(os.path.join(self._book_dir(book_id), 'book.json'), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, book):
+        book['updated_at'] = time.time()
+        path = os.path.join(self._book_dir(book['book_id']), 'book.json')
+        self._write_atomic(path, json.dumps(book, indent=2).encode('utf-8'))
+
+    def new_book(self, book_id, title, author):
+        now = time.time()
+        return {
+            'book_id': book_id,
+            'identifier': f"urn:uuid:{uuid.uuid4()}",
+            'title': title,
+            'author': author,
+            'created_at': now,
+            'updated_at': now,
+            'chapters': [],
+        }
+
+    def read_chapter(self, book_id, chapter_id):
+        with open(self.chapter_path(book_id, chapter_id), 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def write_chapter(self, book_id, chapter_id, body):
+        self._write_atomic(self.chapter_path(book_id, chapter_id), body.encode('utf-8'))
+
+    def delete_chapter(self, book_id, chapter_id):
+        try:
+            os.remove(self.chapter_path(book_id, chapter_id))
+        except FileNotFoundError:
+            pass
+
+    def epub_is_current(self, book):
+        """Whether the stored EPUB was assembled after the last change to the book."""
+        try:
+            return os.path.getmtime(self.epub_path(book['book_id'])) >= book['updated_at']
+        except FileNotFoundError:
+            return False
+
+    def delete(self, book_id):
+        shutil.rmtree(self._book_dir(book_id), ignore_errors=True)
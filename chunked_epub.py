@@ -0,0 +1,251 @@
+"""
+Splitting of large manuscripts for parallel conversion, and merging of the results.
+
+A long document is cut at its level-1 headings (where pandoc's EPUB writer
+starts a new chapter anyway) into chunks of similar size that can be converted
+to XHTML independently. Because the chunks are converted separately, the
+document-wide parts of markdown are handled here:
+
+- Link reference definitions are copied into every chunk, and footnote
+  definitions into the chunks that reference them, so ``[text][ref]`` and
+  ``[^note]`` resolve wherever the definition is in the manuscript.
+- Footnotes are renumbered so that numbering continues across chunks.
+- Identifiers that occur in more than one chunk are made unique, and links to
+  an identifier in another chapter file point to that file, so internal
+  cross-references keep working after the split into chapters.
+
+The merged chapters carry their headings, from which epub_writer builds the
+global table of contents.
+"""
+
+import re
+
+from epub_writer import Chapter, extract_headings
+
+ATX_H1_RE = re.compile(r'^#[ \t]+\S')
+SETEXT_H1_RE = re.compile(r'^ {0,3}=+[ \t]*$')
+FENCE_RE = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+DEFINITION_RE = re.compile(r'^ {0,3}\[(\^?)([^\]\n]+)\]:')
+FOOTNOTE_REF_RE = re.compile(r'\[\^([^\]\s]+)\](?!:)')
+
+# Markdown images are embedded by pandoc's EPUB writer but not by this path
+IMAGE_RE = re.compile(r'!\[|<img\b', re.IGNORECASE)
+
+# pandoc's footnote markup in HTML output
+NOTE_ID_RE = re.compile(r'\b(id|href)="(#?)(fn|fnref)(\d+)"')
+NOTE_MARKER_RE = re.compile(r'(<a\b[^>]*\bclass="footnote-ref"[^>]*>\s*<sup>)(\d+)(</sup>)')
+NOTES_LIST_RE = re.compile(r'(<section\b[^>]*\bclass="footnotes[^"]*"[^>]*>.*?)<ol\b[^>]*>(\s*<li\b[^>]*\bid="fn(\d+)")',
+                           re.DOTALL)
+H1_START_RE = re.compile(r'<h1[\s>]')
+ID_RE = re.compile(r'\bid="([^"]+)"')
+LOCAL_HREF_RE = re.compile(r'\bhref="#([^"]+)"')
+
+
+def has_images(markdown):
+    """Whether markdown references images, which only the pandoc EPUB writer embeds."""
+    return IMAGE_RE.search(markdown) is not None
+
+
+def _definition_blocks(lines):
+    """
+    Find reference and footnote definitions outside code.
+
+    Returns (body_lines, link_definitions, footnotes) where link_definitions is
+    a list of lines and footnotes maps labels to their definition text.
+    """
+    body = []
+    links = []
+    footnotes = {}
+    fence = None
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        fence_match = FENCE_RE.match(line)
+        if fence is not None:
+            if fence_match and fence_match.group(1)[0] == fence[0] and len(fence_match.group(1)) >= len(fence):
+                fence = None
+            body.append(line)
+            i += 1
+            continue
+        if fence_match:
+            fence = fence_match.group(1)
+            body.append(line)
+            i += 1
+            continue
+
+        match = DEFINITION_RE.match(line)
+        if match is None or (i > 0 and lines[i - 1].strip() and not DEFINITION_RE.match(lines[i - 1])):
+            body.append(line)
+            i += 1
+            continue
+
+        # A definition runs to the next blank line, and on through indented blocks
+        end = i + 1
+        while end < len(lines):
+            if lines[end].strip():
+                if DEFINITION_RE.match(lines[end]):
+                    break
+                end += 1
+                continue
+            following = next((line for line in lines[end:] if line.strip()), None)
+            if following is None or not following.startswith(('    ', '\t')) or not match.group(1):
+                break
+            end += 1
+        block = lines[i:end]
+        if match.group(1):
+            footnotes[match.group(2)] = '\n'.join(block)
+        else:
+            links.extend(block)
+        body.append('')
+        i = end
+    return body, links, footnotes
+
+
+def split_definitions(markdown):
+    """
+    Take reference and footnote definitions out of markdown.
+
+    Returns (lines, link_definitions, footnotes) where lines are the lines of
+    markdown with a blank line in place of each definition; see _definition_blocks.
+    """
+    return _definition_blocks(markdown.split('\n'))
+
+
+def split_sections(markdown):
+    """
+    Split markdown before every level-1 heading outside of code blocks.
+
+    Returns (sections, link_definitions, footnotes); see split_definitions.
+    Text before the first heading is a section of its own.
+    """
+    lines, links, footnotes = split_definitions(markdown)
+    starts = [0]
+    fence = None
+    for index, line in enumerate(lines):
+        fence_match = FENCE_RE.match(line)
+        if fence is not None:
+            if fence_match and fence_match.group(1)[0] == fence[0] and len(fence_match.group(1)) >= len(fence):
+                fence = None
+            continue
+        if fence_match:
+            fence = fence_match.group(1)
+        elif ATX_H1_RE.match(line) and (index == 0 or not lines[index - 1].strip()):
+            starts.append(index)
+        elif (SETEXT_H1_RE.match(line) and index >= 1 and lines[index - 1].strip()
+              and (index == 1 or not lines[index - 2].strip())):
+            starts.append(index - 1)
+    starts = sorted(set(starts))
+    sections = ['\n'.join(lines[start:end]) for start, end in zip(starts, starts[1:] + [len(lines)])]
+    return [section for section in sections if section.strip()], links, footnotes
+
+
+def make_chunks(markdown, target_size):
+    """
+    Cut markdown into chunks of about target_size characters at level-1 headings.
+
+    Every chunk carries the link definitions of the whole document and the
+    footnote definitions it references. Returns a list of markdown strings.
+    """
+    sections, links, footnotes = split_sections(markdown)
+    groups = []
+    size = 0
+    for section in sections:
+        if groups and size + len(section) <= target_size:
+            groups[-1].append(section)
+            size += len(section)
+        else:
+            groups.append([section])
+            size = len(section)
+
+    chunks = []
+    for group in groups:
+        text = '\n'.join(group)
+        labels = dict.fromkeys(FOOTNOTE_REF_RE.findall(text))
+        definitions = [footnotes[label] for label in labels if label in footnotes] + (['\n'.join(links)] if links else [])
+        chunks.append('\n\n'.join([text] + definitions) + '\n')
+    return chunks
+
+
+def renumber_footnotes(fragment, offset):
+    """
+    Shift the footnote numbers of a chunk's HTML by offset.
+
+    Returns (fragment, count) where count is the highest footnote number the
+    chunk used before shifting.
+    """
+    numbers = [int(n) for kind, _, _, n in NOTE_ID_RE.findall(fragment)]
+    count = max(numbers, default=0)
+    if offset == 0 or count == 0:
+        return fragment, count
+
+    fragment = NOTE_ID_RE.sub(lambda m: f'{m.group(1)}="{m.group(2)}{m.group(3)}{int(m.group(4)) + offset}"', fragment)
+    fragment = NOTE_MARKER_RE.sub(lambda m: f'{m.group(1)}{int(m.group(2)) + offset}{m.group(3)}', fragment)
+    # Lists of notes start at their first (already shifted) note
+    fragment = NOTES_LIST_RE.sub(lambda m: f'{m.group(1)}<ol start="{m.group(3)}">{m.group(2)}', fragment)
+    return fragment, count
+
+
+def split_chapters(fragment):
+    """Split a chunk's HTML before each level-1 heading, as pandoc splits EPUB chapters."""
+    starts = [match.start() for match in H1_START_RE.finditer(fragment)]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    parts = [fragment[start:end] for start, end in zip(starts, starts[1:] + [len(fragment)])]
+    return [part for part in parts if part.strip()]
+
+
+def link_chapters(bodies, names):
+    """
+    Make identifiers unique across chapter bodies and point links at the file defining their target.
+
+    The first chapter to define an identifier keeps it; later ones get a
+    numbered suffix, as pandoc does within one document.
+    """
+    owners = {}
+
+    def unique_ids(name, body):
+        def rename(match):
+            identifier = candidate = match.group(1)
+            suffix = 0
+            while candidate in owners:
+                suffix += 1
+                candidate = f"{identifier}-{suffix}"
+            owners[candidate] = name
+            return f'id="{candidate}"'
+        return ID_RE.sub(rename, body)
+
+    bodies = [unique_ids(name, body) for name, body in zip(names, bodies)]
+
+    def relink(name, body):
+        def target(match):
+            owner = owners.get(match.group(1))
+            if owner is None or owner == name:
+                return match.group(0)
+            return f'href="{owner}#{match.group(1)}"'
+        return LOCAL_HREF_RE.sub(target, body)
+
+    return [relink(name, body) for name, body in zip(names, bodies)]
+
+
+def merge_fragments(fragments, title):
+    """
+    Merge the HTML of consecutive chunks into EPUB chapters.
+
+    title names a chapter without a level-1 heading (text before the first
+    one). Returns a list of Chapters with continuous footnote numbers and
+    working cross-references.
+    """
+    bodies = []
+    offset = 0
+    for fragment in fragments:
+        fragment, count = renumber_footnotes(fragment, offset)
+        offset += count
+        bodies.extend(split_chapters(fragment))
+
+    names = [f"ch{index + 1:03d}.xhtml" for index in range(len(bodies))]
+    chapters = []
+    for name, body in zip(names, link_chapters(bodies, names)):
+        headings = extract_headings(body)
+        chapter_title = headings[0][2] if headings and headings[0][0] == 1 and headings[0][2] else title
+        chapters.append(Chapter(name, chapter_title, body, headings))
+    return chapters
@@ -0,0 +1,202 @@
+"""
+Named conversion profiles.
+
+A profile bundles everything about a conversion that does not come from the
+request: markdown reader extensions, table of contents settings, a stylesheet,
+an XHTML template and default metadata. Profiles are read from a YAML file
+once per worker and compiled there, so a request only merges its title and
+author into a prepared argument list and metadata block::
+
+    novel:
+      description: Fiction with a shallow table of contents
+      toc_depth: 1
+      css: styles/novel.css
+      metadata:
+        rights: All rights reserved
+
+``reader_extensions`` (e.g. ``-hard_line_breaks+footnotes``) is appended to
+the server's markdown reader format. ``css`` and ``template`` paths are
+relative to the profiles file. The ``default`` profile, used when a request
+names none, always exists and may be redefined in the file.
+"""
+
+import hashlib
+import logging
+import os
+import re
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROFILE = 'default'
+
+PROFILE_NAME_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+PROFILE_FIELDS = ('description', 'reader_extensions', 'toc', 'toc_depth', 'css', 'template', 'metadata')
+EXTENSIONS_RE = re.compile(r'^(?:[+-][a-z0-9_]+)*$')
+
+# pandoc writers whose output is an EPUB
+EPUB_WRITERS = ('epub3', 'epub2')
+
+# Metadata that always comes from the request
+REQUEST_METADATA = ('title', 'author')
+
+
+class ProfileError(Exception):
+    """A profile definition is invalid."""
+
+
+def dump_yaml(data):
+    return yaml.dump(data, default_flow_style=False, allow_unicode=True, sort_keys=False) if data else ''
+
+
+class Profile:
+    """A compiled conversion profile."""
+
+    def __init__(self, name, reader_format, base_metadata, description='', reader_extensions='', toc=True,
+                 toc_depth=3, css=None, template=None, metadata=None):
+        """
+        base_metadata holds the server-wide metadata defaults, which the
+        profile's metadata extends. Raises ProfileError for invalid settings
+        and unreadable files.
+        """
+        if not isinstance(reader_extensions, str) or not EXTENSIONS_RE.match(reader_extensions):
+            raise ProfileError(f"reader_extensions must look like '+ext-other', got {reader_extensions!r}")
+        if not isinstance(toc, bool):
+            raise ProfileError("toc must be true or false")
+        if not isinstance(toc_depth, int) or isinstance(toc_depth, bool) or not 1 <= toc_depth <= 6:
+            raise ProfileError("toc_depth must be a number from 1 to 6")
+        metadata = metadata or {}
+        if not isinstance(metadata, dict) or not all(isinstance(value, str) for value in metadata.values()):
+            raise ProfileError("metadata must map names to strings")
+        if any(key in metadata for key in REQUEST_METADATA):
+            raise ProfileError(f"metadata cannot set {' or '.join(REQUEST_METADATA)}; they come from the request")
+
+        self.name = name
+        self.description = description
+        self.reader_format = reader_format + reader_extensions
+        self.toc = toc
+        self.toc_depth = toc_depth
+        self.css = css
+        self.template = template
+        self.metadata = {key: value for key, value in {**base_metadata, **metadata}.items() if value}
+
+        # Compiled once: the options and metadata block that do not depend on the request
+        self._options = ['-t', 'epub3', '-f', self.reader_format]
+        if toc:
+            self._options += ['--toc', f'--toc-depth={toc_depth}']
+        self._options += ['--wrap=none', '--preserve-tabs', '--shift-heading-level-by=0']
+        hasher = hashlib.sha256()
+        self.stylesheet = None
+        self._file_options = {}
+        for option, path in (('--css', css), ('--template', template)):
+            if path is not None:
+                try:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                except OSError as e:
+                    raise ProfileError(f"Cannot read {option[2:]} file: {e}")
+                hasher.update(data)
+                if option == '--css':
+                    self.stylesheet = data.decode('utf-8', errors='replace')
+                self._options.append(f'{option}={path}')
+                self._file_options[option] = f'{option}={path}'
+        self._metadata_yaml = dump_yaml(self.metadata)
+
+        # Reading and writing as separate steps, for documents parsed once into pandoc's JSON AST
+        self.parse_options = ['-f', self.reader_format, '-t', 'json', '--preserve-tabs']
+        self._toc_options = ['--toc', f'--toc-depth={toc_depth}'] if toc else []
+
+        # Changes to the stylesheet or template must change the result cache key
+        self.files_digest = hasher.hexdigest() if css is not None or template is not None else None
+        # The native engine implements the default reader format, stylesheet and
+        # template only, and the pandoc server engine does not take files
+        self.native = not reader_extensions and css is None and template is None and toc
+        self.pandoc_server = css is None and template is None
+        # Parallel conversion assembles the book itself: it has no templates and always has a TOC
+        self.chunked = template is None and toc
+
+    def build_metadata(self, title, author):
+        """The metadata of a conversion: the request's title and author and the profile defaults."""
+        return {'title': title, 'author': author, **self.metadata}
+
+    def pandoc_options(self, title, author):
+        """The pandoc options that follow the input and output paths."""
+        # Title and author are also passed directly, for backwards compatibility
+        return self._options + ['--metadata', f'title={title}', '--metadata', f'author={author}']
+
+    def writer_options(self, writer, title, author):
+        """
+        The pandoc options rendering a parsed document (see parse_options) with writer.
+
+        The stylesheet applies to EPUB output and to HTML output, which embeds
+        it, and the template (an EPUB template) to EPUB output only.
+        """
+        options = ['-f', 'json', '-t', writer] + self._toc_options + ['--wrap=none']
+        if writer in EPUB_WRITERS:
+            options += list(self._file_options.values())
+        elif writer == 'html5':
+            options += ['--embed-resources'] + ([self._file_options['--css']] if '--css' in self._file_options else [])
+        return options + ['--metadata', f'title={title}', '--metadata', f'author={author}']
+
+    def metadata_document(self, metadata):
+        """The YAML metadata block for metadata from build_metadata(); only request fields are dumped."""
+        request_fields = {key: value for key, value in metadata.items() if key not in self.metadata}
+        return '---\n' + dump_yaml(request_fields) + self._metadata_yaml + '---\n'
+
+    def describe(self):
+        """Public description of the profile for the /profiles endpoint."""
+        return {
+            'name': self.name,
+            'description': self.description,
+            'reader_format': self.reader_format,
+            'toc': self.toc,
+            'toc_depth': self.toc_depth,
+            'css': os.path.basename(self.css) if self.css else None,
+            'template': os.path.basename(self.template) if self.template else None,
+            'metadata': self.metadata,
+        }
+
+
+def load_profiles(path, reader_format, base_metadata):
+    """
+    Compile the profiles defined in the YAML file at path.
+
+    Returns a dict of names to Profiles that always contains DEFAULT_PROFILE.
+    A missing file defines no further profiles; invalid profiles are logged
+    and skipped so that one bad entry does not take the server down.
+    """
+    profiles = {DEFAULT_PROFILE: Profile(DEFAULT_PROFILE, reader_format, base_metadata,
+                                         description='Server defaults')}
+    if not path or not os.path.exists(path):
+        return profiles
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            definitions = yaml.safe_load(f) or {}
+    except (OSError, yaml.YAMLError) as e:
+        logger.error("Could not read conversion profiles from %s: %s", path, e)
+        return profiles
+    if not isinstance(definitions, dict):
+        logger.error("Conversion profiles file %s must map profile names to settings", path)
+        return profiles
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    for name, settings in definitions.items():
+        try:
+            if not isinstance(name, str) or not PROFILE_NAME_RE.match(name):
+                raise ProfileError("names may use letters, digits, '_' and '-' (up to 64 characters)")
+            settings = settings or {}
+            if not isinstance(settings, dict):
+                raise ProfileError("settings must be a mapping")
+            unknown = set(settings) - set(PROFILE_FIELDS)
+            if unknown:
+                raise ProfileError(f"unknown settings: {', '.join(sorted(map(str, unknown)))}")
+            settings = dict(settings)
+            for field in ('css', 'template'):
+                if settings.get(field) is not None:
+                    settings[field] = os.path.join(base_dir, str(settings[field]))
+            profiles[name] = Profile(name, reader_format, base_metadata, **settings)
+        except ProfileError as e:
+            logger.error("Skipping conversion profile %r: %s", name, e)
+    logger.info("Loaded conversion profiles: %s", ', '.join(profiles))
+    return profiles
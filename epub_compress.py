@@ -0,0 +1,198 @@
+"""
+Recompression of generated EPUB containers.
+
+Rewrites an EPUB at a chosen size/speed trade-off:
+
+- ``fast``: text entries deflated at level 1, media stored
+- ``balanced``: text entries deflated at level 6, media stored
+- ``smallest``: everything deflated at level 9 where that helps, XHTML, CSS
+  and package documents minified, and byte-identical resources (images,
+  fonts, stylesheets) stored once with references rewritten
+
+The ``mimetype`` entry always stays first and uncompressed. The result is
+written to a new file, so files hard-linked elsewhere (e.g. into the result
+cache) are never modified.
+"""
+
+import hashlib
+import logging
+import os
+import posixpath
+import re
+import zipfile
+import zlib
+
+logger = logging.getLogger(__name__)
+
+COMPRESSION_MODES = ('off', 'fast', 'balanced', 'smallest')
+
+MODE_LEVELS = {'fast': 1, 'balanced': 6, 'smallest': 9}
+
+# Formats that are already compressed; deflating them again costs time for no gain
+COMPRESSED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.woff', '.woff2',
+                         '.mp3', '.mp4', '.m4a', '.ogg', '.zip')
+XHTML_EXTENSIONS = ('.xhtml', '.html', '.htm')
+XML_EXTENSIONS = ('.opf', '.ncx')
+CSS_EXTENSIONS = ('.css',)
+TEXT_EXTENSIONS = XHTML_EXTENSIONS + XML_EXTENSIONS + CSS_EXTENSIONS
+
+# Elements whose whitespace is significant (pandoc styles code as pre-wrap)
+PRESERVE_RE = re.compile(r'(<(pre|code|textarea|script|style)\b.*?</\2\s*>)', re.DOTALL | re.IGNORECASE)
+WHITESPACE_RE = re.compile(r'[ \t\r\n]+')
+BETWEEN_TAGS_RE = re.compile(r'>[ \t\r\n]+<')
+CSS_TOKEN_RE = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')|/\*.*?\*/|[ \t\r\n]+', re.DOTALL)
+CSS_PUNCTUATION_RE = re.compile(r' ?([{};,]) ?')
+OPF_ITEM_RE = r'<item\b[^>]*\bhref="{href}"[^>]*/>[ \t\r\n]*'
+OPF_ID_RE = re.compile(r'\bid="([^"]*)"')
+
+
+def _extension(name):
+    return posixpath.splitext(name)[1].lower()
+
+
+def minify_xhtml(text):
+    """Collapse whitespace runs outside of whitespace-sensitive elements."""
+    parts = PRESERVE_RE.split(text)
+    out = []
+    # split() yields text, preserved element, tag name, text, ...
+    for index in range(0, len(parts), 3):
+        out.append(WHITESPACE_RE.sub(' ', parts[index]))
+        if index + 1 < len(parts):
+            out.append(parts[index + 1])
+    return ''.join(out)
+
+
+def minify_xml(text):
+    """Drop whitespace-only text between the tags of a package or NCX document."""
+    return BETWEEN_TAGS_RE.sub('><', text).strip()
+
+
+def minify_css(text):
+    """Remove comments and redundant whitespace from a stylesheet, leaving strings alone."""
+    def token(match):
+        if match.group(1) is not None:
+            return match.group(1)
+        return '' if match.group(0).startswith('/*') else ' '
+    parts = re.split(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')', CSS_TOKEN_RE.sub(token, text))
+    for index in range(0, len(parts), 2):
+        parts[index] = CSS_PUNCTUATION_RE.sub(r'\1', parts[index])
+    return ''.join(parts).strip()
+
+
+def _minify(name, text):
+    ext = _extension(name)
+    if ext in XHTML_EXTENSIONS:
+        return minify_xhtml(text)
+    if ext in XML_EXTENSIONS:
+        return minify_xml(text)
+    return minify_css(text)
+
+
+def _reference_re(path):
+    # A relative reference inside an attribute value or a CSS url()
+    return re.compile(r'(?<=["\'(])' + re.escape(path) + r'(?=["\')#?])')
+
+
+def _deduplicate(names, read, texts):
+    """
+    Find byte-identical resources and point every reference at one copy.
+
+    Rewrites ``texts`` (name -> document text) in place and returns the set of
+    entry names that are no longer needed. A duplicate is only dropped when no
+    reference to it is left that the rewrite did not understand.
+    """
+    first_by_digest = {}
+    duplicates = {}
+    for name in names:
+        if name == 'mimetype' or name.startswith('META-INF/') or _extension(name) in XHTML_EXTENSIONS + XML_EXTENSIONS:
+            continue
+        digest = hashlib.sha256(read(name)).digest()
+        if digest in first_by_digest:
+            duplicates[name] = first_by_digest[digest]
+        else:
+            first_by_digest[digest] = name
+
+    removed = set()
+    for duplicate, original in duplicates.items():
+        rewritten = {}
+        for doc_name, text in texts.items():
+            base = posixpath.dirname(doc_name)
+            old = posixpath.relpath(duplicate, base)
+            if _extension(doc_name) == '.opf':
+                item = re.search(OPF_ITEM_RE.format(href=re.escape(old)), text)
+                if item is not None:
+                    text = text[:item.start()] + text[item.end():]
+                    item_id = OPF_ID_RE.search(item.group(0))
+                    if item_id is not None and f'"{item_id.group(1)}"' in text:
+                        # The item is referenced by id (cover, fallback); keep it
+                        break
+            else:
+                text = _reference_re(old).sub(posixpath.relpath(original, base), text)
+            if posixpath.basename(duplicate) in text and posixpath.basename(duplicate) != posixpath.basename(original):
+                break
+            rewritten[doc_name] = text
+        else:
+            texts.update(rewritten)
+            removed.add(duplicate)
+    return removed
+
+
+def _deflate_helps(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return len(compressor.compress(data)) + len(compressor.flush()) < len(data)
+
+
+def recompress_epub(source_path, target_path, mode):
+    """
+    Write a recompressed copy of the EPUB at ``source_path`` to ``target_path``.
+
+    Returns a dict with the 'original_size' and 'compressed_size' in bytes and
+    the number of 'duplicates_removed'.
+    """
+    level = MODE_LEVELS[mode]
+    smallest = mode == 'smallest'
+
+    with zipfile.ZipFile(source_path) as src:
+        infos = [info for info in src.infolist() if not info.is_dir()]
+        names = [info.filename for info in infos]
+
+        texts = {}
+        if smallest:
+            for name in names:
+                if _extension(name) in TEXT_EXTENSIONS:
+                    texts[name] = src.read(name).decode('utf-8')
+        removed = _deduplicate(names, src.read, texts) if smallest else set()
+
+        with zipfile.ZipFile(target_path, 'w') as dst:
+            # The mimetype entry must come first and be stored uncompressed
+            mimetype = zipfile.ZipInfo('mimetype', date_time=src.getinfo('mimetype').date_time)
+            mimetype.compress_type = zipfile.ZIP_STORED
+            dst.writestr(mimetype, src.read('mimetype'))
+
+            for info in infos:
+                name = info.filename
+                if name == 'mimetype' or name in removed:
+                    continue
+                if name in texts:
+                    data = _minify(name, texts[name]).encode('utf-8')
+                else:
+                    data = src.read(name)
+
+                entry = zipfile.ZipInfo(name, date_time=info.date_time)
+                entry.external_attr = info.external_attr
+                if _extension(name) not in COMPRESSED_EXTENSIONS:
+                    entry.compress_type = zipfile.ZIP_DEFLATED
+                elif smallest and _deflate_helps(data, level):
+                    entry.compress_type = zipfile.ZIP_DEFLATED
+                else:
+                    entry.compress_type = zipfile.ZIP_STORED
+                dst.writestr(entry, data, compresslevel=level)
+
+    stats = {
+        'original_size': os.path.getsize(source_path),
+        'compressed_size': os.path.getsize(target_path),
+        'duplicates_removed': len(removed),
+    }
+    logger.debug("Recompressed EPUB (%s): %s -> %s bytes, %s duplicate resources removed",
+                 mode, stats['original_size'], stats['compressed_size'], len(removed))
+    return stats
@@ -0,0 +1,149 @@
+"""
+In-process structural validation of generated EPUB files.
+
+Reads the zip directory, ``META-INF/container.xml`` and the OPF package
+document instead of running pandoc a second time. Two levels are available:
+
+- ``fast``: zip directory, ``mimetype`` entry, container and OPF metadata
+- ``full``: additionally resolves manifest and spine references and checks
+  the CRC of every entry
+"""
+
+import logging
+import posixpath
+import time
+import zipfile
+import xml.etree.ElementTree as ET
+from urllib.parse import unquote, urlsplit
+
+logger = logging.getLogger(__name__)
+
+VERIFY_MODES = ('off', 'fast', 'full')
+
+EPUB_MIMETYPE = b'application/epub+zip'
+
+CONTAINER_NS = {'c': 'urn:oasis:names:tc:opendocument:xmlns:container'}
+OPF_NS = {
+    'opf': 'http://www.idpf.org/2007/opf',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+}
+
+
+class EpubReport:
+    """Outcome of an inspection: fatal errors, non-fatal warnings and facts found."""
+
+    def __init__(self):
+        self.errors = []
+        self.warnings = []
+        self.files = []
+        self.titles = []
+        self.creators = []
+        self.timings = {}   # seconds spent in optional checks, e.g. 'zip_check'
+
+    @property
+    def ok(self):
+        return not self.errors
+
+
+def _text_values(root, path):
+    return [el.text.strip() for el in root.findall(path, OPF_NS) if el.text and el.text.strip()]
+
+
+def _check_metadata(report, opf_root, expected_title, expected_author):
+    report.titles = _text_values(opf_root, 'opf:metadata/dc:title')
+    report.creators = _text_values(opf_root, 'opf:metadata/dc:creator')
+
+    if not report.titles:
+        report.warnings.append("OPF has no dc:title")
+    elif expected_title and not any(expected_title.lower() in t.lower() for t in report.titles):
+        report.warnings.append(f"Title '{expected_title}' not found in dc:title")
+
+    if not report.creators:
+        report.warnings.append("OPF has no dc:creator")
+    elif expected_author and not any(expected_author.lower() in c.lower() for c in report.creators):
+        report.warnings.append(f"Author '{expected_author}' not found in dc:creator")
+
+
+def _check_references(report, opf_root, opf_path, names):
+    opf_dir = posixpath.dirname(opf_path)
+    manifest_ids = set()
+
+    for item in opf_root.findall('opf:manifest/opf:item', OPF_NS):
+        item_id = item.get('id')
+        href = item.get('href')
+        if item_id:
+            manifest_ids.add(item_id)
+        if not href:
+            report.errors.append(f"Manifest item '{item_id}' has no href")
+            continue
+        parts = urlsplit(href)
+        if parts.scheme or parts.netloc:
+            # Remote resources are not part of the container
+            continue
+        target = posixpath.normpath(posixpath.join(opf_dir, unquote(parts.path)))
+        if target not in names:
+            report.errors.append(f"Manifest item '{item_id}' references missing file {target}")
+
+    for itemref in opf_root.findall('opf:spine/opf:itemref', OPF_NS):
+        if itemref.get('idref') not in manifest_ids:
+            report.errors.append(f"Spine references unknown manifest item '{itemref.get('idref')}'")
+
+
+def inspect_epub(path, mode='fast', expected_title=None, expected_author=None):
+    """
+    Inspect the EPUB at ``path`` and return an EpubReport.
+
+    Raises zipfile.BadZipFile if the file is not a zip archive at all.
+    """
+    report = EpubReport()
+    if mode == 'off':
+        return report
+
+    with zipfile.ZipFile(path, 'r') as zf:
+        infos = zf.infolist()
+        report.files = [info.filename for info in infos]
+        names = set(report.files)
+
+        # The mimetype entry must come first and be stored uncompressed (OCF 3.0, 4.3)
+        if not infos or infos[0].filename != 'mimetype':
+            report.errors.append("mimetype is not the first entry in the container")
+        elif infos[0].compress_type != zipfile.ZIP_STORED:
+            report.errors.append("mimetype entry is compressed")
+        elif zf.read('mimetype').strip() != EPUB_MIMETYPE:
+            report.errors.append("mimetype entry does not contain application/epub+zip")
+
+        try:
+            container = ET.fromstring(zf.read('META-INF/container.xml'))
+        except KeyError:
+            report.errors.append("META-INF/container.xml is missing")
+            return report
+        except ET.ParseError as e:
+            report.errors.append(f"META-INF/container.xml is not well-formed: {str(e)}")
+            return report
+
+        rootfile = container.find('c:rootfiles/c:rootfile', CONTAINER_NS)
+        opf_path = rootfile.get('full-path') if rootfile is not None else None
+        if not opf_path:
+            report.errors.append("container.xml does not reference a package document")
+            return report
+
+        try:
+            opf_root = ET.fromstring(zf.read(opf_path))
+        except KeyError:
+            report.errors.append(f"Package document {opf_path} is missing")
+            return report
+        except ET.ParseError as e:
+            report.errors.append(f"Package document {opf_path} is not well-formed: {str(e)}")
+            return report
+
+        _check_metadata(report, opf_root, expected_title, expected_author)
+
+        if mode == 'full':
+            _check_references(report, opf_root, opf_path, names)
+            start = time.perf_counter()
+            bad_entry = zf.testzip()
+            report.timings['zip_check'] = time.perf_counter() - start
+            if bad_entry is not None:
+                report.errors.append(f"CRC check failed for {bad_entry}")
+
+    return report
@@ -0,0 +1,309 @@
+"""
+Assembly of EPUB3 containers from XHTML chapter bodies.
+
+Builds the OCF container (``mimetype``, ``container.xml``), the OPF package
+document, the EPUB3 navigation document and an NCX table of contents for
+older readers. Chapter bodies are produced elsewhere (pandoc fragments or the
+native renderer); this module only packages them.
+"""
+
+import html
+import time
+import uuid
+import zipfile
+from html.parser import HTMLParser
+
+CONTAINER_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="EPUB/content.opf" media-type="application/oebps-package+xml" />
+  </rootfiles>
+</container>
+"""
+
+STYLESHEET = """body { margin: 5%; text-align: justify; font-size: medium; }
+code { font-family: monospace; }
+h1, h2, h3, h4, h5, h6 { text-align: left; }
+h1.title { text-align: center; }
+p.author { text-align: center; }
+nav#toc ol, nav#landmarks ol { padding: 0; margin-left: 1em; }
+nav#toc ol li, nav#landmarks ol li { list-style-type: none; margin: 0; padding: 0; }
+a.footnote-ref { vertical-align: super; }
+table { margin: 1em 0; border-collapse: collapse; }
+th, td { padding: 0.25em 0.5em; }
+pre { white-space: pre-wrap; }
+blockquote { margin: 1em 2em; }
+"""
+
+XHTML_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" xml:lang="{lang}" lang="{lang}">
+<head>
+  <meta charset="utf-8" />
+  <title>{title}</title>
+  <link rel="stylesheet" type="text/css" href="{css}" />
+</head>
+<body epub:type="{body_type}">
+{body}
+</body>
+</html>
+"""
+
+# Fixed timestamp for zip entries so identical input produces identical bytes
+ZIP_DATE_TIME = (2000, 1, 1, 0, 0, 0)
+
+
+def escape(text):
+    return html.escape(text, quote=True)
+
+
+class Chapter:
+    """One XHTML file of the book with the headings that go into the TOC."""
+
+    def __init__(self, name, title, body, headings=None):
+        self.name = name            # file name below EPUB/text/, e.g. 'ch001.xhtml'
+        self.title = title
+        self.body = body            # XHTML body content
+        self.headings = headings if headings is not None else extract_headings(body)
+
+
+class _HeadingParser(HTMLParser):
+    def __init__(self, max_level):
+        super().__init__(convert_charrefs=True)
+        self.max_level = max_level
+        self.headings = []
+        self._level = None
+        self._id = None
+        self._text = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if len(tag) == 2 and tag[0] == 'h' and tag[1].isdigit() and 1 <= int(tag[1]) <= self.max_level:
+            self._level, self._id, self._text = int(tag[1]), attrs.get('id'), []
+        elif self._level is not None and tag == 'a' and 'footnote-ref' in (attrs.get('class') or ''):
+            # Footnote references inside headings are not part of the title
+            self._skip += 1
+
+    def handle_endtag(self, tag):
+        if self._level is None:
+            return
+        if tag == 'a' and self._skip:
+            self._skip -= 1
+        elif tag == f"h{self._level}":
+            self.headings.append((self._level, self._id, ' '.join(''.join(self._text).split())))
+            self._level = None
+
+    def handle_data(self, data):
+        if self._level is not None and not self._skip:
+            self._text.append(data)
+
+
+def extract_headings(body, max_level=6):
+    """Return (level, id, text) for every heading in an XHTML fragment."""
+    parser = _HeadingParser(max_level)
+    parser.feed(body)
+    parser.close()
+    return parser.headings
+
+
+def book_identifier(seed):
+    """A stable urn:uuid identifier derived from ``seed``."""
+    return f"urn:uuid:{uuid.uuid5(uuid.NAMESPACE_URL, seed)}"
+
+
+def _toc_entries(chapters, toc_depth):
+    """Flatten chapter headings into (level, href, text) entries for the TOC."""
+    entries = []
+    for chapter in chapters:
+        href = f"text/{chapter.name}"
+        headings = [h for h in chapter.headings if h[0] <= toc_depth and h[2]]
+        if not headings:
+            entries.append((1, href, chapter.title))
+            continue
+        for level, heading_id, text in headings:
+            entries.append((level, f"{href}#{heading_id}" if heading_id else href, text))
+    return entries
+
+
+def _nested_toc(entries):
+    """Turn flat (level, href, text) entries into a tree of [href, text, children]."""
+    root = []
+    stack = [(0, root)]
+    for level, href, text in entries:
+        while stack[-1][0] >= level:
+            stack.pop()
+        node = [href, text, []]
+        stack[-1][1].append(node)
+        stack.append((level, node[2]))
+    return root
+
+
+def _nav_list(nodes, indent):
+    pad = '  ' * indent
+    lines = [f"{pad}<ol>"]
+    for href, text, children in nodes:
+        link = f'<a href="{escape(href)}">{escape(text)}</a>'
+        if children:
+            lines.append(f"{pad}  <li>{link}")
+            lines.append(_nav_list(children, indent + 2))
+            lines.append(f"{pad}  </li>")
+        else:
+            lines.append(f"{pad}  <li>{link}</li>")
+    lines.append(f"{pad}</ol>")
+    return '\n'.join(lines)
+
+
+def _nav_document(title, lang, tree, first_href):
+    body = (
+        '<nav epub:type="toc" id="toc">\n'
+        f'  <h1 id="toc-title">{escape(title)}</h1>\n'
+        f'{_nav_list(tree, 1)}\n'
+        '</nav>\n'
+        '<nav epub:type="landmarks" id="landmarks" hidden="hidden">\n'
+        '  <ol>\n'
+        '    <li><a href="text/title_page.xhtml" epub:type="titlepage">Title Page</a></li>\n'
+        f'    <li><a href="{escape(first_href)}" epub:type="bodymatter">Start of Content</a></li>\n'
+        '  </ol>\n'
+        '</nav>'
+    )
+    # The navigation document lives next to content.opf, not in text/
+    return XHTML_TEMPLATE.format(lang=escape(lang), title=escape(title), css='styles/stylesheet.css',
+                                 body_type='frontmatter', body=body)
+
+
+def _ncx_points(nodes, counter, indent):
+    lines = []
+    pad = '  ' * indent
+    for href, text, children in nodes:
+        counter[0] += 1
+        lines.append(f'{pad}<navPoint id="navPoint-{counter[0]}">')
+        lines.append(f'{pad}  <navLabel><text>{escape(text)}</text></navLabel>')
+        lines.append(f'{pad}  <content src="{escape(href)}" />')
+        lines.extend(_ncx_points(children, counter, indent + 1))
+        lines.append(f'{pad}</navPoint>')
+    return lines
+
+
+def _ncx_document(identifier, title, tree):
+    points = '\n'.join(_ncx_points(tree, [0], 2))
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<ncx version="2005-1" xmlns="http://www.daisy.org/z3986/2005/ncx/">\n'
+        '  <head>\n'
+        f'    <meta name="dtb:uid" content="{escape(identifier)}" />\n'
+        '  </head>\n'
+        f'  <docTitle><text>{escape(title)}</text></docTitle>\n'
+        '  <navMap>\n'
+        f'{points}\n'
+        '  </navMap>\n'
+        '</ncx>\n'
+    )
+
+
+def _title_page(metadata, lang):
+    title = metadata.get('title', 'Untitled')
+    lines = [f'<section epub:type="titlepage" class="titlepage">', f'  <h1 class="title">{escape(title)}</h1>']
+    if metadata.get('author'):
+        lines.append(f'  <p class="author">{escape(metadata["author"])}</p>')
+    if metadata.get('publisher'):
+        lines.append(f'  <p class="publisher">{escape(metadata["publisher"])}</p>')
+    if metadata.get('date'):
+        lines.append(f'  <p class="date">{escape(str(metadata["date"]))}</p>')
+    if metadata.get('rights'):
+        lines.append(f'  <div class="rights">{escape(metadata["rights"])}</div>')
+    lines.append('</section>')
+    return XHTML_TEMPLATE.format(lang=escape(lang), title=escape(title), css='../styles/stylesheet.css',
+                                 body_type='frontmatter', body='\n'.join(lines))
+
+
+def _package_document(metadata, identifier, modified, chapters, lang):
+    meta = [
+        f'    <dc:identifier id="epub-id-1">{escape(identifier)}</dc:identifier>',
+        f'    <dc:title id="epub-title-1">{escape(metadata.get("title", "Untitled"))}</dc:title>',
+    ]
+    if metadata.get('author'):
+        meta.append(f'    <dc:creator id="epub-creator-1">{escape(metadata["author"])}</dc:creator>')
+    meta.append(f'    <dc:language>{escape(lang)}</dc:language>')
+    if metadata.get('date'):
+        meta.append(f'    <dc:date>{escape(str(metadata["date"]))}</dc:date>')
+    if metadata.get('publisher'):
+        meta.append(f'    <dc:publisher>{escape(metadata["publisher"])}</dc:publisher>')
+    if metadata.get('rights'):
+        meta.append(f'    <dc:rights>{escape(metadata["rights"])}</dc:rights>')
+    meta.append(f'    <meta property="dcterms:modified">{modified}</meta>')
+
+    manifest = [
+        '    <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml" />',
+        '    <item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav" />',
+        '    <item id="stylesheet1" href="styles/stylesheet.css" media-type="text/css" />',
+        '    <item id="title_page_xhtml" href="text/title_page.xhtml" media-type="application/xhtml+xml" />',
+    ]
+    spine = ['    <itemref idref="title_page_xhtml" linear="yes" />']
+    for chapter in chapters:
+        item_id = chapter.name.replace('.', '_')
+        manifest.append(f'    <item id="{item_id}" href="text/{chapter.name}" media-type="application/xhtml+xml" />')
+        spine.append(f'    <itemref idref="{item_id}" />')
+    spine.append('    <itemref idref="nav" />')
+
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<package version="3.0" xmlns="http://www.idpf.org/2007/opf" unique-identifier="epub-id-1">\n'
+        '  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">\n'
+        + '\n'.join(meta) + '\n'
+        '  </metadata>\n'
+        '  <manifest>\n'
+        + '\n'.join(manifest) + '\n'
+        '  </manifest>\n'
+        '  <spine toc="ncx">\n'
+        + '\n'.join(spine) + '\n'
+        '  </spine>\n'
+        '  <guide>\n'
+        '    <reference type="toc" title="' + escape(metadata.get('title', 'Untitled')) + '" href="nav.xhtml" />\n'
+        '  </guide>\n'
+        '</package>\n'
+    )
+
+
+def chapter_document(chapter, lang):
+    """Full XHTML document for a chapter body."""
+    return XHTML_TEMPLATE.format(lang=escape(lang), title=escape(chapter.title), css='../styles/stylesheet.css',
+                                 body_type='bodymatter', body=chapter.body)
+
+
+def write_epub(target, metadata, chapters, toc_depth=3, identifier=None, modified=None,
+               compression=zipfile.ZIP_DEFLATED, compresslevel=None, stylesheet=None):
+    """
+    Write an EPUB3 container for ``chapters`` to ``target`` (a path or binary file).
+
+    ``metadata`` uses the same keys as the pandoc metadata file (title, author,
+    language, date, rights, publisher). ``stylesheet`` replaces the default
+    STYLESHEET, like pandoc's ``--css``.
+    """
+    lang = metadata.get('language') or 'en-US'
+    title = metadata.get('title', 'Untitled')
+    if identifier is None:
+        identifier = book_identifier(f"{title}\n{metadata.get('author', '')}")
+    if modified is None:
+        modified = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+    tree = _nested_toc(_toc_entries(chapters, toc_depth))
+    first_href = f"text/{chapters[0].name}" if chapters else 'text/title_page.xhtml'
+
+    def add(zf, name, text, compress_type=compression):
+        info = zipfile.ZipInfo(name, date_time=ZIP_DATE_TIME)
+        info.compress_type = compress_type
+        info.external_attr = 0o644 << 16
+        zf.writestr(info, text.encode('utf-8') if isinstance(text, str) else text, compresslevel=compresslevel)
+
+    with zipfile.ZipFile(target, 'w') as zf:
+        # The mimetype entry must come first and be stored uncompressed
+        add(zf, 'mimetype', 'application/epub+zip', zipfile.ZIP_STORED)
+        add(zf, 'META-INF/container.xml', CONTAINER_XML)
+        add(zf, 'EPUB/content.opf', _package_document(metadata, identifier, modified, chapters, lang))
+        add(zf, 'EPUB/toc.ncx', _ncx_document(identifier, title, tree))
+        add(zf, 'EPUB/nav.xhtml', _nav_document(title, lang, tree, first_href))
+        add(zf, 'EPUB/styles/stylesheet.css', STYLESHEET if stylesheet is None else stylesheet)
+        add(zf, 'EPUB/text/title_page.xhtml', _title_page(metadata, lang))
+        for chapter in chapters:
+            add(zf, f"EPUB/text/{chapter.name}", chapter_document(chapter, lang))
@@ -0,0 +1,197 @@
+"""
+Stored responses of /convert requests sent with an ``Idempotency-Key`` header.
+
+A client that retries a conversion after a timeout sends the same key again
+and gets the EPUB of the first attempt instead of a second conversion. Every
+key has a ``<hash>.json`` record (the fingerprint of the request it was first
+used with and the response headers) and a ``<hash>.epub`` next to it in a
+directory shared by all workers. While the first request is still converting,
+a ``<hash>.lock`` file claims the key, so a concurrent retry is told to wait
+instead of starting a duplicate conversion. Records expire after a TTL.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+# Keys are opaque client strings, typically UUIDs
+IDEMPOTENCY_KEY_RE = re.compile(r'^[\x21-\x7e]{1,255}$')
+
+# Seconds after which the claim of a request that never finished (its worker
+# died) is ignored
+STALE_CLAIM_AFTER = 900
+
+# Seconds between scans for expired records
+PRUNE_INTERVAL = 300
+
+
+class IdempotencyConflict(Exception):
+    """An Idempotency-Key cannot be used for this request (yet)."""
+
+    def __init__(self, message, status_code, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class IdempotencyStore:
+    """Claims Idempotency-Keys and keeps the EPUB responses of finished requests."""
+
+    def __init__(self, directory, ttl, retry_after=5):
+        self.directory = directory
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self._last_prune = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _base_path(self, idempotency_key):
+        digest = hashlib.sha256(idempotency_key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    def result_path(self, idempotency_key):
+        """Path of the stored EPUB for a key."""
+        return self._base_path(idempotency_key) + '.epub'
+
+    def _read_record(self, idempotency_key):
+        try:
+            with open(self._base_path(idempotency_key) + '.json', 'r', encoding='utf-8') as f:
+                record = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if time.time() - record['created_at'] > self.ttl:
+            self._delete(self._base_path(idempotency_key))
+            return None
+        return record
+
+    def begin(self, idempotency_key, fingerprint):
+        """
+        Look up or claim a key for a request identified by fingerprint.
+
+        Returns the stored record ('headers') of an earlier request with the
+        same key and fingerprint, whose EPUB is at result_path(). Otherwise
+        claims the key and returns None; the caller must then call complete()
+        or release(). Raises IdempotencyConflict when the key was used for a
+        different request (422) or its first request is still running (409).
+        """
+        if not IDEMPOTENCY_KEY_RE.match(idempotency_key):
+            raise IdempotencyConflict("Idempotency-Key must be 1 to 255 printable ASCII characters", 400)
+        self._prune()
+
+        record = self._read_record(idempotency_key)
+        if record is None:
+            self._claim(idempotency_key, fingerprint)
+            # The first request may have finished between the lookup and the claim
+            record = self._read_record(idempotency_key)
+            if record is None:
+                return None
+            self.release(idempotency_key)
+        if record['fingerprint'] != fingerprint:
+            raise IdempotencyConflict("Idempotency-Key was already used for a different request", 422)
+        return record
+
+    def reclaim(self, idempotency_key, fingerprint):
+        """
+        Claim a key whose record begin() returned but whose EPUB has been
+        pruned since. Raises IdempotencyConflict (409) when another request
+        claimed it first.
+        """
+        self._delete(self._base_path(idempotency_key))
+        self._claim(idempotency_key, fingerprint)
+
+    def _claim(self, idempotency_key, fingerprint):
+        lock_path = self._base_path(idempotency_key) + '.lock'
+        for _ in range(2):
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock_path) <= STALE_CLAIM_AFTER:
+                        break
+                    logger.warning("Ignoring stale claim of an Idempotency-Key")
+                    os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+                continue
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(fingerprint)
+            return
+        raise IdempotencyConflict("A request with this Idempotency-Key is still being processed", 409,
+                                  retry_after=self.retry_after)
+
+    def complete(self, idempotency_key, fingerprint, source, headers):
+        """
+        Store the EPUB and headers of a claimed key's response and release the claim.
+
+        source is the path of the EPUB (hard-linked, or copied across
+        filesystems) or a binary file object, which is copied from its start
+        whatever its position and rewound afterwards.
+        """
+        base_path = self._base_path(idempotency_key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            if isinstance(source, str):
+                os.close(fd)
+                os.remove(tmp_path)
+                try:
+                    os.link(source, tmp_path)
+                except OSError:
+                    shutil.copyfile(source, tmp_path)
+            else:
+                source.seek(0)
+                with os.fdopen(fd, 'wb') as f:
+                    shutil.copyfileobj(source, f)
+                source.seek(0)
+            os.replace(tmp_path, base_path + '.epub')
+
+            # The record is written last: it makes the stored response visible
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'fingerprint': fingerprint, 'headers': headers, 'created_at': time.time()}, f)
+            os.replace(tmp_path, base_path + '.json')
+        except OSError as e:
+            logger.warning("Could not store the response for an Idempotency-Key: %s", e)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        finally:
+            self.release(idempotency_key)
+
+    def release(self, idempotency_key):
+        """Give up the claim of a key, e.g. after a failed conversion, so that it can be retried."""
+        try:
+            os.remove(self._base_path(idempotency_key) + '.lock')
+        except FileNotFoundError:
+            pass
+
+    def _delete(self, base_path):
+        for suffix in ('.json', '.epub'):
+            try:
+                os.remove(base_path + suffix)
+            except FileNotFoundError:
+                pass
+
+    def _prune(self):
+        """Remove expired records, at most every PRUNE_INTERVAL."""
+        now = time.time()
+        if now - self._last_prune < PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith('.json')]
+        except OSError as e:
+            logger.warning("Could not list idempotency directory %s: %s", self.directory, e)
+            return
+        for name in names:
+            try:
+                if now - os.path.getmtime(os.path.join(self.directory, name)) > self.ttl:
+                    self._delete(os.path.join(self.directory, name[:-len('.json')]))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,232 @@
+"""
+Content-addressed storage and optimization of images referenced from markdown.
+
+Conversion requests can carry images next to the markdown (base64 strings in
+JSON, or file parts of a multipart upload). Every image is stored once under
+the sha256 of its bytes in a directory shared by all workers, so an
+illustration sent with many requests is written to disk once. A conversion
+hard-links its images into its work directory under the names the markdown
+uses, and pandoc embeds them from there.
+
+With optimization enabled (requires Pillow), JPEG, PNG and WebP images larger
+than the target size are downscaled to fit and recompressed. The optimized
+variant is stored under a hash of the original and the settings, so it is only
+computed the first time an image is seen. Files that have not been used for
+``ttl`` seconds are removed.
+"""
+
+import base64
+import binascii
+import hashlib
+import io
+import logging
+import os
+import posixpath
+import re
+import shutil
+import tempfile
+import time
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Image types that can be embedded, by file extension
+IMAGE_TYPES = {
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp',
+    '.svg': 'image/svg+xml',
+}
+SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+
+# Relative paths such as 'cover.jpg' or 'figures/fig-1.png'; no segment starts with a dot
+NAME_RE = re.compile(r'^[A-Za-z0-9_-][A-Za-z0-9._-]*(?:/[A-Za-z0-9_-][A-Za-z0-9._-]*)*$')
+MAX_NAME_LENGTH = 200
+
+# Pillow formats that are downscaled and recompressed
+OPTIMIZED_FORMATS = ('JPEG', 'PNG', 'WEBP')
+
+# Seconds between scans for expired images
+PRUNE_INTERVAL = 300
+
+
+class InvalidImage(Exception):
+    """An image asset is badly named, malformed or of an unsupported type."""
+
+
+def optimization_available():
+    """Whether Pillow is installed, which image optimization requires."""
+    return Image is not None
+
+
+def sniff_media_type(data):
+    """The media type of image bytes, from their first bytes, or None."""
+    for signature, media_type in SIGNATURES:
+        if data.startswith(signature):
+            return media_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    head = data[:1024].lstrip()
+    if head.startswith(b'<svg') or (head.startswith(b'<?xml') and b'<svg' in head):
+        return 'image/svg+xml'
+    return None
+
+
+def check_image(name, data):
+    """Raise InvalidImage unless name is a safe relative path whose extension matches the image data."""
+    if not isinstance(name, str) or len(name) > MAX_NAME_LENGTH or not NAME_RE.match(name):
+        raise InvalidImage(f"Invalid image name: {name!r}")
+    media_type = IMAGE_TYPES.get(posixpath.splitext(name)[1].lower())
+    if media_type is None:
+        raise InvalidImage(f"Unsupported image type: {name} (use {', '.join(sorted(IMAGE_TYPES))})")
+    if sniff_media_type(data) != media_type:
+        raise InvalidImage(f"Image {name} is not a valid {media_type} file")
+
+
+def decode_base64_image(name, value):
+    """Decode the base64 string (optionally a data: URI) sent for the image called name."""
+    if not isinstance(value, str):
+        raise InvalidImage(f"Image {name} must be a base64 string")
+    if value.startswith('data:'):
+        value = value.partition(',')[2]
+    try:
+        return base64.b64decode(''.join(value.split()), validate=True)
+    except (binascii.Error, ValueError):
+        raise InvalidImage(f"Image {name} is not valid base64")
+
+
+def optimize_image(data, max_width, max_height, quality):
+    """
+    Downscale an image to fit max_width x max_height and recompress it.
+
+    Returns the original bytes when Pillow is missing, the format is not
+    recompressed (GIF, SVG, animations) or the result would not be smaller.
+    """
+    if Image is None:
+        return data
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image_format = image.format
+            if image_format not in OPTIMIZED_FORMATS or getattr(image, 'is_animated', False):
+                return data
+            resized = image.width > max_width or image.height > max_height
+            if resized:
+                image.thumbnail((max_width, max_height), Image.LANCZOS)
+            output = io.BytesIO()
+            if image_format == 'PNG':
+                image.save(output, 'PNG', optimize=True)
+            elif image_format == 'JPEG':
+                if image.mode not in ('RGB', 'L'):
+                    image = image.convert('RGB')
+                image.save(output, 'JPEG', quality=quality, optimize=True)
+            else:
+                image.save(output, 'WEBP', quality=quality)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logger.warning("Could not optimize image, keeping the original: %s", e)
+        return data
+
+    optimized = output.getvalue()
+    if not resized and len(optimized) >= len(data):
+        return data
+    logger.debug("Optimized %s image: %s -> %s bytes", image_format, len(data), len(optimized))
+    return optimized
+
+
+def link_images(images, directory):
+    """Hard-link (or copy) stored images into directory under the names the markdown uses."""
+    for name, path in images.items():
+        target = os.path.join(directory, *name.split('/'))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(path, target)
+        except OSError:
+            shutil.copyfile(path, target)
+
+
+class AssetStore:
+    """Images shared by all workers, stored once under the hash of their content."""
+
+    def __init__(self, directory, ttl, optimize=None):
+        """optimize is None or (max_width, max_height, quality) for optimize_image()."""
+        self.directory = directory
+        self.ttl = ttl
+        self.optimize = optimize
+        self._last_prune = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def put(self, name, data):
+        """
+        Store the image sent under name and return the path of the file to embed.
+
+        The file is the optimized variant when optimization is enabled. Raises
+        InvalidImage for names and data that cannot be embedded.
+        """
+        check_image(name, data)
+        extension = posixpath.splitext(name)[1].lower()
+        digest = hashlib.sha256(data).hexdigest()
+        if self.optimize is not None:
+            settings = 'x'.join(str(value) for value in self.optimize)
+            digest = hashlib.sha256(f"{digest}:{settings}".encode('ascii')).hexdigest()
+        path = os.path.join(self.directory, digest + extension)
+
+        if not self._touch(path):
+            if self.optimize is not None:
+                data = optimize_image(data, *self.optimize)
+            self._write(path, data)
+        self._prune()
+        return path
+
+    def _touch(self, path):
+        # Refresh the age of a stored image; False if it is not stored (any more)
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _write(self, path, data):
+        # Write to a private file first so other workers never see a partial image
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _prune(self):
+        """Remove images that have not been used for ttl seconds, at most every PRUNE_INTERVAL."""
+        now = time.time()
+        if self.ttl <= 0 or now - self._last_prune < PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        removed = 0
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    try:
+                        if now - entry.stat().st_mtime > self.ttl:
+                            os.remove(entry.path)
+                            removed += 1
+                    except FileNotFoundError:
+                        pass
+        except OSError as e:
+            logger.warning("Could not prune image directory %s: %s", self.directory, e)
+            return
+        if removed:
+            logger.info("Removed %s unused images", removed)
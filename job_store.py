@@ -0,0 +1,225 @@
+"""
+File-backed state for asynchronous conversion jobs.
+
+Every job has a directory under the store root holding ``state.json`` and,
+once finished, ``result.epub``. Because state lives on the filesystem, any
+gunicorn worker can answer status and result requests for a job, whichever
+worker runs it. Finished jobs expire after a TTL, and running jobs whose
+worker stopped updating them are reported as failed. A queued job waits in
+the executor of the worker that accepted it, which holds a ``flock`` on the
+job's ``.queued`` file until the job starts; the kernel drops the lock when
+that worker dies, and the job is reported as failed. Jobs waiting in the
+queue of a live worker never go stale.
+
+State changes take an exclusive ``flock`` on the job's lock file, and a
+finished state is final: a late progress update from the worker of a job
+that was reported as failed does not bring it back.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+FINISHED_STATUSES = ('done', 'failed')
+
+
+class JobStore:
+    """Creates, updates and expires job records in a shared directory."""
+
+    def __init__(self, directory, ttl, stale_after):
+        self.directory = directory
+        self.ttl = ttl
+        self.stale_after = stale_after
+        self._claims = {}  # job_id -> locked .queued file of the jobs this process queued
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _job_dir(self, job_id):
+        if not JOB_ID_RE.match(job_id):
+            return None
+        return os.path.join(self.directory, job_id)
+
+    def _state_path(self, job_id):
+        return os.path.join(self.directory, job_id, 'state.json')
+
+    def result_path(self, job_id):
+        """Path of the finished EPUB for a job."""
+        return os.path.join(self.directory, job_id, 'result.epub')
+
+    @contextmanager
+    def _lock(self, job_id):
+        """Hold an exclusive lock on a job; yields False when the job no longer exists."""
+        try:
+            lock_file = open(os.path.join(self.directory, job_id, '.lock'), 'w')
+        except FileNotFoundError:
+            yield False
+            return
+        with lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write_state(self, job_id, state):
+        # Replace the file atomically so readers in other workers never see partial JSON
+        job_dir = os.path.join(self.directory, job_id)
+        fd, tmp_path = tempfile.mkstemp(dir=job_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self._state_path(job_id))
+
+    def _read_state(self, job_id):
+        try:
+            with open(self._state_path(job_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _claim_path(self, job_id):
+        return os.path.join(self.directory, job_id, '.queued')
+
+    def _claim(self, job_id):
+        claim = open(self._claim_path(job_id), 'w')
+        fcntl.flock(claim, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._claims[job_id] = claim
+
+    def _release(self, job_id):
+        claim = self._claims.pop(job_id, None)
+        if claim is not None:
+            claim.close()
+
+    def _abandoned(self, job_id):
+        """Whether the process that queued a job no longer holds its claim."""
+        try:
+            claim = open(self._claim_path(job_id), 'r')
+        except FileNotFoundError:
+            return True
+        with claim:
+            try:
+                fcntl.flock(claim, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            fcntl.flock(claim, fcntl.LOCK_UN)
+            return True
+
+    def create(self, **fields):
+        """Create a job queued by this process and return its id."""
+        self.purge_expired()
+        job_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.directory, job_id))
+        self._claim(job_id)
+        now = time.time()
+        state = {
+            'job_id': job_id,
+            'status': 'queued',
+            'stage': 'queued',
+            'progress': 0,
+            'created_at': now,
+            'updated_at': now,
+            'error': None,
+        }
+        state.update(fields)
+        self._write_state(job_id, state)
+        return job_id
+
+    def update(self, job_id, **fields):
+        """
+        Merge fields into a job's state and return the new state.
+
+        A finished job is left unchanged and its state returned as it is.
+        """
+        with self._lock(job_id) as exists:
+            state = self._read_state(job_id) if exists else None
+            if state is not None and state['status'] not in FINISHED_STATUSES:
+                state = self._apply(job_id, state, fields)
+            # The claim is given up only once the new state is written (see _fail_abandoned)
+            if state is None or state['status'] != 'queued':
+                self._release(job_id)
+            return state
+
+    def _apply(self, job_id, state, fields):
+        """Merge fields into state and write it; the caller holds the job's lock."""
+        state.update(fields)
+        state['updated_at'] = time.time()
+        if state['status'] != 'queued' and 'started_at' not in state:
+            state['started_at'] = state['updated_at']
+        if state['status'] in FINISHED_STATUSES:
+            state['finished_at'] = state['updated_at']
+        self._write_state(job_id, state)
+        return state
+
+    def store_result(self, job_id, path):
+        """Move a finished EPUB into the job's directory."""
+        shutil.move(path, self.result_path(job_id))
+
+    def get(self, job_id):
+        """Return the state of a job, or None if it is unknown or expired."""
+        job_dir = self._job_dir(job_id)
+        if job_dir is None:
+            return None
+        state = self._read_state(job_id)
+        if state is None:
+            return None
+
+        now = time.time()
+        if state['status'] in FINISHED_STATUSES:
+            if now - state.get('finished_at', state['updated_at']) > self.ttl:
+                self.delete(job_id)
+                return None
+        elif state['status'] == 'running' and now - state['updated_at'] > self.stale_after:
+            state = self._fail_stale(job_id)
+        elif state['status'] == 'queued' and self._abandoned(job_id):
+            state = self._fail_abandoned(job_id)
+        return state
+
+    def _fail_stale(self, job_id):
+        """Mark a running job failed if it is still without progress once the lock is held."""
+        with self._lock(job_id) as exists:
+            state = self._read_state(job_id) if exists else None
+            if state is None or state['status'] != 'running':
+                return state
+            # updated_at is the worker's heartbeat: it moves with every progress update
+            idle = time.time() - state['updated_at']
+            if idle <= self.stale_after:
+                return state
+            # The worker running the job died or was restarted
+            logger.warning("Job %s has not been updated for %ss, marking failed", job_id, int(idle))
+            return self._apply(job_id, state, {'status': 'failed', 'error': 'Job was interrupted'})
+
+    def _fail_abandoned(self, job_id):
+        """Mark a queued job failed if the process that queued it is still gone once the lock is held."""
+        with self._lock(job_id) as exists:
+            state = self._read_state(job_id) if exists else None
+            if state is None or state['status'] != 'queued' or not self._abandoned(job_id):
+                return state
+            # The worker holding the job in its queue died or was restarted
+            logger.warning("Job %s was queued by a worker that has stopped, marking failed", job_id)
+            return self._apply(job_id, state, {'status': 'failed', 'error': 'Job was interrupted'})
+
+    def delete(self, job_id):
+        job_dir = self._job_dir(job_id)
+        if job_dir is not None:
+            self._release(job_id)
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+    def purge_expired(self):
+        """Delete expired jobs; called whenever a new job is created."""
+        try:
+            job_ids = [name for name in os.listdir(self.directory) if JOB_ID_RE.match(name)]
+        except OSError as e:
+            logger.warning("Could not list job directory %s: %s", self.directory, e)
+            return
+        for job_id in job_ids:
+            # get() removes finished jobs past their TTL
+            self.get(job_id)
@@ -0,0 +1,182 @@
+"""
+Incremental rendering of markdown for the live preview of the web UI.
+
+The preview is rendered while the user types, so most requests differ from
+the previous one in a paragraph or two. The document is cut into its
+top-level blocks and every block is rendered (and cached) on its own; a
+request only sends the blocks that are not in the cache to pandoc, all of
+them in one pandoc run.
+
+Rendering blocks separately has to keep what depends on the whole document:
+
+- Reference and footnote definitions are taken out of the text and added to
+  every block that uses them (see chunked_epub.split_definitions), and they
+  are part of the cache key of the block.
+- Footnotes of a block are cached numbered from 1 and renumbered when the
+  blocks are put together, under one list of notes at the end.
+- Identifiers that occur in more than one block are made unique.
+"""
+
+import json
+import re
+
+from chunked_epub import FENCE_RE, link_chapters, renumber_footnotes, split_definitions
+from result_cache import cache_key
+
+LIST_ITEM_RE = re.compile(r'^ {0,3}([-*+]|\d+[.)]|#\.)[ \t]')
+FENCED_DIV_RE = re.compile(r'^ {0,3}:{3,}(.*)$')
+FOOTNOTE_LABEL_RE = re.compile(r'\[\^([^\]\s]+)\](?!:)')
+
+# A paragraph between blocks rendered in one pandoc run, found again in its output
+BOUNDARY = 'previewblockboundary'
+BOUNDARY_RE = re.compile(r'\s*<p>' + BOUNDARY + r'</p>\s*')
+
+# pandoc's footnote markup in HTML output
+NOTES_SECTION_RE = re.compile(r'<section\b[^>]*\bclass="footnotes[^"]*"[^>]*>(.*?)</section>\s*', re.DOTALL)
+NOTE_ITEM_RE = re.compile(r'<li\b[^>]*\bid="fn(\d+)"')
+NOTE_REF_RE = re.compile(r'\bid="fnref(\d+)"')
+
+
+def split_blocks(lines):
+    """
+    Group lines of markdown into top-level blocks.
+
+    Blocks end at blank lines, except inside fenced code and fenced divs,
+    before indented lines (which continue a list item or code block) and
+    between the items of a list. Returns a list of markdown strings.
+    """
+    blocks = []
+    current = []
+    fence = None
+    div_depth = 0
+    for index, line in enumerate(lines):
+        fence_match = FENCE_RE.match(line)
+        if fence is not None:
+            if fence_match and fence_match.group(1)[0] == fence[0] and len(fence_match.group(1)) >= len(fence):
+                fence = None
+            current.append(line)
+            continue
+        if fence_match:
+            fence = fence_match.group(1)
+        else:
+            div = FENCED_DIV_RE.match(line)
+            if div and div.group(1).strip():
+                div_depth += 1
+            elif div and div_depth:
+                div_depth -= 1
+
+        if line.strip() or div_depth:
+            current.append(line)
+            continue
+        if not current:
+            continue
+        following = next((line for line in lines[index + 1:] if line.strip()), None)
+        if following is not None and (following.startswith(('    ', '\t'))
+                                      or (LIST_ITEM_RE.match(current[0]) and LIST_ITEM_RE.match(following))):
+            current.append(line)
+            continue
+        blocks.append('\n'.join(current))
+        current = []
+    if current:
+        blocks.append('\n'.join(current).rstrip('\n'))
+    return blocks
+
+
+def block_sources(markdown):
+    """The markdown of each top-level block with the definitions it needs to render alone."""
+    lines, links, footnotes = split_definitions(markdown)
+    sources = []
+    for block in split_blocks(lines):
+        labels = dict.fromkeys(FOOTNOTE_LABEL_RE.findall(block))
+        definitions = [footnotes[label] for label in labels if label in footnotes] + (['\n'.join(links)] if links else [])
+        sources.append('\n\n'.join([block] + definitions) + '\n')
+    return sources
+
+
+def _split_rendered(html, count):
+    """
+    Split the HTML of count blocks rendered in one run into cache entries.
+
+    An entry is a dict of the block's html and its footnote list items, both
+    with footnotes numbered from 1. Returns None when the output does not
+    have count blocks.
+    """
+    notes = {}
+    for section in NOTES_SECTION_RE.findall(html):
+        items = section[section.find('<ol'):section.rfind('</ol>')]
+        starts = [(match.start(), int(match.group(1))) for match in NOTE_ITEM_RE.finditer(items)]
+        for (start, number), (end, _) in zip(starts, starts[1:] + [(len(items), None)]):
+            notes[number] = items[start:end].strip()
+    fragments = BOUNDARY_RE.split(NOTES_SECTION_RE.sub('', html).strip())
+    if len(fragments) != count:
+        return None
+
+    entries = []
+    for fragment in fragments:
+        numbers = sorted({int(number) for number in NOTE_REF_RE.findall(fragment)})
+        block_notes = [notes[number] for number in numbers if number in notes]
+        if numbers and numbers[0] > 1:
+            offset = 1 - numbers[0]
+            fragment = renumber_footnotes(fragment, offset)[0]
+            block_notes = [renumber_footnotes(item, offset)[0] for item in block_notes]
+        entries.append({'html': fragment.strip(), 'notes': block_notes})
+    return entries
+
+
+def render_blocks(sources, render):
+    """
+    Render block sources with render (markdown -> HTML) in one run.
+
+    Returns a cache entry for each block (see _split_rendered).
+    """
+    entries = _split_rendered(render(f'\n\n{BOUNDARY}\n\n'.join(sources)), len(sources))
+    if entries is None:
+        # A block swallowed a boundary (an unclosed raw HTML element, say)
+        entries = [_split_rendered(render(source), 1)[0] for source in sources]
+    return entries
+
+
+def assemble(entries):
+    """Join the cache entries of a document's blocks into one HTML fragment."""
+    bodies = []
+    notes = []
+    for entry in entries:
+        offset = len(notes)
+        html, count = renumber_footnotes(entry['html'], offset)
+        notes.extend(renumber_footnotes(item, offset)[0] for item in entry['notes'])
+        # Keep numbering continuous when a note's list item was missing from the output
+        notes.extend([''] * (count - len(entry['notes'])))
+        bodies.append(html)
+    # With one name for all of them, link_chapters only makes identifiers unique
+    html = '\n'.join(body for body in link_chapters(bodies, [''] * len(bodies)) if body)
+    if any(notes):
+        items = '\n'.join(item for item in notes if item)
+        html += f'\n<section class="footnotes" role="doc-endnotes">\n<hr />\n<ol>\n{items}\n</ol>\n</section>'
+    return html
+
+
+def render_preview(markdown, reader_format, render, cache=None):
+    """
+    Render normalized markdown to an HTML fragment for the live preview.
+
+    render converts markdown read with reader_format to HTML. Blocks found in
+    cache (a ResultCache) are not rendered again; the others are rendered and
+    cached. Returns (html, blocks, rendered) where blocks is the number of
+    blocks in the document and rendered the number that was not cached.
+    """
+    sources = block_sources(markdown)
+    keys = [cache_key(source, {}, ['preview', reader_format]) for source in sources]
+    entries = [None] * len(sources)
+    if cache is not None:
+        for index, key in enumerate(keys):
+            data = cache.get(key)
+            if data is not None:
+                entries[index] = json.loads(data)
+
+    missing = [index for index, entry in enumerate(entries) if entry is None]
+    if missing:
+        for index, entry in zip(missing, render_blocks([sources[index] for index in missing], render)):
+            entries[index] = entry
+            if cache is not None:
+                cache.put(keys[index], json.dumps(entry).encode('utf-8'))
+    return assemble(entries), len(sources), len(missing)
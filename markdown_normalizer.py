@@ -0,0 +1,111 @@
+"""
+Single-pass normalization of line breaks in markdown input.
+
+Produces the same output as the original chain of rewrites, applied in order:
+
+1. CRLF and CR line endings become LF
+2. the escaped sequence ``\\n\\n`` (sent by some clients) becomes a blank line
+3. a blank line is inserted before lines starting with ``#``
+4. a blank line is inserted before lines starting with a ``*``, ``-`` or ``+``
+   list marker followed by whitespace
+5. runs of blank lines collapse to a single blank line
+
+Instead of copying the document once per rewrite, every run of line breaks is
+rewritten in one left-to-right scan. Line endings and escaped breaks are
+translated first with C-level replaces, and only where they occur. Runs the
+rewrites leave unchanged (a single or double LF before ordinary text, i.e.
+most of a document) are skipped by the precompiled pattern without calling
+back into Python.
+
+MarkdownNormalizer works incrementally, so input can be normalized chunk by
+chunk while a request body is still being read.
+"""
+
+import re
+
+LIST_MARKERS = ('*', '-', '+')
+ESCAPED_BREAK = '\\n\\n'
+
+# A run of LFs that normalization changes: one LF before a header or list
+# marker, or two or more LFs before a list marker or further LFs. The
+# lookbehind keeps the scan from starting inside a run it skipped
+BREAK_RUN_RE = re.compile(r'\n(?<!\n\n)(?=[#*+\-]|\n[\n*+\-])\n*')
+
+# Characters held back between chunks: a list marker after a run plus a
+# possibly incomplete escaped break after it
+LOOKAHEAD = 1 + len(ESCAPED_BREAK)
+
+
+class MarkdownNormalizer:
+    """
+    Incremental markdown normalizer.
+
+    Call feed() with successive chunks of the document and close() at the end;
+    the concatenation of the returned strings equals normalize_markdown() of
+    the whole document.
+    """
+
+    def __init__(self):
+        self._pending = ''
+        self._offset = 0            # position of _pending[0] in the normalized document
+        # Position of a line break that a preceding list marker consumed as its
+        # trailing whitespace; no blank line is inserted before that break
+        self._consumed_at = -1
+
+    def feed(self, chunk):
+        """Normalize as much of the input seen so far as is final and return it."""
+        return self._process(self._pending + chunk, final=False)
+
+    def close(self):
+        """Normalize and return the rest of the input."""
+        return self._process(self._pending, final=True)
+
+    def _process(self, text, final):
+        if '\r' in text:
+            # A CR at the end of a chunk may be the first half of a CRLF
+            held = '\r' if not final and text.endswith('\r') else ''
+            text = text[:len(text) - len(held)].replace('\r\n', '\n').replace('\r', '\n') + held
+        if ESCAPED_BREAK in text:
+            text = text.replace(ESCAPED_BREAK, '\n\n')
+
+        out = []
+        pos = 0
+        size = len(text)
+        # Without more input, a run near the end may still grow or change
+        safe_end = size if final else size - LOOKAHEAD
+
+        for match in BREAK_RUN_RE.finditer(text):
+            start, end = match.span()
+            if end > safe_end:
+                safe_end = start
+                break
+            out.append(text[pos:start])
+            out.append(self._rewrite(end - start, self._offset + start, self._offset + end, text[end:end + 2]))
+            pos = end
+
+        safe_end = max(safe_end, pos)
+        if not final:
+            # Never split a skipped run of line breaks between two chunks
+            while safe_end > pos and text[safe_end - 1] == '\n':
+                safe_end -= 1
+        out.append(text[pos:safe_end])
+        self._pending = text[safe_end:]
+        self._offset += safe_end
+        return ''.join(out)
+
+    def _rewrite(self, breaks, start, end, following):
+        marker, after_marker = following[:1], following[1:]
+        is_list_item = marker in LIST_MARKERS and after_marker.isspace()
+        if breaks == 1 and start == self._consumed_at:
+            is_list_item = False
+        if is_list_item and after_marker == '\n':
+            self._consumed_at = end + 1
+
+        if breaks > 1 or is_list_item or marker == '#':
+            return '\n\n'
+        return '\n'
+
+
+def normalize_markdown(markdown_content):
+    """Normalize line breaks so pandoc interprets headers, lists and paragraphs reliably."""
+    return MarkdownNormalizer()._process(markdown_content, final=True)
@@ -0,0 +1,173 @@
+"""
+Counters and histograms for the conversion pipeline, in Prometheus text format.
+
+Every gunicorn worker (and every batch pool process) records into its own
+Metrics registry and writes a snapshot of it to ``<directory>/<pid>-<id>.json``
+after each request. ``render()`` sums the snapshots of all processes, so a
+scrape of ``/metrics`` answered by any worker reports the totals of the whole
+host. Snapshots of exited processes are kept so counters never go backwards;
+clear the directory when the service is (re)deployed.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Histogram buckets for durations in seconds and for sizes in bytes
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(10))  # 1 KiB .. 256 MiB
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in items) + '}'
+
+
+class Metrics:
+    """Registry of counters and histograms shared by the processes writing to one directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._definitions = {}  # name -> (type, help, histogram buckets or gauge callback)
+        self._reset()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._snapshot_path = os.path.join(self.directory, f"{self._pid}-{uuid.uuid4().hex[:8]}.json")
+        self._counters = {}     # (name, labels) -> value
+        self._histograms = {}   # (name, labels) -> [per-bucket counts..., +Inf count, sum]
+
+    def _check_pid(self):
+        # A forked child must not overwrite its parent's snapshot
+        if os.getpid() != self._pid:
+            self._reset()
+
+    def counter(self, name, help_text):
+        """Declare a counter."""
+        self._definitions[name] = ('counter', help_text, None)
+
+    def histogram(self, name, help_text, buckets=TIME_BUCKETS):
+        """Declare a histogram with the given upper bucket bounds."""
+        self._definitions[name] = ('histogram', help_text, tuple(buckets))
+
+    def gauge(self, name, help_text, callback):
+        """Declare a gauge whose host-wide value callback() returns at scrape time."""
+        self._definitions[name] = ('gauge', help_text, callback)
+
+    def inc(self, name, amount=1, **labels):
+        """Add amount to a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._check_pid()
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """Record one observation in a histogram."""
+        buckets = self._definitions[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._check_pid()
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [0] * (len(buckets) + 2)
+            index = next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))
+            series[index] += 1
+            series[-1] += value
+
+    def _snapshot(self):
+        with self._lock:
+            self._check_pid()
+            return {
+                'counters': [[name, labels, value] for (name, labels), value in self._counters.items()],
+                'histograms': [[name, labels, list(series)] for (name, labels), series in self._histograms.items()],
+            }
+
+    def flush(self):
+        """Write this process's snapshot for other workers to aggregate."""
+        snapshot = self._snapshot()
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self._snapshot_path)
+        except OSError as e:
+            logger.warning("Could not write metrics snapshot to %s: %s", self.directory, e)
+
+    def _collect(self):
+        """Sum the snapshots of all processes."""
+        self.flush()
+        counters = {}
+        histograms = {}
+        try:
+            paths = [entry.path for entry in os.scandir(self.directory) if entry.name.endswith('.json')]
+        except OSError as e:
+            logger.warning("Could not read metrics directory %s: %s", self.directory, e)
+            paths = []
+
+        for path in paths:
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, labels, value in snapshot.get('counters', []):
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, series in snapshot.get('histograms', []):
+                key = (name, tuple(tuple(label) for label in labels))
+                total = histograms.get(key)
+                if total is None:
+                    histograms[key] = list(series)
+                elif len(total) == len(series):
+                    histograms[key] = [a + b for a, b in zip(total, series)]
+        return counters, histograms
+
+    def render(self):
+        """Return the metrics of all processes in the Prometheus text exposition format."""
+        counters, histograms = self._collect()
+        lines = []
+        for name, (kind, help_text, spec) in sorted(self._definitions.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'gauge':
+                try:
+                    lines.append(f"{name} {_format_value(spec())}")
+                except Exception as e:
+                    logger.warning("Could not read gauge %s: %s", name, e)
+                continue
+            if kind == 'counter':
+                for (series_name, labels), value in sorted(counters.items()):
+                    if series_name == name:
+                        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+
+            for (series_name, labels), series in sorted(histograms.items()):
+                if series_name != name or len(series) != len(spec) + 2:
+                    continue
+                cumulative = 0
+                for bound, count in zip(spec + ('+Inf',), series):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else _format_value(bound)
+                    lines.append(f"{name}_bucket{_format_labels(labels, ('le', le))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(series[-1])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return '\n'.join(lines) + '\n'
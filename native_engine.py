@@ -0,0 +1,294 @@
+"""
+Pure-Python fast path for simple markdown.
+
+Renders the subset of pandoc markdown that most prose uses (ATX headings,
+paragraphs, bullet and ordered lists, emphasis, inline code, links, bare URIs,
+horizontal rules) to XHTML, following the reader extensions the pandoc path
+uses (smart punctuation, hard line breaks, auto identifiers). Anything outside
+that subset raises NativeUnsupported so the caller can fall back to pandoc.
+
+The input is expected to have gone through the app's markdown normalization,
+which puts a blank line before every heading and top-level bullet item.
+"""
+
+import html
+import re
+
+from epub_writer import Chapter
+
+
+class NativeUnsupported(Exception):
+    """The document uses markdown the native engine does not render."""
+
+
+BLOCK_SPLIT_RE = re.compile(r'\n(?:[ \t]*\n)+')
+ATX_HEADING_RE = re.compile(r'^(#{1,6})[ \t]+(.*?)(?:[ \t]+#+)?[ \t]*$')
+HR_RE = re.compile(r'^ {0,3}([-*_])(?:[ \t]*\1){2,}[ \t]*$')
+SETEXT_RE = re.compile(r'^ {0,3}(?:=+|-+)[ \t]*$')
+BULLET_RE = re.compile(r'^( {0,3})([*+-])([ \t]+)(.*)$')
+ORDERED_RE = re.compile(r'^( {0,3})(\d{1,9})([.)])([ \t]+)(.*)$')
+
+# Block starts that need pandoc: code, quotes, tables, line blocks, divs,
+# definition lists, fenced code and metadata blocks
+UNSUPPORTED_LINE_RE = re.compile(r'^(?: {4}|\t| {0,3}(?:>|```|~~~|:::|[:~][ \t]|%)|\s*\|)')
+
+INLINE_RE = re.compile(r'''
+    (?P<code>`(?P<code_text>[^`\n]+)`)
+  | (?P<link>\[(?P<link_text>[^\[\]\n]+)\]\((?P<link_url>[^()\s]+)\))
+  | (?P<autolink><(?P<auto_url>https?://[^<>\s]+)>)
+  | (?P<uri>https?://[^\s<>()\[\]"]*[^\s<>()\[\]".,;:!?'])
+  | \*\*(?=\S)(?P<strong>[^*]+?)(?<=\S)\*\*
+  | (?<![A-Za-z0-9_])__(?=\S)(?P<strong2>[^_]+?)(?<=\S)__(?![A-Za-z0-9_])
+  | \*(?=\S)(?P<em>[^*]+?)(?<=\S)\*
+  | (?<![A-Za-z0-9_])_(?=\S)(?P<em2>[^_]+?)(?<=\S)_(?![A-Za-z0-9_])
+''', re.VERBOSE)
+
+# Characters that start pandoc inline syntax the native engine does not handle
+# (escapes, raw HTML, math, super/subscript, footnotes, spans, unmatched markup)
+UNSUPPORTED_TEXT_RE = re.compile(r'[\\<>$^~`\[\]*{}]|&(?:#\d+|#x[0-9a-fA-F]+|\w+);|(?<![A-Za-z0-9])_|_(?![A-Za-z0-9])')
+
+SMART_RULES = [
+    (re.compile(r'---'), '—'),
+    (re.compile(r'--'), '–'),
+    (re.compile(r'\.\.\.'), '…'),
+    # Apostrophes inside words and after digits
+    (re.compile(r"(?<=[A-Za-z0-9])'(?=[A-Za-z])"), '’'),
+    (re.compile(r"(?:^|(?<=[\s(\[{—–\"]))'(?=\S)"), '‘'),
+    (re.compile(r"'"), '’'),
+    (re.compile(r'(?:^|(?<=[\s(\[{—–‘]))"(?=\S)'), '“'),
+    (re.compile(r'"'), '”'),
+]
+
+
+def smart_punctuation(text):
+    """Apply the typographic replacements of pandoc's smart extension."""
+    for pattern, replacement in SMART_RULES:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def _text(segment):
+    if UNSUPPORTED_TEXT_RE.search(segment):
+        raise NativeUnsupported(f"Unsupported inline markup in: {segment[:40]!r}")
+    return html.escape(smart_punctuation(segment), quote=False)
+
+
+def render_inline(text):
+    """Render inline markdown to XHTML. Raises NativeUnsupported."""
+    out = []
+    pos = 0
+    for match in INLINE_RE.finditer(text):
+        out.append(_text(text[pos:match.start()]))
+        pos = match.end()
+        if match.group('code') is not None:
+            out.append(f"<code>{html.escape(match.group('code_text').strip(), quote=False)}</code>")
+        elif match.group('link') is not None:
+            if text[:match.start()].endswith('!'):
+                raise NativeUnsupported("Image")
+            url = html.escape(match.group('link_url'), quote=True)
+            out.append(f'<a href="{url}">{render_inline(match.group("link_text"))}</a>')
+        elif match.group('autolink') is not None or match.group('uri') is not None:
+            url = match.group('auto_url') or match.group('uri')
+            out.append(f'<a href="{html.escape(url, quote=True)}" class="uri">{html.escape(url, quote=False)}</a>')
+        elif match.group('strong') is not None or match.group('strong2') is not None:
+            out.append(f"<strong>{render_inline(match.group('strong') or match.group('strong2'))}</strong>")
+        else:
+            out.append(f"<em>{render_inline(match.group('em') or match.group('em2'))}</em>")
+    out.append(_text(text[pos:]))
+    return ''.join(out)
+
+
+def render_lines(lines):
+    """Render paragraph lines, turning every newline into a line break (hard_line_breaks)."""
+    return '<br />\n'.join(render_inline(line.strip()) for line in lines)
+
+
+def plain_text(xhtml):
+    """Text content of rendered inline XHTML."""
+    return html.unescape(re.sub(r'<[^>]+>', '', xhtml))
+
+
+def make_identifier(text, used):
+    """Derive a heading id the way pandoc's auto_identifiers extension does."""
+    ident = ''.join(c for c in text if c.isalnum() or c in '_-. ' or c.isspace())
+    ident = '-'.join(ident.split()).lower()
+    # Identifiers may not begin with a number or punctuation
+    while ident and not ident[0].isalpha():
+        ident = ident[1:]
+    ident = ident or 'section'
+    candidate = ident
+    n = 0
+    while candidate in used:
+        n += 1
+        candidate = f"{ident}-{n}"
+    used.add(candidate)
+    return candidate
+
+
+class _ListItem:
+    def __init__(self, text):
+        self.lines = [text]
+        self.sublist = None     # rendered XHTML of a nested (tight) list
+
+
+def _list_marker(line):
+    """Return (ordered, marker_key, start, content, content_column) or None."""
+    m = BULLET_RE.match(line)
+    if m:
+        indent, marker, space, content = m.groups()
+        return False, marker, 1, content, len(indent) + 1 + len(space)
+    m = ORDERED_RE.match(line)
+    if m:
+        indent, number, delim, space, content = m.groups()
+        return True, delim, int(number), content, len(indent) + len(number) + 1 + len(space)
+    return None
+
+
+def _render_list_items(lines, loose):
+    """Parse the lines of one list (items at column 0..3) and render the <li> elements."""
+    items = []
+    first = _list_marker(lines[0])
+    ordered, key, start, content, column = first
+    items.append(_ListItem(content))
+    sub_lines = []
+
+    def close_sublist():
+        if sub_lines:
+            items[-1].sublist = _render_list([line[column:] if line[:column].strip() == '' else line.lstrip()
+                                              for line in sub_lines], loose=False)
+            sub_lines.clear()
+
+    for line in lines[1:]:
+        marker = _list_marker(line)
+        indent = len(line) - len(line.lstrip(' '))
+        if marker is not None and indent < column:
+            if marker[0] != ordered or marker[1] != key:
+                raise NativeUnsupported("Mixed list markers")
+            close_sublist()
+            items.append(_ListItem(marker[3]))
+            column = marker[4]
+        elif indent >= column and (sub_lines or _list_marker(line.lstrip(' ')) is not None):
+            if indent >= column + 4:
+                raise NativeUnsupported("Code block inside list")
+            sub_lines.append(line)
+        else:
+            if sub_lines:
+                raise NativeUnsupported("Text after nested list")
+            items[-1].lines.append(line)
+    close_sublist()
+
+    rendered = []
+    for item in items:
+        content = render_lines(item.lines)
+        if loose:
+            content = f"<p>{content}</p>"
+        if item.sublist:
+            content += '\n' + item.sublist
+        rendered.append(f"<li>{content}</li>")
+    return ordered, start, rendered
+
+
+def _render_list(lines, loose):
+    ordered, start, items = _render_list_items(lines, loose)
+    return _wrap_list(ordered, start, items)
+
+
+def _wrap_list(ordered, start, items):
+    body = '\n'.join(items)
+    if ordered:
+        start_attr = f' start="{start}"' if start != 1 else ''
+        return f'<ol{start_attr}>\n{body}\n</ol>'
+    return f'<ul>\n{body}\n</ul>'
+
+
+def render_blocks(markdown):
+    """
+    Render normalized markdown to a list of (kind, level, id, xhtml) blocks.
+
+    kind is 'heading' or 'block'. Raises NativeUnsupported.
+    """
+    blocks = []
+    used_ids = set()
+    pending_list = None     # (ordered, key, start, [block lines...]) of the list being built
+
+    def flush_list():
+        nonlocal pending_list
+        if pending_list is not None:
+            ordered, _, start, list_blocks = pending_list
+            # Items separated by blank lines make a loose list, whose items are paragraphs
+            loose = len(list_blocks) > 1
+            items = [item for lines in list_blocks for item in _render_list_items(lines, loose)[2]]
+            blocks.append(('block', None, None, _wrap_list(ordered, start, items)))
+            pending_list = None
+
+    queue = [b for b in BLOCK_SPLIT_RE.split(markdown.strip('\n')) if b.strip()]
+    while queue:
+        lines = queue.pop(0).split('\n')
+        for line in lines:
+            if UNSUPPORTED_LINE_RE.match(line) and not _list_marker(line.lstrip(' ')):
+                raise NativeUnsupported(f"Unsupported block: {line[:40]!r}")
+        if any(SETEXT_RE.match(line) for line in lines[1:]):
+            raise NativeUnsupported("Setext heading")
+        if pending_list is not None and lines[0][:1] in (' ', '\t'):
+            # An indented paragraph or list after a blank line continues the last item
+            raise NativeUnsupported("Block inside a list item")
+
+        heading = ATX_HEADING_RE.match(lines[0])
+        if heading:
+            flush_list()
+            level = len(heading.group(1))
+            content = render_inline(heading.group(2))
+            ident = make_identifier(plain_text(content), used_ids)
+            blocks.append(('heading', level, ident, f'<h{level} id="{ident}">{content}</h{level}>'))
+            if len(lines) > 1:
+                queue.insert(0, '\n'.join(lines[1:]))
+            continue
+
+        if len(lines) == 1 and HR_RE.match(lines[0]):
+            flush_list()
+            blocks.append(('block', None, None, '<hr />'))
+            continue
+
+        marker = _list_marker(lines[0])
+        if marker is not None:
+            ordered, key, start, _, _ = marker
+            if pending_list is not None and pending_list[:2] == (ordered, key):
+                pending_list[3].append(lines)
+            else:
+                flush_list()
+                pending_list = (ordered, key, start, [lines])
+            continue
+
+        flush_list()
+        blocks.append(('block', None, None, f"<p>{render_lines(lines)}</p>"))
+
+    flush_list()
+    return blocks
+
+
+def render_chapters(markdown, title):
+    """
+    Render normalized markdown into EPUB chapters split at level-1 headings,
+    as pandoc's EPUB writer does. Raises NativeUnsupported.
+    """
+    chapters = []
+    current = None
+
+    def start_chapter(chapter_title):
+        chapter = {'title': chapter_title, 'parts': [], 'headings': []}
+        chapters.append(chapter)
+        return chapter
+
+    for kind, level, ident, xhtml in render_blocks(markdown):
+        if kind == 'heading' and level == 1:
+            current = start_chapter(plain_text(xhtml))
+        elif current is None:
+            current = start_chapter(title)
+        if kind == 'heading':
+            current['headings'].append((level, ident, plain_text(xhtml)))
+        current['parts'].append(xhtml)
+
+    return [
+        Chapter(f"ch{index + 1:03d}.xhtml", chapter['title'], '\n'.join(chapter['parts']), chapter['headings'])
+        for index, chapter in enumerate(chapters)
+    ]
@@ -0,0 +1,127 @@
+"""
+Time and memory limits for pandoc processes.
+
+Some inputs (deeply nested lists, huge tables) make pandoc run for minutes or
+grow without bound. Each process gets:
+
+- a wall-clock timeout, after which its whole process group is killed;
+- a CPU time limit set with ``prlimit``, which the kernel enforces even when
+  the worker that started pandoc was killed and can no longer time it out;
+- a heap limit through pandoc's runtime options (``+RTS -M<size> -RTS``).
+  An address space rlimit is not used: the GHC runtime reserves a very large
+  address range up front, so pandoc would not even start under one.
+
+Exceeding a limit raises PandocLimitExceeded with the HTTP status to report.
+Long-lived ``pandoc server`` processes (see pandoc_pool) get the heap limit
+only: their CPU time adds up over all the conversions they serve.
+"""
+
+import logging
+import math
+import os
+import signal
+import subprocess
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Exit code of a GHC program that ran out of heap under +RTS -M
+HEAP_EXHAUSTED_EXIT = 251
+
+# Seconds between the CPU soft limit (SIGXCPU) and the hard limit (SIGKILL)
+CPU_GRACE = 5
+
+
+class PandocLimitExceeded(Exception):
+    """A pandoc process was stopped for exceeding a limit ('timeout', 'cpu' or 'memory')."""
+
+    def __init__(self, message, status_code, limit):
+        super().__init__(message)
+        self.status_code = status_code
+        self.limit = limit
+
+
+def kill_process_group(pid):
+    """Kill a process started with start_new_session=True and anything it started."""
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class PandocLimits:
+    """Limits applied to each pandoc process; 0 disables a limit."""
+
+    def __init__(self, cpu_seconds=0, memory_mb=0):
+        """cpu_seconds of 0 limits CPU time to the wall-clock timeout of each run."""
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+
+    def command(self, cmd):
+        """cmd with pandoc's runtime options for the heap limit."""
+        if not self.memory_mb:
+            return cmd
+        return cmd[:1] + ['+RTS', f'-M{self.memory_mb}m', '-RTS'] + cmd[1:]
+
+    def started(self, pid, timeout):
+        """Set the CPU time limit of a process that was just started."""
+        cpu_seconds = self.cpu_seconds or timeout
+        if not cpu_seconds or resource is None or not hasattr(resource, 'prlimit'):
+            return
+        # RLIMIT_CPU counts whole seconds, and 0 would stop pandoc at once
+        cpu_seconds = max(1, math.ceil(cpu_seconds))
+        try:
+            resource.prlimit(pid, resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + CPU_GRACE))
+        except (ProcessLookupError, PermissionError, OSError) as e:
+            logger.warning("Could not limit CPU time of pandoc process %s: %s", pid, e)
+
+    def timeout_exceeded(self, timeout):
+        """The error for a process that was killed after timeout seconds."""
+        return PandocLimitExceeded(f"Conversion did not finish within {timeout:g} seconds", 504, 'timeout')
+
+    def memory_exceeded(self):
+        """The error for a process that ran out of heap."""
+        return PandocLimitExceeded(f"Document is too complex to convert within {self.memory_mb} MB of memory", 413,
+                                   'memory')
+
+    def check(self, returncode, stderr):
+        """Raise PandocLimitExceeded if a finished process was stopped by the CPU or heap limit."""
+        if returncode == -signal.SIGXCPU:
+            raise PandocLimitExceeded("Conversion exceeded its CPU time limit", 504, 'cpu')
+        if self.memory_mb and returncode == HEAP_EXHAUSTED_EXIT and 'Heap exhausted' in (stderr or ''):
+            raise self.memory_exceeded()
+
+    def run(self, cmd, input=None, text=False, timeout=0):
+        """
+        subprocess.run() for a pandoc command line under the limits.
+
+        The process runs in its own process group, which is killed after
+        timeout seconds (0 for none). Returns a CompletedProcess; raises
+        PandocLimitExceeded on timeout. The CPU and heap limits are reported
+        by check().
+        """
+        process = subprocess.Popen(
+            self.command(cmd),
+            stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=text,
+            start_new_session=True
+        )
+        self.started(process.pid, timeout)
+        try:
+            stdout, stderr = process.communicate(input, timeout=timeout or None)
+        except subprocess.TimeoutExpired:
+            kill_process_group(process.pid)
+            process.communicate()
+            logger.warning("Killed pandoc process %s after %s seconds", process.pid, timeout)
+            raise self.timeout_exceeded(timeout)
+        except BaseException:
+            kill_process_group(process.pid)
+            process.wait()
+            raise
+        return subprocess.CompletedProcess(process.args, process.returncode, stdout, stderr)
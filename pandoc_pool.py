@@ -0,0 +1,344 @@
+"""
+Pool of long-lived ``pandoc server`` processes.
+
+Starting pandoc's Haskell runtime dominates the latency of small conversions,
+so each worker keeps a few pandoc server processes warm and sends conversions
+to their JSON API. Processes are health-checked before use and recycled after
+a configurable number of jobs; replacements are started in a background
+thread, never in the thread of a conversion. Any failure is reported as
+PandocPoolError so the caller can fall back to the one-shot subprocess path.
+
+Each conversion has a timeout. A server whose conversion runs past it is
+restarted, as the server keeps working on a request after its client gave up,
+and the conversion is reported as PandocPoolTimeout. With PandocLimits the
+servers run under the heap limit of one-shot processes; a conversion that
+exhausts it takes its server down and raises PandocLimitExceeded. The CPU
+time limit is not used, as a server's CPU time adds up over its conversions;
+the timeout stops runaway conversions instead.
+"""
+
+import atexit
+import base64
+import json
+import logging
+import math
+import queue
+import shlex
+import socket
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from pandoc_limits import HEAP_EXHAUSTED_EXIT
+from structured_logging import clip
+
+logger = logging.getLogger(__name__)
+
+# pandoc server always has a timeout; this one stands in for none
+NO_TIMEOUT = 86400
+
+# Seconds between attempts to start a replacement for a server that could not be restarted
+RESPAWN_DELAY = 5
+
+
+class PandocPoolError(Exception):
+    """Raised when the pool cannot perform a conversion."""
+
+
+class PandocPoolTimeout(PandocPoolError):
+    """Raised when a conversion did not finish within its timeout."""
+
+    def __init__(self, message, timeout):
+        super().__init__(message)
+        self.timeout = timeout
+
+
+def server_request_from_args(args, text, metadata):
+    """
+    Translate a pandoc argument vector into a pandoc server request body.
+
+    Only the options used by the converter are understood; anything else
+    raises PandocPoolError so the caller uses the subprocess path instead.
+    """
+    body = {'text': text, 'metadata': dict(metadata)}
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == '-t':
+            body['to'] = args[i + 1]
+            i += 1
+        elif arg == '-f':
+            body['from'] = args[i + 1]
+            i += 1
+        elif arg == '--standalone':
+            body['standalone'] = True
+        elif arg == '--toc':
+            body['table-of-contents'] = True
+        elif arg.startswith('--toc-depth='):
+            body['toc-depth'] = int(arg.split('=', 1)[1])
+        elif arg.startswith('--wrap='):
+            body['wrap'] = arg.split('=', 1)[1]
+        elif arg == '--preserve-tabs':
+            body['preserve-tabs'] = True
+        elif arg.startswith('--reference-location='):
+            body['reference-location'] = arg.split('=', 1)[1]
+        elif arg.startswith('--shift-heading-level-by='):
+            body['shift-heading-level-by'] = int(arg.split('=', 1)[1])
+        elif arg == '--metadata':
+            # Command line metadata overrides the metadata file, as in pandoc
+            key, _, value = args[i + 1].partition('=')
+            body['metadata'][key] = value
+            i += 1
+        else:
+            raise PandocPoolError(f"Option not supported by pandoc server: {arg}")
+        i += 1
+    return body
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class _ServerProcess:
+    """A single pandoc server process listening on a local port."""
+
+    def __init__(self, command, request_timeout):
+        self.port = _free_port()
+        self.jobs = 0
+        self.last_check = 0.0
+        self.process = subprocess.Popen(
+            command + ['--port', str(self.port), '--timeout', str(math.ceil(request_timeout) or NO_TIMEOUT)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def exit_code(self, wait):
+        """The exit code of the process, waiting up to wait seconds for it to exit, or None."""
+        try:
+            return self.process.wait(timeout=wait)
+        except subprocess.TimeoutExpired:
+            return None
+
+    def healthy(self, timeout=2):
+        if not self.alive():
+            return False
+        try:
+            with urllib.request.urlopen(f"{self.url}/version", timeout=timeout) as response:
+                ok = response.status == 200
+        except (OSError, urllib.error.URLError):
+            return False
+        self.last_check = time.monotonic()
+        return ok
+
+    def wait_ready(self, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not self.alive():
+                return False
+            if self.healthy(timeout=1):
+                return True
+            time.sleep(0.05)
+        return False
+
+    def stop(self):
+        if self.alive():
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+class PandocServerPool:
+    """Checks pandoc server processes in and out for conversions."""
+
+    def __init__(self, size, max_jobs, health_interval, command='pandoc server',
+                 request_timeout=120, checkout_timeout=5, start_timeout=10, limits=None):
+        """
+        request_timeout is the longest timeout of a conversion, 0 for none.
+        limits is the PandocLimits whose heap limit the servers run under.
+        """
+        self.size = size
+        self.max_jobs = max_jobs
+        self.health_interval = health_interval
+        self.limits = limits
+        self.command = shlex.split(command) if limits is None else limits.command(shlex.split(command))
+        self.request_timeout = request_timeout
+        self.checkout_timeout = checkout_timeout
+        self.start_timeout = start_timeout
+
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._started = False
+        self._disabled = False
+        self._closed = False
+        self._counters = {'jobs': 0, 'spawned': 0, 'recycled': 0, 'unhealthy': 0, 'failures': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _spawn(self):
+        server = _ServerProcess(self.command, self.request_timeout)
+        if not server.wait_ready(self.start_timeout):
+            server.stop()
+            raise PandocPoolError(f"pandoc server on port {server.port} did not become ready")
+        self._count('spawned')
+        logger.info("Started pandoc server on port %s", server.port)
+        return server
+
+    def start(self):
+        """
+        Start the server processes, once; a pool that cannot be started is disabled.
+
+        Call it in the process that uses the pool (each gunicorn worker), not
+        before forking. Callers that come while the pool starts wait for it.
+        """
+        with self._start_lock:
+            if self._started or self._disabled:
+                return
+            try:
+                for _ in range(self.size):
+                    self._idle.put(self._spawn())
+            except (OSError, PandocPoolError) as e:
+                logger.error("Could not start pandoc server pool, using subprocess engine: %s", e)
+                self._disabled = True
+                self.shutdown()
+                return
+            self._started = True
+        atexit.register(self.shutdown)
+
+    def _checkout(self):
+        deadline = time.monotonic() + self.checkout_timeout
+        while True:
+            try:
+                server = self._idle.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                raise PandocPoolError("No pandoc server available")
+
+            due = time.monotonic() - server.last_check > self.health_interval
+            if server.alive() and not (due and not server.healthy()):
+                return server
+            logger.warning("pandoc server on port %s failed its health check, restarting", server.port)
+            self._count('unhealthy')
+            self._replace(server)
+
+    def _checkin(self, server, busy=False):
+        """Return a server to the pool; busy servers are still converting and get restarted."""
+        server.jobs += 1
+        if busy:
+            logger.warning("Restarting pandoc server on port %s, which is still busy with a timed-out conversion",
+                           server.port)
+            self._replace(server)
+        elif server.jobs >= self.max_jobs:
+            logger.debug("Recycling pandoc server on port %s after %s jobs", server.port, server.jobs)
+            self._count('recycled')
+            self._replace(server)
+        else:
+            self._idle.put(server)
+
+    def _replace(self, server):
+        """Stop server and start its replacement in the background; the pool is one server short meanwhile."""
+        threading.Thread(target=self._respawn, args=(server,), name='pandoc-pool-respawn', daemon=True).start()
+
+    def _respawn(self, server):
+        server.stop()
+        while not self._closed:
+            try:
+                replacement = self._spawn()
+            except (OSError, PandocPoolError) as e:
+                # Conversions fall back to the subprocess engine while no server is idle
+                logger.error("Could not restart pandoc server, retrying in %s seconds: %s", RESPAWN_DELAY, e)
+                time.sleep(RESPAWN_DELAY)
+                continue
+            with self._lock:
+                if not self._closed:
+                    self._idle.put(replacement)
+                    return
+            replacement.stop()
+
+    @property
+    def available(self):
+        if not self._started:
+            self.start()
+        return not self._disabled
+
+    def convert(self, args, text, metadata, timeout=None):
+        """
+        Run a conversion on a pooled server and return the output bytes.
+
+        The conversion may take timeout seconds (request_timeout for None, 0 for
+        no limit); raises PandocPoolTimeout when it takes longer, and
+        PandocLimitExceeded when it exhausts the heap limit.
+        """
+        if not self.available:
+            raise PandocPoolError("pandoc server pool is disabled")
+
+        if timeout is None:
+            timeout = self.request_timeout
+        body = json.dumps(server_request_from_args(args, text, metadata)).encode('utf-8')
+        server = self._checkout()
+        busy = False
+        try:
+            req = urllib.request.Request(
+                server.url,
+                data=body,
+                headers={'Content-Type': 'application/json', 'Accept': 'application/json'},
+                method='POST',
+            )
+            # The server answers only when it is done, so the socket timeout bounds the conversion
+            with urllib.request.urlopen(req, timeout=timeout or None) as response:
+                result = json.loads(response.read())
+        except (OSError, ValueError, urllib.error.URLError) as e:
+            self._count('failures')
+            if isinstance(e, TimeoutError) or isinstance(getattr(e, 'reason', None), TimeoutError):
+                busy = True
+                raise PandocPoolTimeout(f"pandoc server conversion did not finish within {timeout:g} seconds",
+                                        timeout)
+            if self.limits is not None and self.limits.memory_mb and server.exit_code(wait=1) == HEAP_EXHAUSTED_EXIT:
+                logger.warning("pandoc server on port %s ran out of heap", server.port)
+                raise self.limits.memory_exceeded()
+            raise PandocPoolError(f"pandoc server request failed: {str(e)}")
+        finally:
+            self._checkin(server, busy)
+
+        if 'error' in result:
+            self._count('failures')
+            raise PandocPoolError(f"pandoc server error: {result['error']}")
+        for message in result.get('messages', []):
+            logger.debug("pandoc server: %s", clip(message))
+
+        self._count('jobs')
+        output = result.get('output', '')
+        if result.get('base64'):
+            return base64.b64decode(output)
+        return output.encode('utf-8')
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats['size'] = self.size
+        stats['idle'] = self._idle.qsize()
+        stats['enabled'] = self._started and not self._disabled
+        return stats
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().stop()
+            except queue.Empty:
+                break
@@ -0,0 +1,108 @@
+"""
+Size-limited, decompressing request body streams.
+
+install_body_stream() replaces the WSGI input of a request with a stream that
+undoes its Content-Encoding (gzip, or zstd when the ``zstandard`` package is
+installed) and raises BodyTooLarge as soon as more than the allowed number of
+decoded bytes has been read. Flask's JSON and form parsing, as well as code
+reading ``request.stream`` directly, then see the decoded body, and the limit
+is enforced while the body arrives instead of after it has been buffered.
+"""
+
+import gzip
+import io
+import zlib
+
+from werkzeug.wsgi import get_input_stream
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+IDENTITY_ENCODINGS = ('', 'identity')
+GZIP_ENCODINGS = ('gzip', 'x-gzip')
+ZSTD_ENCODINGS = ('zstd',)
+
+
+class BodyTooLarge(Exception):
+    """The decoded request body exceeds the configured maximum."""
+
+    def __init__(self, limit):
+        super().__init__(f"Request body exceeds the maximum input size of {limit} bytes")
+        self.limit = limit
+
+
+class UnsupportedEncoding(Exception):
+    """The request uses a Content-Encoding that cannot be decoded."""
+
+    def __init__(self, encoding):
+        super().__init__(f"Unsupported Content-Encoding: {encoding}")
+        self.encoding = encoding
+
+
+class BodyDecodeError(Exception):
+    """The compressed request body is corrupt or truncated."""
+
+
+def supported_encodings():
+    """Content-Encodings install_body_stream() can decode."""
+    return GZIP_ENCODINGS + (ZSTD_ENCODINGS if zstandard is not None else ())
+
+
+class DecodedBody(io.RawIOBase):
+    """Reads a request body through its decoder, counting decoded bytes against a limit."""
+
+    def __init__(self, source, max_bytes):
+        self._source = source
+        self.max_bytes = max_bytes
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        try:
+            data = self._source.read(len(buffer))
+        except (OSError, EOFError, zlib.error) as e:
+            raise BodyDecodeError(f"Request body could not be decompressed: {str(e)}")
+        except Exception as e:
+            if zstandard is not None and isinstance(e, zstandard.ZstdError):
+                raise BodyDecodeError(f"Request body could not be decompressed: {str(e)}")
+            raise
+
+        self.bytes_read += len(data)
+        if self.max_bytes > 0 and self.bytes_read > self.max_bytes:
+            raise BodyTooLarge(self.max_bytes)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def install_body_stream(environ, max_bytes):
+    """
+    Replace the WSGI input of a request with its decoded, size-limited body.
+
+    Must be called before anything reads the request body. Raises
+    UnsupportedEncoding for unknown encodings and BodyTooLarge when the
+    declared length of an uncompressed body is already over the limit.
+    """
+    encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+    raw = get_input_stream(environ)
+
+    if encoding in IDENTITY_ENCODINGS:
+        content_length = environ.get('CONTENT_LENGTH')
+        if max_bytes > 0 and content_length and content_length.isdigit() and int(content_length) > max_bytes:
+            raise BodyTooLarge(max_bytes)
+        source = raw
+    elif encoding in GZIP_ENCODINGS:
+        source = gzip.GzipFile(fileobj=raw, mode='rb')
+    elif encoding in ZSTD_ENCODINGS and zstandard is not None:
+        source = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+    else:
+        raise UnsupportedEncoding(encoding)
+
+    environ['wsgi.input'] = io.BufferedReader(DecodedBody(source, max_bytes))
+    # The decoded length is unknown; let readers consume the stream to its end
+    environ.pop('CONTENT_LENGTH', None)
+    environ.pop('HTTP_CONTENT_ENCODING', None)
+    environ['wsgi.input_terminated'] = True
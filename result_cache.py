@@ -0,0 +1,288 @@
+"""
+Content-addressed result cache for generated EPUB files (and parsed documents).
+
+Entries are keyed by a hash of the resolved metadata, the pandoc argument
+vector and the normalized markdown, which can be hashed incrementally while a
+request body is read. Results live in two tiers: a small in-process
+LRU tier and a disk tier under a directory that every gunicorn worker on the
+host shares. Both tiers evict by age (TTL) and by total size, least recently
+used first.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+
+logger = logging.getLogger(__name__)
+
+# Bump when the layout of cached entries or keys changes so old entries are ignored
+CACHE_FORMAT_VERSION = 2
+
+
+def cache_key_hasher(metadata, pandoc_args):
+    """
+    Return a sha256 object primed with everything but the markdown.
+
+    Feed the normalized markdown to it with ``update()`` as UTF-8, in one piece
+    or in chunks; its hex digest is the same as ``cache_key()``.
+    """
+    payload = json.dumps(
+        {
+            'version': CACHE_FORMAT_VERSION,
+            'metadata': metadata,
+            'args': list(pandoc_args),
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    hasher = hashlib.sha256(payload.encode('utf-8'))
+    hasher.update(b'\0')
+    return hasher
+
+
+def cache_key(markdown, metadata, pandoc_args):
+    """Return the hex digest identifying a conversion result."""
+    hasher = cache_key_hasher(metadata, pandoc_args)
+    hasher.update(markdown.encode('utf-8'))
+    return hasher.hexdigest()
+
+
+class ResultCache:
+    """
+    Two-tier (memory + shared disk) cache of EPUB bytes.
+
+    Disk entries are named ``<key><suffix>``; caches of other kinds of data
+    pass a suffix of their own so that they never mix with EPUB entries.
+    """
+
+    def __init__(self, directory, max_memory_bytes, max_disk_bytes, ttl, suffix='.epub'):
+        self.directory = directory
+        self.suffix = suffix
+        self.max_memory_bytes = max_memory_bytes
+        # Large results are only kept on disk, where they can be streamed
+        self.max_memory_entry_bytes = max_memory_bytes // 16
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> (created, data)
+        self._memory_bytes = 0
+        self._counters = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+        }
+
+        if self.max_disk_bytes > 0:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+            except OSError as e:
+                logger.error("Could not create cache directory %s: %s", self.directory, e)
+                self.max_disk_bytes = 0
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def _expired(self, created, now):
+        return self.ttl > 0 and now - created > self.ttl
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def open(self, key):
+        """
+        Return a binary file object for the cached EPUB or ``None`` on a miss.
+
+        Small entries come from memory; large disk entries are returned as open
+        files so they can be streamed without loading them into memory.
+        """
+        now = time.time()
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, data = entry
+                if self._expired(created, now):
+                    self._drop_memory(key)
+                    self._counters['evictions'] += 1
+                else:
+                    self._memory.move_to_end(key)
+                    self._counters['memory_hits'] += 1
+                    return BytesIO(data)
+
+        f = self._open_disk(key, now)
+        if f is None:
+            self._count('misses')
+            return None
+
+        self._count('disk_hits')
+        size = os.fstat(f.fileno()).st_size
+        if size <= self.max_memory_entry_bytes:
+            with f:
+                data = f.read()
+            self._store_memory(key, data, now)
+            return BytesIO(data)
+        return f
+
+    def get(self, key):
+        """Return the cached EPUB bytes for ``key`` or ``None`` on a miss."""
+        f = self.open(key)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def put(self, key, data):
+        """Store EPUB bytes under ``key`` in both tiers."""
+        now = time.time()
+        self._store_memory(key, data, now)
+        self._write_disk(key, data)
+        self._count('stores')
+
+    def put_file(self, key, path):
+        """Store the EPUB file at ``path`` under ``key`` without buffering large files."""
+        now = time.time()
+        size = os.path.getsize(path)
+        if size <= self.max_memory_entry_bytes:
+            with open(path, 'rb') as f:
+                self._store_memory(key, f.read(), now)
+        self._link_disk(key, path, size)
+        self._count('stores')
+
+    def stats(self):
+        """Return the hit/miss counters and current tier sizes for this worker."""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['memory_entries'] = len(self._memory)
+            stats['memory_bytes'] = self._memory_bytes
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_ratio'] = round((lookups - stats['misses']) / lookups, 4) if lookups else 0.0
+        stats['pid'] = os.getpid()
+        return stats
+
+    # Memory tier
+
+    def _drop_memory(self, key):
+        _, data = self._memory.pop(key)
+        self._memory_bytes -= len(data)
+
+    def _store_memory(self, key, data, now):
+        if len(data) > self.max_memory_entry_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._drop_memory(key)
+            self._memory[key] = (now, data)
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.max_memory_bytes:
+                oldest = next(iter(self._memory))
+                self._drop_memory(oldest)
+                self._counters['evictions'] += 1
+
+    # Disk tier
+
+    def _open_disk(self, key, now):
+        if self.max_disk_bytes <= 0:
+            return None
+        path = self._entry_path(key)
+        try:
+            created = os.path.getmtime(path)
+            if self._expired(created, now):
+                os.remove(path)
+                self._count('evictions')
+                return None
+            # An open file stays readable even if another worker evicts the entry
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning("Could not read cache entry %s: %s", path, e)
+            return None
+        try:
+            # The access time orders eviction, the modification time is the entry's age
+            os.utime(path, (now, created))
+        except OSError:
+            pass
+        return f
+
+    def _link_disk(self, key, path, size):
+        if self.max_disk_bytes <= 0 or size > self.max_disk_bytes:
+            return
+        tmp_path = os.path.join(self.directory, f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            try:
+                # A hard link avoids copying when the source is on the same filesystem
+                os.link(path, tmp_path)
+            except OSError:
+                shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, self._entry_path(key))
+        except OSError as e:
+            logger.warning("Could not write cache entry for %s: %s", key, e)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self._prune_disk()
+
+    def _write_disk(self, key, data):
+        if self.max_disk_bytes <= 0 or len(data) > self.max_disk_bytes:
+            return
+        try:
+            # Write to a private file first so other workers never see a partial entry
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._entry_path(key))
+        except OSError as e:
+            logger.warning("Could not write cache entry for %s: %s", key, e)
+            return
+        self._prune_disk()
+
+    def _prune_disk(self):
+        """Drop expired entries, then the least recently used ones until the tier fits its budget."""
+        now = time.time()
+        entries = []
+        total = 0
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if not entry.name.endswith(self.suffix):
+                        continue
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_atime, st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+        except OSError as e:
+            logger.warning("Could not scan cache directory %s: %s", self.directory, e)
+            return
+
+        entries.sort()
+        evicted = 0
+        for _, mtime, size, path in entries:
+            if not self._expired(mtime, now) and total <= self.max_disk_bytes:
+                continue
+            try:
+                os.remove(path)
+                evicted += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning("Could not evict cache entry %s: %s", path, e)
+                continue
+            total -= size
+        if evicted:
+            self._count('evictions', evicted)
+            logger.debug("Evicted %s entries from disk cache", evicted)
@@ -0,0 +1,176 @@
+"""
+Store of finished conversions that clients download later by URL.
+
+With ``POST /convert?delivery=url`` the EPUB is put into the result store
+and the client gets a download URL instead of the bytes, so a dropped
+connection on a large book costs a resumed download rather than another
+conversion. Results expire after a TTL.
+
+ResultStore is the interface of a backend. It is shaped after object
+storage: results are immutable blobs under random ids with a small metadata
+record, and a backend may hand out its own (e.g. presigned) download URLs.
+LocalResultStore keeps them in a directory shared by all workers on the host
+and leaves serving them to the app.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from abc import ABC, abstractmethod
+
+logger = logging.getLogger(__name__)
+
+RESULT_STORE_BACKENDS = ('local',)
+
+# Seconds between scans for expired results
+PRUNE_INTERVAL = 300
+
+
+class StoredResult:
+    """A result in the store: where to read it and what to send with it."""
+
+    def __init__(self, result_id, path, filename, content_type, size, created_at, expires_at):
+        self.result_id = result_id
+        self.path = path
+        self.filename = filename
+        self.content_type = content_type
+        self.size = size
+        self.created_at = created_at
+        self.expires_at = expires_at
+
+    @property
+    def etag(self):
+        """A strong validator: the bytes of a result never change."""
+        return self.result_id
+
+
+class ResultStore(ABC):
+    """Interface of result store backends."""
+
+    @abstractmethod
+    def put(self, source, filename, content_type):
+        """
+        Store a result and return its StoredResult.
+
+        source is the path of a file or a binary file object.
+        """
+
+    @abstractmethod
+    def get(self, result_id):
+        """The StoredResult for result_id, or None when it does not exist or has expired."""
+
+    def download_url(self, result):
+        """A URL at which the backend serves result itself, or None when the app serves it."""
+        return None
+
+    @abstractmethod
+    def delete(self, result_id):
+        """Remove a result before it expires."""
+
+
+class LocalResultStore(ResultStore):
+    """Results as ``<id>.bin`` files with ``<id>.json`` records in a local directory."""
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+        self._last_prune = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _base_path(self, result_id):
+        return os.path.join(self.directory, result_id)
+
+    def put(self, source, filename, content_type):
+        self._prune()
+        result_id = uuid.uuid4().hex
+        base_path = self._base_path(result_id)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            if isinstance(source, str):
+                os.close(fd)
+                os.remove(tmp_path)
+                try:
+                    os.link(source, tmp_path)
+                except OSError:
+                    shutil.copyfile(source, tmp_path)
+            else:
+                with os.fdopen(fd, 'wb') as f:
+                    shutil.copyfileobj(source, f)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, base_path + '.bin')
+
+            # The record is written last: it makes the result visible
+            created_at = time.time()
+            record = {'filename': filename, 'content_type': content_type, 'size': size, 'created_at': created_at}
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(record, f)
+            os.replace(tmp_path, base_path + '.json')
+        except BaseException:
+            for path in (tmp_path, base_path + '.bin'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            raise
+        return StoredResult(result_id, base_path + '.bin', filename, content_type, size, created_at,
+                            created_at + self.ttl)
+
+    def get(self, result_id):
+        if not result_id.isalnum():
+            return None
+        base_path = self._base_path(result_id)
+        try:
+            with open(base_path + '.json', 'r', encoding='utf-8') as f:
+                record = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        expires_at = record['created_at'] + self.ttl
+        if time.time() > expires_at or not os.path.exists(base_path + '.bin'):
+            self.delete(result_id)
+            return None
+        return StoredResult(result_id, base_path + '.bin', record['filename'], record['content_type'],
+                            record['size'], record['created_at'], expires_at)
+
+    def delete(self, result_id):
+        # The record goes first, so a half-deleted result is never served
+        for suffix in ('.json', '.bin'):
+            try:
+                os.remove(self._base_path(result_id) + suffix)
+            except FileNotFoundError:
+                pass
+
+    def _prune(self):
+        """Remove expired results, at most every PRUNE_INTERVAL."""
+        now = time.time()
+        if now - self._last_prune < PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        try:
+            names = os.listdir(self.directory)
+        except OSError as e:
+            logger.warning("Could not list result store directory %s: %s", self.directory, e)
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(path) <= self.ttl:
+                    continue
+                if name.endswith('.json'):
+                    self.delete(name[:-len('.json')])
+                elif name.endswith(('.bin', '.tmp')):
+                    # Left behind by a worker that died while storing
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def create_result_store(backend, directory, ttl):
+    """The ResultStore for a RESULT_STORE backend name (see RESULT_STORE_BACKENDS)."""
+    if backend == 'local':
+        return LocalResultStore(directory, ttl)
+    raise ValueError(f"Unknown result store backend: {backend}")
@@ -0,0 +1,130 @@
+"""
+Logging setup: plain text or JSON lines, request correlation and debug sampling.
+
+- Every record carries the id of the request (or job) it belongs to, taken
+  from a context variable, so all lines of one conversion can be found
+  together across stages, job threads and batch processes.
+- ``json`` format writes one object per line with the message, level, logger,
+  request id and any ``extra`` fields, for log shippers.
+- Debug output can be sampled: with a rate below 1, only that fraction of
+  requests logs its debug detail, all of it, so sampled requests stay
+  complete. Records that are filtered out are never formatted.
+- ``clip()`` wraps large payloads (pandoc output, document text) so they are
+  truncated, and only when the record is actually written.
+
+Log calls should pass arguments (``logger.info("Converted %s", name)``)
+instead of pre-formatting f-strings, so disabled levels cost no formatting.
+"""
+
+import contextvars
+import json
+import logging
+import random
+import sys
+import time
+import uuid
+
+LOG_FORMATS = ('text', 'json')
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
+
+request_id_var = contextvars.ContextVar('request_id', default='-')
+debug_sampled_var = contextvars.ContextVar('debug_sampled', default=True)
+
+# LogRecord attributes that are not user-supplied extra fields
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'request_id'}
+
+
+# Characters of a clipped payload that are logged (0 for no limit)
+payload_limit = 2048
+
+
+class ClippedText:
+    """Text for a log argument that is truncated when, and only when, it is formatted."""
+
+    __slots__ = ('text', 'limit')
+
+    def __init__(self, text, limit):
+        self.text = text
+        self.limit = limit
+
+    def __str__(self):
+        text = self.text if isinstance(self.text, str) else str(self.text)
+        if self.limit <= 0 or len(text) <= self.limit:
+            return text
+        return f"{text[:self.limit]}... [{len(text) - self.limit} more characters]"
+
+
+def clip(text, limit=None):
+    """Wrap a large payload for logging; it is cut to payload_limit characters."""
+    return ClippedText(text, payload_limit if limit is None else limit)
+
+
+def new_request_id():
+    return uuid.uuid4().hex
+
+
+def start_request(request_id, debug_sample_rate):
+    """Bind a request id to the current context and decide whether its debug detail is logged."""
+    request_id_var.set(request_id)
+    debug_sampled_var.set(debug_sample_rate >= 1 or random.random() < debug_sample_rate)
+
+
+def log_context():
+    """The current request id and sampling decision, to hand to another process."""
+    return request_id_var.get(), debug_sampled_var.get()
+
+
+def bind_log_context(context):
+    """Continue logging for the request described by a log_context() value."""
+    request_id, sampled = context
+    request_id_var.set(request_id)
+    debug_sampled_var.set(sampled)
+
+
+class ContextFilter(logging.Filter):
+    """Adds the request id to records and drops debug records of unsampled requests."""
+
+    def filter(self, record):
+        if record.levelno < logging.INFO and not debug_sampled_var.get():
+            return False
+        record.request_id = request_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record."""
+
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def configure_logging(level, log_format, max_payload=None):
+    """Install a stdout handler with the given level name and format on the root logger."""
+    global payload_limit
+    if max_payload is not None:
+        payload_limit = max_payload
+    handler = logging.StreamHandler(sys.stdout)
+    handler.addFilter(ContextFilter())
+    if log_format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Test script for admission control: pandoc slots are granted up to the limit,
+further requests queue, and a full queue, a queue timeout or low memory turn
+requests away with 429 or 503.
+"""
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import admission
+from admission import AdmissionController, AdmissionRejected
+
+
+@pytest.fixture
+def make_controller():
+    directories = []
+
+    def make(max_active=2, max_queued=1, queue_timeout=0.2, min_free_bytes=0):
+        directories.append(tempfile.mkdtemp())
+        return AdmissionController(directories[-1], max_active=max_active, max_queued=max_queued,
+                                   queue_timeout=queue_timeout, min_free_bytes=min_free_bytes, retry_after=7)
+    yield make
+    for directory in directories:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def test_slots_are_granted_up_to_the_limit(make_controller):
+    """max_active slots are handed out at once and counted host-wide."""
+    controller = make_controller(max_active=2)
+    first, second = controller.acquire(), controller.acquire()
+    assert controller.state() == {'active': 2, 'queued': 0}
+    first.release()
+    second.release()
+    assert controller.state() == {'active': 0, 'queued': 0}
+    print("✓ slots granted and released")
+
+
+def test_full_queue_is_rejected_with_429(make_controller):
+    """With every slot busy and no queue space, a request gets 429 at once."""
+    controller = make_controller(max_active=1, max_queued=0)
+    slot = controller.acquire()
+    try:
+        with pytest.raises(AdmissionRejected) as rejected:
+            controller.acquire()
+        assert (rejected.value.reason, rejected.value.status_code, rejected.value.retry_after) == ('queue_full', 429, 7)
+    finally:
+        slot.release()
+    print("✓ queue_full → 429")
+
+
+def test_queue_timeout_is_rejected_with_503(make_controller):
+    """A queued request that gets no slot in time gets 503 and gives up its queue position."""
+    controller = make_controller(max_active=1, max_queued=1, queue_timeout=0.1)
+    slot = controller.acquire()
+    try:
+        with pytest.raises(AdmissionRejected) as rejected:
+            controller.acquire()
+        assert (rejected.value.reason, rejected.value.status_code) == ('timeout', 503)
+        assert controller.state() == {'active': 1, 'queued': 0}
+    finally:
+        slot.release()
+    print("✓ timeout → 503")
+
+
+def test_queued_request_gets_a_released_slot(make_controller):
+    """A queued request proceeds as soon as a slot is released."""
+    controller = make_controller(max_active=1, max_queued=1, queue_timeout=5)
+    slot = controller.acquire()
+    threading.Timer(0.1, slot.release).start()
+    controller.acquire().release()
+
+    slot = controller.acquire()
+    threading.Timer(0.1, slot.release).start()
+    asyncio.run(controller.acquire_async()).release()
+    print("✓ queued requests get released slots")
+
+
+def test_low_memory_is_rejected_with_503(make_controller, monkeypatch):
+    """Less than min_free_bytes of available memory turns requests away before pandoc starts."""
+    controller = make_controller(min_free_bytes=64 * 1024 * 1024)
+    monkeypatch.setattr(admission, 'available_memory', lambda: 10 * 1024 * 1024)
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire()
+    assert (rejected.value.reason, rejected.value.status_code) == ('memory', 503)
+    assert controller.state() == {'active': 0, 'queued': 0}
+
+    monkeypatch.setattr(admission, 'available_memory', lambda: None)
+    controller.acquire().release()
+    print("✓ low memory → 503")
+
+
+def test_rejection_response():
+    """The app answers a rejected conversion with its status code and a Retry-After header."""
+    import app
+    with app.app.app_context():
+        response = app.error_response(app.admission_error(
+            AdmissionRejected('queue_full', "Too many conversions in progress", 429, 7)))
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '7'
+    assert response.get_json() == {'error': "Too many conversions in progress"}
+    print("✓ 429 response with Retry-After")
+
+
+
+def test_pandoc_timeout_is_cut_to_the_request_deadline():
+    """A request's pandoc run ends before the worker timeout, and one with no time left gets 503."""
+    import app
+    context = app.contextvars.copy_context()
+
+    def timeout_with(remaining, pandoc_timeout):
+        app.pandoc_timeout_var.set(pandoc_timeout)
+        app.request_deadline_var.set(None if remaining is None else time.monotonic() + remaining)
+        return app.pandoc_timeout()
+
+    assert context.run(timeout_with, None, 25) == 25
+    assert context.run(timeout_with, 60, 25) == 25
+    assert context.run(timeout_with, 10, 25) == pytest.approx(10, abs=0.2)
+    assert context.run(timeout_with, 10, 0) == pytest.approx(10, abs=0.2)
+    with pytest.raises(app.ConversionError) as error:
+        context.run(timeout_with, 0.5, 25)
+    assert (error.value.status_code, error.value.retry_after) == (503, app.RETRY_AFTER)
+    print("✓ pandoc timeout within the request deadline")
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Test script for splitting manuscripts for parallel conversion and merging the
+parts: definitions reach every chunk, footnotes are numbered through the
+book, and links find their targets in other chapter files.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from chunked_epub import link_chapters, make_chunks, merge_fragments, renumber_footnotes, split_sections
+
+
+def note_html(number):
+    return (f'<a href="#fn{number}" class="footnote-ref" id="fnref{number}" role="doc-noteref">'
+            f'<sup>{number}</sup></a>')
+
+
+def notes_section(*numbers):
+    items = ''.join(f'<li id="fn{n}"><p>Note.<a href="#fnref{n}" class="footnote-back">↩︎</a></p></li>'
+                    for n in numbers)
+    return f'<section id="footnotes" class="footnotes footnotes-end-of-document"><hr /><ol>{items}</ol></section>'
+
+
+def test_split_at_level_one_headings():
+    """Sections start at level-1 headings outside code, and definitions are taken out."""
+    markdown = ("Preamble.\n\n# One\n\nSee [home][h].[^a]\n\n```\n# not a heading\n```\n\n"
+                "## Sub\n\nTwo\n===\n\nText.\n\n[h]: https://example.com\n\n[^a]: The note.")
+    sections, links, footnotes = split_sections(markdown)
+    assert [section.strip().split('\n')[0] for section in sections] == ['Preamble.', '# One', 'Two']
+    assert links == ['[h]: https://example.com']
+    assert footnotes == {'a': '[^a]: The note.'}
+    print("✓ sections and definitions")
+
+
+def test_chunks_carry_their_definitions():
+    """Every chunk has the link definitions, and the footnote definitions it references."""
+    markdown = ("# One\n\nA [link][h] and a note[^a].\n\n# Two\n\nAnother note[^b].\n\n"
+                "[h]: https://example.com\n\n[^a]: First.\n\n[^b]: Second.")
+    one, two = make_chunks(markdown, target_size=1)
+    assert '[h]: https://example.com' in one and '[h]: https://example.com' in two
+    assert '[^a]: First.' in one and '[^b]:' not in one
+    assert '[^b]: Second.' in two and '[^a]:' not in two
+    print("✓ definitions copied into chunks")
+
+
+def test_renumber_footnotes():
+    """Footnote ids, links, markers and the notes list of a chunk are shifted by the offset."""
+    fragment = f'<p>A{note_html(1)} B{note_html(2)}</p>{notes_section(1, 2)}'
+    shifted, count = renumber_footnotes(fragment, 3)
+    assert count == 2
+    assert 'id="fnref4"' in shifted and 'href="#fn5"' in shifted and '<sup>5</sup>' in shifted
+    assert 'id="fn4"' in shifted and 'href="#fnref5"' in shifted
+    assert '<ol start="4">' in shifted
+    assert 'fn1"' not in shifted and 'fnref2"' not in shifted
+    assert renumber_footnotes(fragment, 0) == (fragment, 2)
+    print("✓ footnotes renumbered")
+
+
+def test_merged_chapters_number_footnotes_through_the_book():
+    """Merging chunks continues footnote numbers and names chapters after their headings."""
+    first = f'<p>Intro{note_html(1)}</p>{notes_section(1)}<h1 id="one">One</h1><p>x{note_html(2)}</p>{notes_section(2)}'
+    second = f'<h1 id="two">Two</h1><p>y{note_html(1)}</p>{notes_section(1)}'
+    chapters = merge_fragments([first, second], 'Book')
+    assert [chapter.title for chapter in chapters] == ['Book', 'One', 'Two']
+    assert [chapter.name for chapter in chapters] == ['ch001.xhtml', 'ch002.xhtml', 'ch003.xhtml']
+    assert 'id="fnref3"' in chapters[2].body and '<sup>3</sup>' in chapters[2].body
+    assert chapters[1].headings == [(1, 'one', 'One')]
+    print("✓ footnotes continue across chunks")
+
+
+def test_links_point_to_the_chapter_defining_their_target():
+    """Duplicate identifiers get suffixes, and local links to other chapters name their file."""
+    bodies = [
+        '<h1 id="intro">Intro</h1><p><a href="#details">details</a> <a href="#intro">top</a></p>',
+        '<h1 id="intro">Intro again</h1><h2 id="details">Details</h2><p><a href="#intro">back</a></p>',
+    ]
+    names = ['ch001.xhtml', 'ch002.xhtml']
+    first, second = link_chapters(bodies, names)
+    assert 'href="ch002.xhtml#details"' in first
+    assert 'href="#intro"' in first
+    assert 'id="intro-1"' in second and 'id="details"' in second
+    # The first chapter keeps the identifier, so links to it go there
+    assert 'href="ch001.xhtml#intro"' in second
+    print("✓ cross-chapter links")
+
+
+if __name__ == "__main__":
+    failed = False
+    for test in (test_split_at_level_one_headings, test_chunks_carry_their_definitions, test_renumber_footnotes,
+                 test_merged_chapters_number_footnotes_through_the_book,
+                 test_links_point_to_the_chapter_defining_their_target):
+        print(f"\n{test.__doc__}")
+        try:
+            test()
+        except AssertionError as e:
+            print(f"✗ {e}")
+            failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Test script for answering /convert without converting: ETag revalidation
+with If-None-Match, and Idempotency-Key claims, conflicts and replays.
+
+Conversions use the native engine, so pandoc is not needed.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+from io import BytesIO
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import app
+from idempotency_store import IdempotencyConflict, IdempotencyStore
+
+DOCUMENT = {'markdown': "# Chapter One\n\nA paragraph.", 'title': 'Book', 'author': 'Author'}
+
+
+@pytest.fixture
+def store():
+    store = IdempotencyStore(tempfile.mkdtemp(), ttl=60, retry_after=3)
+    yield store
+    shutil.rmtree(store.directory, ignore_errors=True)
+
+
+@pytest.fixture
+def client(store, monkeypatch):
+    monkeypatch.setattr(app, 'NATIVE_ENGINE', 'auto')
+    monkeypatch.setattr(app, 'result_cache', None)
+    monkeypatch.setattr(app, 'idempotency_store', store)
+    monkeypatch.setattr(app, 'AUTH_TOKEN', '')
+    return app.app.test_client()
+
+
+def test_claim_complete_and_replay(store):
+    """A key is claimed by its first request, and returns its record once completed."""
+    assert store.begin('key-1', 'fingerprint') is None
+    with pytest.raises(IdempotencyConflict) as conflict:
+        store.begin('key-1', 'fingerprint')
+    assert (conflict.value.status_code, conflict.value.retry_after) == (409, 3)
+
+    source = os.path.join(store.directory, 'book.epub')
+    with open(source, 'wb') as f:
+        f.write(b'epub bytes')
+    store.complete('key-1', 'fingerprint', source, {'X-Conversion-Engine': 'native'})
+    record = store.begin('key-1', 'fingerprint')
+    assert record['headers'] == {'X-Conversion-Engine': 'native'}
+    with open(store.result_path('key-1'), 'rb') as f:
+        assert f.read() == b'epub bytes'
+    print("✓ claim, complete, replay")
+
+
+def test_key_conflicts(store):
+    """A key reused for another request gets 422, a malformed key 400, and a released key can be retried."""
+    store.begin('key-2', 'first')
+    store.release('key-2')
+    assert store.begin('key-2', 'second') is None
+    store.complete('key-2', 'second', tempfile.SpooledTemporaryFile(), {})
+    with pytest.raises(IdempotencyConflict) as conflict:
+        store.begin('key-2', 'first')
+    assert conflict.value.status_code == 422
+    with pytest.raises(IdempotencyConflict) as conflict:
+        store.begin('has spaces', 'first')
+    assert conflict.value.status_code == 400
+    print("✓ 422, 400 and retry after release")
+
+
+def test_etag_revalidation(client):
+    """A /convert response carries its conversion key as ETag, and If-None-Match with it gets 304."""
+    response = client.post('/convert', json=DOCUMENT)
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert response.headers['X-Conversion-Engine'] == 'native'
+
+    response = client.post('/convert', json=DOCUMENT, headers={'If-None-Match': etag})
+    assert response.status_code == 304 and response.headers['ETag'] == etag
+    assert response.get_data() == b''
+
+    changed = dict(DOCUMENT, title='Another Book')
+    response = client.post('/convert', json=changed, headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+    print("✓ ETag and 304")
+
+
+def test_idempotency_key_replay_and_conflict(client):
+    """A retry with the same Idempotency-Key replays the first response; another body gets 422."""
+    headers = {'Idempotency-Key': 'retry-1'}
+    first = client.post('/convert', json=DOCUMENT, headers=headers)
+    assert first.status_code == 200 and 'Idempotent-Replayed' not in first.headers
+
+    replay = client.post('/convert', json=DOCUMENT, headers=headers)
+    assert replay.status_code == 200
+    assert replay.headers['Idempotent-Replayed'] == 'true'
+    assert replay.headers['X-Conversion-Engine'] == 'native'
+    assert replay.get_data() == first.get_data()
+
+    conflict = client.post('/convert', json=dict(DOCUMENT, title='Another Book'), headers=headers)
+    assert conflict.status_code == 422
+    print("✓ replay and 422")
+
+
+def test_idempotency_key_replay_in_memory(client, monkeypatch):
+    """With PANDOC_IO=pipe the EPUB is built in memory and read by verification; the replay is still whole."""
+    monkeypatch.setattr(app, 'PANDOC_IO', 'pipe')
+    monkeypatch.setattr(app, 'EPUB_COMPRESSION', 'off')
+    headers = {'Idempotency-Key': 'retry-pipe'}
+    first = client.post('/convert', json=DOCUMENT, headers=headers)
+    assert first.status_code == 200
+
+    replay = client.post('/convert', json=DOCUMENT, headers=headers)
+    assert replay.headers['Idempotent-Replayed'] == 'true'
+    assert replay.get_data() == first.get_data()
+    assert zipfile.ZipFile(BytesIO(replay.get_data())).testzip() is None
+    print("✓ replay of an in-memory conversion")
+
+
+def test_idempotency_key_replay_of_pruned_response(client, store, monkeypatch):
+    """A record whose EPUB was pruned after it was read is converted again, and stored for the next retry."""
+    headers = {'Idempotency-Key': 'retry-pruned'}
+    first = client.post('/convert', json=DOCUMENT, headers=headers)
+    begin = store.begin
+
+    def begin_then_prune(idempotency_key, fingerprint):
+        record = begin(idempotency_key, fingerprint)
+        if record is not None:
+            os.remove(store.result_path(idempotency_key))
+        return record
+
+    monkeypatch.setattr(store, 'begin', begin_then_prune)
+    response = client.post('/convert', json=DOCUMENT, headers=headers)
+    assert response.status_code == 200 and 'Idempotent-Replayed' not in response.headers
+    assert response.get_data() == first.get_data()
+
+    monkeypatch.setattr(store, 'begin', begin)
+    replay = client.post('/convert', json=DOCUMENT, headers=headers)
+    assert replay.headers['Idempotent-Replayed'] == 'true'
+    assert replay.get_data() == first.get_data()
+    print("✓ pruned response converted again")
+
+
+def test_idempotency_key_in_progress(client, store):
+    """A retry while the first request with the key is still converting gets 409 with Retry-After."""
+    fingerprint = app.conversion_cache_key(
+        app.normalize_markdown(DOCUMENT['markdown']), app.build_metadata('Book', 'Author'),
+        app.build_pandoc_options('Book', 'Author'))
+    store.begin('busy-1', fingerprint)
+    response = client.post('/convert', json=DOCUMENT, headers={'Idempotency-Key': 'busy-1'})
+    assert response.status_code == 409
+    assert response.headers['Retry-After'] == '3'
+    print("✓ 409 while in progress")
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
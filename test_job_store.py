@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Test script for the job store: the job lifecycle, expiry of finished jobs and
+failing of jobs whose worker stopped updating them or died with them queued.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from job_store import JobStore
+
+
+def make_store(ttl=60, stale_after=30):
+    return JobStore(tempfile.mkdtemp(), ttl=ttl, stale_after=stale_after)
+
+
+def age_job(store, job_id, seconds):
+    """Move every timestamp of a job seconds into the past."""
+    path = os.path.join(store.directory, job_id, 'state.json')
+    with open(path, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    for field in ('created_at', 'updated_at', 'started_at', 'finished_at'):
+        if field in state:
+            state[field] -= seconds
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+
+
+def test_lifecycle():
+    """A job goes from queued through running to done and keeps its fields."""
+    store = make_store()
+    try:
+        job_id = store.create(title='Book')
+        state = store.get(job_id)
+        assert state['status'] == 'queued' and state['title'] == 'Book'
+        assert 'started_at' not in state
+
+        state = store.update(job_id, status='running', stage='pandoc', progress=50)
+        assert state['status'] == 'running' and state['started_at'] == state['updated_at']
+
+        state = store.update(job_id, status='done', progress=100)
+        assert state['status'] == 'done' and state['finished_at'] == state['updated_at']
+        assert store.get(job_id)['progress'] == 100
+        assert store.get('not-a-job-id') is None
+        print("✓ queued → running → done")
+    finally:
+        shutil.rmtree(store.directory)
+
+
+def test_queued_job_does_not_go_stale():
+    """A job waiting in the queue longer than stale_after is still queued, and runs when its turn comes."""
+    store = make_store()
+    try:
+        job_id = store.create()
+        age_job(store, job_id, 3600)
+        assert store.get(job_id)['status'] == 'queued'
+
+        store.update(job_id, status='running', stage='pandoc', progress=10)
+        assert store.get(job_id)['status'] == 'running'
+        assert job_id not in store._claims
+        print("✓ queued → stale age → running")
+    finally:
+        shutil.rmtree(store.directory)
+
+
+def test_job_queued_by_a_stopped_worker_fails():
+    """A queued job fails once the process that queued it has exited, and then expires like any other."""
+    store = make_store(ttl=60)
+    try:
+        script = ("import sys; from job_store import JobStore; "
+                  "print(JobStore(sys.argv[1], ttl=60, stale_after=30).create())")
+        job_id = subprocess.run([sys.executable, '-c', script, store.directory], check=True, capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        state = store.get(job_id)
+        assert state['status'] == 'failed' and state['error'] == 'Job was interrupted'
+
+        # Jobs queued by a live process stay queued
+        own_job = store.create()
+        assert store.get(own_job)['status'] == 'queued'
+        other = JobStore(store.directory, ttl=60, stale_after=30)
+        assert other.get(own_job)['status'] == 'queued'
+
+        age_job(store, job_id, 61)
+        assert store.get(job_id) is None
+        print("✓ queued by a stopped worker → failed → expired")
+    finally:
+        shutil.rmtree(store.directory)
+
+
+def test_stale_running_job_fails_for_good():
+    """A running job without progress fails, and late updates from its worker do not revive it."""
+    store = make_store()
+    try:
+        job_id = store.create()
+        store.update(job_id, status='running', progress=10)
+        age_job(store, job_id, 31)
+        state = store.get(job_id)
+        assert state['status'] == 'failed' and state['error'] == 'Job was interrupted'
+
+        assert store.update(job_id, status='running', progress=60)['status'] == 'failed'
+        assert store.update(job_id, status='done', progress=100)['status'] == 'failed'
+        assert store.get(job_id)['progress'] == 10
+        print("✓ running → stale → failed stays failed")
+    finally:
+        shutil.rmtree(store.directory)
+
+
+def test_finished_job_expires():
+    """Finished jobs are deleted once they are older than the TTL."""
+    store = make_store(ttl=60)
+    try:
+        job_id = store.create()
+        store.update(job_id, status='done')
+        age_job(store, job_id, 30)
+        assert store.get(job_id) is not None
+        age_job(store, job_id, 31)
+        assert store.get(job_id) is None
+        assert not os.path.exists(os.path.join(store.directory, job_id))
+        assert store.update(job_id, status='running') is None
+        print("✓ finished jobs expire")
+    finally:
+        shutil.rmtree(store.directory)
+
+
+if __name__ == "__main__":
+    failed = False
+    for test in (test_lifecycle, test_queued_job_does_not_go_stale, test_job_queued_by_a_stopped_worker_fails,
+                 test_stale_running_job_fails_for_good, test_finished_job_expires):
+        print(f"\n{test.__doc__}")
+        try:
+            test()
+        except AssertionError as e:
+            print(f"✗ {e}")
+            failed = True
+    sys.exit(1 if failed else 0)
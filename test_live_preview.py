@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Test script for the live preview: splitting markdown into blocks, rendering
+only the blocks that changed, and putting footnotes and identifiers of
+separately rendered blocks back together. Also checks that /preview stays
+out of the admission control of conversions.
+
+A small stand-in for pandoc renders the blocks, so pandoc is not needed.
+"""
+
+import os
+import re
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import app
+from live_preview import block_sources, render_preview, split_blocks
+from result_cache import ResultCache
+
+DOCUMENT = ("# Intro\n\nFirst paragraph.[^a]\n\nSecond paragraph.\n\n"
+            "# Intro\n\nThird paragraph.[^b]\n\n[^a]: Note A.\n\n[^b]: Note B.\n")
+
+
+class FakePandoc:
+    """Renders headings, paragraphs and footnotes with pandoc's HTML markup, and records its input."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, markdown):
+        self.calls.append(markdown)
+        notes = {}
+        labels = []
+        blocks = []
+
+        def reference(match):
+            if match.group(1) not in labels:
+                labels.append(match.group(1))
+            n = labels.index(match.group(1)) + 1
+            return f'<a href="#fn{n}" class="footnote-ref" id="fnref{n}" role="doc-noteref"><sup>{n}</sup></a>'
+
+        for block in re.split(r'\n\s*\n', markdown.strip()):
+            definition = re.match(r'\[\^(\w+)\]: (.*)', block, re.DOTALL)
+            if definition:
+                notes[definition.group(1)] = definition.group(2)
+                continue
+            text = re.sub(r'\[\^(\w+)\]', reference, block)
+            heading = re.match(r'# (.*)', text)
+            if heading:
+                blocks.append(f'<h1 id="{heading.group(1).lower()}">{heading.group(1)}</h1>')
+            else:
+                blocks.append(f'<p>{text}</p>')
+
+        html = '\n'.join(blocks)
+        if labels:
+            items = '\n'.join(f'<li id="fn{n}"><p>{notes[label]}<a href="#fnref{n}" class="footnote-back">↩︎</a></p></li>'
+                              for n, label in enumerate(labels, 1))
+            html += ('\n<section id="footnotes" class="footnotes footnotes-end-of-document" role="doc-endnotes">'
+                     f'\n<hr />\n<ol>\n{items}\n</ol>\n</section>')
+        return html
+
+
+@pytest.fixture
+def cache():
+    return ResultCache(None, max_memory_bytes=1024 * 1024, max_disk_bytes=0, ttl=0)
+
+
+def test_split_blocks():
+    markdown = ("Para one\ncontinued.\n\n- item one\n\n- item two\n\n      code in item\n\n"
+                "```\ncode\n\nmore code\n```\n\n::: note\nInside\n\nthe div\n:::\n\nLast.")
+    assert split_blocks(markdown.split('\n')) == [
+        "Para one\ncontinued.",
+        "- item one\n\n- item two\n\n      code in item",
+        "```\ncode\n\nmore code\n```",
+        "::: note\nInside\n\nthe div\n:::",
+        "Last.",
+    ]
+
+
+def test_blocks_carry_their_definitions():
+    sources = block_sources("See [home][h].[^a]\n\nPlain.\n\n[h]: https://example.com\n\n[^a]: The note.")
+    assert sources == ["See [home][h].[^a]\n\n[^a]: The note.\n\n[h]: https://example.com\n",
+                       "Plain.\n\n[h]: https://example.com\n"]
+
+
+def test_footnotes_and_identifiers():
+    html, blocks, rendered = render_preview(DOCUMENT, 'markdown', FakePandoc())
+    assert (blocks, rendered) == (5, 5)
+    assert html.count('<h1 id="intro">') == 1 and '<h1 id="intro-1">' in html
+    assert 'First paragraph.<a href="#fn1"' in html
+    assert 'Third paragraph.<a href="#fn2"' in html
+    assert html.count('<section class="footnotes"') == 1
+    assert html.index('<li id="fn1"><p>Note A.') < html.index('<li id="fn2"><p>Note B.')
+
+
+def test_only_changed_blocks_are_rendered(cache):
+    render = FakePandoc()
+    first, _, rendered = render_preview(DOCUMENT, 'markdown', render, cache)
+    assert rendered == 5 and len(render.calls) == 1
+
+    # Unchanged: nothing goes to pandoc
+    assert render_preview(DOCUMENT, 'markdown', render, cache) == (first, 5, 0)
+    assert len(render.calls) == 1
+
+    edited = DOCUMENT.replace('Second paragraph.', 'Second paragraph, edited.')
+    html, blocks, rendered = render_preview(edited, 'markdown', render, cache)
+    assert (blocks, rendered) == (5, 1)
+    assert render.calls[-1] == "Second paragraph, edited.\n"
+    assert html == render_preview(edited, 'markdown', FakePandoc())[0]
+
+    # A changed note re-renders the block that uses it, and numbering stays continuous
+    edited = edited.replace('Note A.', 'Note A, edited.')
+    html, _, rendered = render_preview(edited, 'markdown', render, cache)
+    assert rendered == 1
+    assert '<li id="fn1"><p>Note A, edited.' in html and '<li id="fn2"><p>Note B.' in html
+
+
+def test_block_swallowing_the_boundary_is_rendered_alone():
+    render = FakePandoc()
+
+    def swallowing(markdown):
+        return render(re.sub(r'<div>\s*previewblockboundary', '<div>', markdown))
+
+    html, blocks, rendered = render_preview("<div>\n\nText.", 'markdown', swallowing)
+    assert (blocks, rendered) == (2, 2)
+    assert len(render.calls) == 3
+
+
+@pytest.fixture
+def client(monkeypatch):
+    class NoAdmission:
+        def acquire(self):
+            raise AssertionError("previews must not take a pandoc slot")
+
+    monkeypatch.setattr(app, 'admission', NoAdmission())
+    monkeypatch.setattr(app, 'preview_cache', None)
+    monkeypatch.setattr(app, 'pandoc_pool', None)
+    monkeypatch.setattr(app, 'AUTH_TOKEN', '')
+    return app.app.test_client()
+
+
+def test_preview_with_native_engine(client, monkeypatch):
+    monkeypatch.setattr(app, 'NATIVE_ENGINE', 'auto')
+    response = client.post('/preview', json={'markdown': "# Chapter\n\nSome *text*."})
+    assert response.status_code == 200
+    assert response.get_json() == {'html': '<h1 id="chapter">Chapter</h1>\n<p>Some <em>text</em>.</p>',
+                                   'blocks': 2, 'rendered': 2}
+
+
+def test_busy_preview_slots(client, monkeypatch):
+    slots = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(app, 'preview_slots', slots)
+    slots.acquire()
+    # Code blocks need pandoc
+    response = client.post('/preview', json={'markdown': "    code"})
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Test script checking that the single-pass normalizer matches the original
+chain of str.replace/re.sub rewrites exactly, on whole documents and when the
+input arrives in chunks.
+"""
+
+import os
+import random
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from markdown_normalizer import MarkdownNormalizer, normalize_markdown
+
+HEADER_BREAK_RE = re.compile(r'(\n)#')
+LIST_BREAK_RE = re.compile(r'(\n)(\*|\-|\+)(\s)')
+BLANK_LINES_RE = re.compile(r'\n\n+')
+
+
+def reference_normalize(markdown_content):
+    """The original multi-pass normalization the single-pass version replaces."""
+    normalized_content = markdown_content.replace('\r\n', '\n').replace('\r', '\n')
+    normalized_content = normalized_content.replace('\\n\\n', '\n\n')
+    normalized_content = HEADER_BREAK_RE.sub(r'\n\n#', normalized_content)
+    normalized_content = LIST_BREAK_RE.sub(r'\n\n\2\3', normalized_content)
+    return BLANK_LINES_RE.sub('\n\n', normalized_content)
+
+
+def normalize_in_chunks(text, sizes):
+    normalizer = MarkdownNormalizer()
+    out = []
+    pos = 0
+    for size in sizes:
+        out.append(normalizer.feed(text[pos:pos + size]))
+        pos += size
+    out.append(normalizer.feed(text[pos:]))
+    out.append(normalizer.close())
+    return ''.join(out)
+
+
+CASES = [
+    '',
+    'plain text',
+    '# Title\nText\n## Sub\nMore',
+    'Intro\n- one\n- two\n* three\n+ four',
+    'Windows\r\nline\r\n\r\n\r\nendings\r# header\r- item',
+    'Escaped\\n\\nbreaks\\n\\n\\n\\n# and header',
+    'Odd escape \\\\n\\n\\n',
+    'Markers without space\n-not\n*a list\n+either',
+    'Marker then break\n-\n- consumed\n-\n\n- not consumed',
+    'Marker then escaped break\n-\\n\\n- item',
+    'Marker then CR\n-\r- item\n-\r\n# header',
+    'Blank runs\n\n\n\n\nbetween\n \n\nparagraphs',
+    'Unicode space\n-\xa0item\n- item',
+    '\n\n\nLeading and trailing breaks\n\n\n',
+    '\n#starts\n-with\n- breaks',
+]
+
+
+def test_matches_reference_on_cases():
+    """Hand-picked edge cases normalize exactly like the original chain."""
+    for case in CASES:
+        assert normalize_markdown(case) == reference_normalize(case), repr(case)
+    print(f"✓ {len(CASES)} edge cases match")
+
+
+def test_matches_reference_on_random_input():
+    """Random documents built from the characters normalization cares about match the original chain."""
+    rng = random.Random(1234)
+    alphabet = ['\n', '\r', '\r\n', '\\', 'n', '\\n\\n', '#', '*', '-', '+', ' ', '\t', 'a', '\xa0']
+    for _ in range(20000):
+        text = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 60)))
+        assert normalize_markdown(text) == reference_normalize(text), repr(text)
+    print("✓ 20000 random documents match")
+
+
+def test_chunked_input_matches_whole_input():
+    """Feeding a document in chunks of any size gives the same output as normalizing it at once."""
+    rng = random.Random(5678)
+    alphabet = ['\n', '\r', '\r\n', '\\', 'n', '\\n\\n', '#', '*', '-', '+', ' ', 'a']
+    for _ in range(5000):
+        text = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 80)))
+        sizes = [rng.randint(0, 7) for _ in range(rng.randint(0, 20))]
+        assert normalize_in_chunks(text, sizes) == reference_normalize(text), (repr(text), sizes)
+    for case in CASES:
+        for size in range(1, 8):
+            assert normalize_in_chunks(case, [size] * len(case)) == reference_normalize(case), (repr(case), size)
+    print("✓ chunked normalization matches")
+
+
+if __name__ == "__main__":
+    failed = False
+    for test in (test_matches_reference_on_cases, test_matches_reference_on_random_input,
+                 test_chunked_input_matches_whole_input):
+        print(f"\n{test.__doc__}")
+        try:
+            test()
+        except AssertionError as e:
+            print(f"✗ Mismatch for input {e}")
+            failed = True
+    sys.exit(1 if failed else 0)
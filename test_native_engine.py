@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Test script comparing the native engine's EPUBs with pandoc's for simple markdown.
+
+Both engines convert the same documents; the chapter texts, TOC entries and
+metadata of the two EPUBs must match. Markup details (element attributes,
+section wrappers, identifiers) are allowed to differ. Requires pandoc on PATH;
+the pandoc comparisons are skipped without it.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+import xml.etree.ElementTree as ET
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app import build_metadata, build_pandoc_options, normalize_markdown, run_pandoc_subprocess
+from epub_writer import write_epub
+from native_engine import NativeUnsupported, render_blocks, render_chapters
+
+PANDOC_AVAILABLE = shutil.which('pandoc') is not None
+
+XHTML = '{http://www.w3.org/1999/xhtml}'
+OPF = '{http://www.idpf.org/2007/opf}'
+DC = '{http://purl.org/dc/elements/1.1/}'
+OPS = '{http://www.idpf.org/2007/ops}'
+
+BLOCK_TAGS = {'p', 'li', 'ul', 'ol', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'section', 'div', 'hr', 'br', 'body'}
+
+# Documents inside the native engine's subset; each starts with a level-1 heading
+CORPUS = {
+    'headings': "# Chapter One\n\nA paragraph.\n\n## Section\n\nText.\n\n### Subsection\n\nMore text.\n\n# Chapter Two\n\nThe end.",
+    'emphasis': "# Styles\n\nSome *emphasis*, some **strong** text, _underscored_ and __double__ words, `inline code` and snake_case_names.",
+    'links': "# Links\n\nA [link](https://example.com/page?a=1&b=2), an autolink <https://example.org> and a bare https://example.net/path.",
+    'smart': "# Punctuation\n\n\"Hello,\" she said. It's 'quoted' -- mostly... Ranges 1--2 and dashes --- everywhere.",
+    'line breaks': "# Poem\n\nFirst line\nsecond line\nthird line\n\nNext stanza.",
+    'lists': "# Lists\n\n- apples\n- pears\n  - green\n  - red\n- plums\n\nThen numbers:\n\n1. one\n2. two\n3. three",
+    'duplicate headings': "# Notes\n\nFirst.\n\n# Notes\n\nSecond.\n\n## Notes\n\nThird.",
+    'rule': "# Break\n\nBefore.\n\n---\n\nAfter.",
+}
+
+# Documents the native engine must hand to pandoc
+UNSUPPORTED = {
+    'table': "# T\n\n| a | b |\n|---|---|\n| 1 | 2 |",
+    'blockquote': "# T\n\n> quoted",
+    'code block': "# T\n\n```\ncode\n```",
+    'indented code': "# T\n\n    code",
+    'footnote': "# T\n\nText[^1]\n\n[^1]: Note.",
+    'inline note': "# T\n\nText^[Note.]",
+    'raw html': "# T\n\n<div>html</div>",
+    'image': "# T\n\n![alt](image.png)",
+    'math': "# T\n\n$x^2$",
+    'escape': "# T\n\nA \\*literal\\* star.",
+    'entity': "# T\n\nAT&amp;T",
+    'setext heading': "Title\n=====\n\nText.",
+    'heading attributes': "# Title {#custom}\n\nText.",
+    'definition list': "# T\n\nTerm\n: Definition",
+    'div': "# T\n\n::: note\nText\n:::",
+    'unmatched emphasis': "# T\n\n2 * 3 = 6",
+    'list item paragraphs': "# T\n\n- a\n\n  continued para\n- b",
+    'loose nested list': "# T\n\n- a\n\n  - sub\n- b",
+}
+
+
+def element_text(element, parts):
+    """Collect the text of an element, separating block-level elements with spaces."""
+    tag = element.tag.replace(XHTML, '')
+    block = tag in BLOCK_TAGS
+    if block:
+        parts.append(' ')
+    if element.text:
+        parts.append(element.text)
+    for child in element:
+        element_text(child, parts)
+        if child.tail:
+            parts.append(child.tail)
+    if block:
+        parts.append(' ')
+
+
+def normalize_text(text):
+    # split() also folds the non-breaking spaces pandoc inserts after abbreviations
+    return ' '.join(text.split())
+
+
+def read_epub(path):
+    """Return (title, creators, chapter texts, TOC entries) of an EPUB."""
+    with zipfile.ZipFile(path) as zf:
+        container = ET.fromstring(zf.read('META-INF/container.xml'))
+        opf_path = next(el.get('full-path') for el in container.iter() if el.tag.endswith('rootfile'))
+        opf_dir = os.path.dirname(opf_path)
+        opf = ET.fromstring(zf.read(opf_path))
+
+        title = normalize_text(opf.find(f'.//{DC}title').text or '')
+        creators = [normalize_text(el.text or '') for el in opf.iter(f'{DC}creator')]
+
+        manifest = {item.get('id'): item for item in opf.iter(f'{OPF}item')}
+        chapters = []
+        nav_href = None
+        for item in manifest.values():
+            if 'nav' in (item.get('properties') or '').split():
+                nav_href = item.get('href')
+        for itemref in opf.iter(f'{OPF}itemref'):
+            href = manifest[itemref.get('idref')].get('href')
+            if href == nav_href or os.path.basename(href).startswith('title_page'):
+                continue
+            doc = ET.fromstring(zf.read(os.path.join(opf_dir, href)))
+            parts = []
+            element_text(doc.find(f'{XHTML}body'), parts)
+            chapters.append(normalize_text(''.join(parts)))
+
+        toc = []
+        nav = ET.fromstring(zf.read(os.path.join(opf_dir, nav_href)))
+        for nav_el in nav.iter(f'{XHTML}nav'):
+            if nav_el.get(f'{OPS}type') == 'toc':
+                collect_toc(nav_el.find(f'{XHTML}ol'), 1, toc)
+    return title, creators, chapters, toc
+
+
+def collect_toc(ol, level, entries):
+    if ol is None:
+        return
+    for li in ol.findall(f'{XHTML}li'):
+        link = li.find(f'{XHTML}a')
+        if link is not None:
+            parts = []
+            element_text(link, parts)
+            entries.append((level, normalize_text(''.join(parts))))
+        collect_toc(li.find(f'{XHTML}ol'), level + 1, entries)
+
+
+def convert_both(markdown, temp_dir, title='Equivalence Test', author='Test Author'):
+    normalized = normalize_markdown(markdown)
+    metadata = build_metadata(title, author)
+
+    native_path = os.path.join(temp_dir, 'native.epub')
+    write_epub(native_path, metadata, render_chapters(normalized, title), toc_depth=3)
+
+    input_path = os.path.join(temp_dir, 'input.md')
+    with open(input_path, 'w', encoding='utf-8') as f:
+        f.write(normalized)
+    pandoc_path = os.path.join(temp_dir, 'pandoc.epub')
+    run_pandoc_subprocess(input_path, metadata, build_pandoc_options(title, author), pandoc_path, temp_dir)
+
+    return read_epub(native_path), read_epub(pandoc_path)
+
+
+def test_native_matches_pandoc():
+    """The native engine's output matches pandoc's for every document in the corpus."""
+    if not PANDOC_AVAILABLE:
+        pytest.skip("pandoc not installed")
+
+    failures = []
+    for name, markdown in CORPUS.items():
+        temp_dir = tempfile.mkdtemp()
+        try:
+            native, pandoc = convert_both(markdown, temp_dir)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        for label, index in (('title', 0), ('creators', 1), ('chapters', 2), ('toc', 3)):
+            if native[index] != pandoc[index]:
+                failures.append(name)
+                print(f"✗ {name}: {label} differs")
+                print(f"  native: {native[index]}")
+                print(f"  pandoc: {pandoc[index]}")
+                break
+        else:
+            print(f"✓ {name}")
+
+    assert not failures, f"Native output differs from pandoc for: {', '.join(failures)}"
+
+
+def test_unsupported_markdown_falls_back():
+    """Markdown outside the native subset is rejected so pandoc converts it."""
+    accepted = []
+    for name, markdown in UNSUPPORTED.items():
+        try:
+            render_blocks(normalize_markdown(markdown))
+        except NativeUnsupported as e:
+            print(f"✓ {name}: {e}")
+        else:
+            accepted.append(name)
+            print(f"✗ {name}: rendered natively")
+
+    assert not accepted, f"Native engine accepted unsupported markdown: {', '.join(accepted)}"
+
+
+def test_chapters_split_at_level_one_headings():
+    """Chapters follow pandoc's EPUB split: preamble first, then one per level-1 heading."""
+    chapters = render_chapters(normalize_markdown("Preamble.\n\n# One\n\n## One A\n\n# Two"), 'Book')
+    assert [c.title for c in chapters] == ['Book', 'One', 'Two']
+    assert [c.name for c in chapters] == ['ch001.xhtml', 'ch002.xhtml', 'ch003.xhtml']
+    assert chapters[1].headings == [(1, 'one', 'One'), (2, 'one-a', 'One A')]
+    print("✓ chapter split")
+
+
+if __name__ == "__main__":
+    failed = False
+    for test in (test_chapters_split_at_level_one_headings, test_unsupported_markdown_falls_back,
+                 test_native_matches_pandoc):
+        print(f"\n{test.__doc__}")
+        try:
+            test()
+        except AssertionError as e:
+            print(f"✗ {e}")
+            failed = True
+        except pytest.skip.Exception as e:
+            print(f"- skipped: {e}")
+    sys.exit(1 if failed else 0)
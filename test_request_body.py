@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Test script for decompressing request bodies: gzip and zstd bodies are
+decoded, and the size limit applies to the decoded bytes as they are read.
+"""
+
+import gzip
+import os
+import sys
+
+import pytest
+from werkzeug.test import EnvironBuilder
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from request_body import (BodyDecodeError, BodyTooLarge, UnsupportedEncoding, install_body_stream,
+                          supported_encodings, zstandard)
+
+LIMIT = 64 * 1024
+
+
+def make_environ(body, encoding=None):
+    headers = {'Content-Encoding': encoding} if encoding else {}
+    return EnvironBuilder(method='POST', data=body, headers=headers).get_environ()
+
+
+def read_body(environ, max_bytes=LIMIT):
+    install_body_stream(environ, max_bytes)
+    return environ['wsgi.input'].read()
+
+
+def compress(data, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(data)
+    if zstandard is None:
+        pytest.skip("zstandard not installed")
+    return zstandard.ZstdCompressor().compress(data)
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'zstd'])
+def test_compressed_body_is_decoded(encoding):
+    """A compressed body under the limit reads back as the original bytes."""
+    data = b'# Chapter\n\n' + b'text ' * 5000
+    assert read_body(make_environ(compress(data, encoding), encoding)) == data
+    print(f"✓ {encoding} body decoded")
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'zstd'])
+def test_decoded_size_is_limited(encoding):
+    """A small compressed body that expands past the limit is rejected while it is read."""
+    body = compress(b'\0' * (LIMIT * 16), encoding)
+    assert len(body) < LIMIT
+    environ = make_environ(body, encoding)
+    with pytest.raises(BodyTooLarge):
+        read_body(environ)
+    print(f"✓ {encoding} bomb rejected")
+
+
+def test_limit_of_exactly_max_bytes_is_accepted():
+    """The limit is inclusive, and 0 disables it."""
+    data = b'a' * LIMIT
+    assert read_body(make_environ(gzip.compress(data), 'gzip')) == data
+    assert read_body(make_environ(gzip.compress(data * 4), 'gzip'), max_bytes=0) == data * 4
+    print("✓ limit boundaries")
+
+
+def test_declared_length_over_limit_is_rejected_up_front():
+    """An uncompressed body with a Content-Length over the limit is rejected before reading."""
+    with pytest.raises(BodyTooLarge):
+        install_body_stream(make_environ(b'a' * (LIMIT + 1)), LIMIT)
+    print("✓ Content-Length checked")
+
+
+def test_bad_encodings():
+    """Unknown encodings and corrupt bodies raise their own errors."""
+    with pytest.raises(UnsupportedEncoding):
+        install_body_stream(make_environ(b'data', 'br'), LIMIT)
+    with pytest.raises(BodyDecodeError):
+        read_body(make_environ(b'not gzip at all', 'gzip'))
+    with pytest.raises(BodyDecodeError):
+        read_body(make_environ(gzip.compress(b'a' * 1000)[:20], 'gzip'))
+    assert 'gzip' in supported_encodings()
+    print("✓ unsupported and corrupt bodies")
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Test script for the result cache: keys, the memory and disk tiers, eviction
+by age and size, and the hit/miss counters.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from result_cache import ResultCache, cache_key, cache_key_hasher
+
+METADATA = {'title': 'Book', 'author': 'Author'}
+ARGS = ['-f', 'markdown', '-t', 'epub3']
+
+
+@pytest.fixture
+def directory():
+    directory = tempfile.mkdtemp()
+    yield directory
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def set_times(cache, key, accessed, modified):
+    os.utime(cache._entry_path(key), (accessed, modified))
+
+
+def test_cache_key():
+    markdown = "# Chapter\n\nText with ünïcode."
+    key = cache_key(markdown, METADATA, ARGS)
+    hasher = cache_key_hasher(METADATA, ARGS)
+    for line in markdown.encode('utf-8').splitlines(keepends=True):
+        hasher.update(line)
+    assert hasher.hexdigest() == key
+
+    # Key order of the metadata does not matter, everything else does
+    assert cache_key(markdown, {'author': 'Author', 'title': 'Book'}, ARGS) == key
+    assert cache_key(markdown + ' ', METADATA, ARGS) != key
+    assert cache_key(markdown, dict(METADATA, title='Other'), ARGS) != key
+    assert cache_key(markdown, METADATA, ARGS + ['--toc']) != key
+
+
+def test_memory_tier_evicts_least_recently_used():
+    # Room for 16 entries of the largest size kept in memory
+    cache = ResultCache(None, max_memory_bytes=16 * 30, max_disk_bytes=0, ttl=0)
+    for index in range(16):
+        cache.put(index, b'x' * 30)
+    assert cache.get(0) == b'x' * 30
+    cache.put(16, b'x' * 30)
+    assert cache.get(1) is None
+    assert all(cache.get(index) is not None for index in [0] + list(range(2, 17)))
+
+    stats = cache.stats()
+    assert (stats['memory_hits'], stats['misses'], stats['stores'], stats['evictions']) == (17, 1, 17, 1)
+    assert (stats['memory_entries'], stats['memory_bytes']) == (16, 480)
+    assert stats['hit_ratio'] == round(17 / 18, 4)
+
+    cache.put('large', b'x' * 31)
+    assert cache.get('large') is None
+
+
+def test_memory_tier_expires_entries():
+    cache = ResultCache(None, max_memory_bytes=1024 * 1024, max_disk_bytes=0, ttl=60)
+    cache.put('a', b'data')
+    cache._memory['a'] = (time.time() - 61, b'data')
+    assert cache.get('a') is None
+    assert cache.stats()['evictions'] == 1
+
+
+def test_disk_tier(directory):
+    # Entries larger than a sixteenth of the memory tier are kept on disk only
+    cache = ResultCache(directory, max_memory_bytes=1600, max_disk_bytes=1024 * 1024, ttl=60)
+    cache.put('small', b's' * 10)
+    cache.put('large', b'l' * 1000)
+    assert set(os.listdir(directory)) == {'small.epub', 'large.epub'}
+
+    other = ResultCache(directory, max_memory_bytes=1600, max_disk_bytes=1024 * 1024, ttl=60)
+    with other.open('large') as f:
+        assert f.read() == b'l' * 1000
+    assert other.get('small') == b's' * 10
+    assert other.get('small') == b's' * 10
+    stats = other.stats()
+    assert (stats['disk_hits'], stats['memory_hits'], stats['memory_entries']) == (2, 1, 1)
+
+    source = os.path.join(directory, 'result.tmp')
+    with open(source, 'wb') as f:
+        f.write(b'f' * 1000)
+    other.put_file('file', source)
+    assert cache.get('file') == b'f' * 1000
+
+
+def test_disk_tier_expires_entries(directory):
+    cache = ResultCache(directory, max_memory_bytes=0, max_disk_bytes=1024 * 1024, ttl=60)
+    cache.put('a', b'data')
+    now = time.time()
+    set_times(cache, 'a', now, now - 61)
+    assert cache.get('a') is None
+    assert not os.path.exists(cache._entry_path('a'))
+    assert cache.stats()['evictions'] == 1
+
+
+def test_disk_tier_evicts_least_recently_used(directory):
+    cache = ResultCache(directory, max_memory_bytes=0, max_disk_bytes=3000, ttl=3600)
+    now = time.time()
+    for age, key in enumerate('abc'):
+        cache.put(key, key.encode() * 1000)
+        set_times(cache, key, now - 100 + age, now - 100 + age)
+
+    # A hit makes the oldest entry the most recently used, but does not make it younger
+    assert cache.get('a') == b'a' * 1000
+    st = os.stat(cache._entry_path('a'))
+    assert st.st_atime > now - 1
+    assert st.st_mtime == pytest.approx(now - 100)
+
+    cache.put('d', b'd' * 1000)
+    assert sorted(os.listdir(directory)) == ['a.epub', 'c.epub', 'd.epub']
+    assert cache.stats()['evictions'] == 1
+
+
+def test_suffix_separates_caches(directory):
+    epubs = ResultCache(directory, max_memory_bytes=0, max_disk_bytes=2000, ttl=3600)
+    asts = ResultCache(directory, max_memory_bytes=0, max_disk_bytes=2000, ttl=3600, suffix='.json')
+    epubs.put('key', b'e' * 1500)
+    asts.put('key', b'j' * 1500)
+    assert sorted(os.listdir(directory)) == ['key.epub', 'key.json']
+    assert epubs.get('key') == b'e' * 1500
+    assert asts.get('key') == b'j' * 1500
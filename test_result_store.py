@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Test script for the result store: storing and expiring results, and
+resumable downloads from /results/<id> with Range and If-Range.
+"""
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import app
+from result_store import LocalResultStore, ResultStore
+
+CONTENT = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def store():
+    store = LocalResultStore(tempfile.mkdtemp(), ttl=60)
+    yield store
+    shutil.rmtree(store.directory, ignore_errors=True)
+
+
+@pytest.fixture
+def client(store, monkeypatch):
+    monkeypatch.setattr(app, 'result_store', store)
+    return app.app.test_client()
+
+
+def test_result_store_is_abstract():
+    with pytest.raises(TypeError):
+        ResultStore()
+
+
+def test_put_and_get(store):
+    result = store.put(io.BytesIO(CONTENT), 'book.epub', 'application/epub+zip')
+    stored = store.get(result.result_id)
+    assert stored is not None
+    assert (stored.filename, stored.content_type, stored.size) == ('book.epub', 'application/epub+zip', len(CONTENT))
+    with open(stored.path, 'rb') as f:
+        assert f.read() == CONTENT
+
+    path = os.path.join(store.directory, 'source.epub')
+    with open(path, 'wb') as f:
+        f.write(CONTENT)
+    assert store.get(store.put(path, 'book.epub', 'application/epub+zip').result_id).size == len(CONTENT)
+
+    assert store.get('not-an-id') is None
+    assert store.get('0' * 32) is None
+
+
+def test_expired_result_is_removed(store):
+    result = store.put(io.BytesIO(CONTENT), 'book.epub', 'application/epub+zip')
+    store.ttl = -1
+    assert store.get(result.result_id) is None
+    assert not os.path.exists(result.path)
+    assert not os.path.exists(os.path.join(store.directory, result.result_id + '.json'))
+
+
+def test_prune_removes_expired_results(store):
+    result = store.put(io.BytesIO(CONTENT), 'book.epub', 'application/epub+zip')
+    old = time.time() - 3600
+    for suffix in ('.json', '.bin'):
+        os.utime(os.path.join(store.directory, result.result_id + suffix), (old, old))
+    store._last_prune = 0
+    store.put(io.BytesIO(CONTENT), 'book.epub', 'application/epub+zip')
+    assert not os.path.exists(result.path)
+
+
+def test_download(client, store):
+    result = store.put(io.BytesIO(CONTENT), 'book.epub', 'application/epub+zip')
+    response = client.get(f'/results/{result.result_id}')
+    assert response.status_code == 200
+    assert response.data == CONTENT
+    assert response.headers['ETag'] == f'"{result.result_id}"'
+    assert 'attachment' in response.headers['Content-Disposition']
+    assert 'immutable' in response.headers['Cache-Control']
+
+    assert client.get('/results/' + '0' * 32).status_code == 404
+
+
+def test_range_download(client, store):
+    result = store.put(io.BytesIO(CONTENT), 'book.epub', 'application/epub+zip')
+    url = f'/results/{result.result_id}'
+
+    response = client.get(url, headers={'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert response.data == CONTENT[100:200]
+    assert response.headers['Content-Range'] == f'bytes 100-199/{len(CONTENT)}'
+
+    response = client.get(url, headers={'Range': 'bytes=1000-'})
+    assert response.status_code == 206
+    assert response.data == CONTENT[1000:]
+
+    # A validator of another result sends the whole file
+    response = client.get(url, headers={'Range': 'bytes=100-199', 'If-Range': '"other"'})
+    assert response.status_code == 200
+    assert response.data == CONTENT
+
+    response = client.get(url, headers={'Range': 'bytes=100-199', 'If-Range': f'"{result.result_id}"'})
+    assert response.status_code == 206
+
+    response = client.get(url, headers={'Range': f'bytes={len(CONTENT)}-'})
+    assert response.status_code == 416